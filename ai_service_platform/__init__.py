@@ -1,29 +1,67 @@
 import os
 from flask import (
     Flask,
+    abort,
     render_template,
     flash,
     redirect,
+    request,
     url_for,
     g,
+    send_file,
     send_from_directory,
 )
-
-from ai_service_platform.models.models import Base
-
-from .models import db
+from sqlalchemy import exists, select
+from werkzeug.security import safe_join
+
+from ai_service_platform.models.models import Base, Request, Role
+
+from .models import (
+    async_model_client,
+    blob_store,
+    database,
+    db,
+    deadlines,
+    dispatcher,
+    job_queue,
+    model_client,
+    model_registry,
+    preprocessing,
+    principal_cache,
+    rate_limits,
+    result_cache,
+    source_tokens,
+    status_events,
+    status_writer,
+    thumbnails,
+)
+from .models.request_handler import process_requests, process_requests_async
+from .models.schema import upgrade_schema
+from .uploads import UploadRequest
+from .commands import (
+    add_endpoint_command,
+    migrate_outputs_command,
+    migrate_uploads_command,
+    model_timeout_command,
+    redeploy_model_command,
+    remove_endpoint_command,
+    worker_command,
+)
 
 from .views.request import bp as request_bp
-from .views.auth import bp as auth_bp
+from .views.batch import bp as batch_bp
+from .views.auth import bp as auth_bp, roles_required
 from .views.source import bp as source_bp
 from .views.model import bp as model_bp
 from .views.user import bp as user_bp
+from .views.metrics import bp as metrics_bp
 
 
 def create_app(test_config=None) -> Flask:
     """Creates the flask app object"""
 
     app = Flask(__name__, instance_relative_config=True)
+    app.request_class = UploadRequest
     app.config["SECRET_KEY"] = "dev"
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
         app.instance_path, "flask-test.db"
@@ -33,6 +71,9 @@ def create_app(test_config=None) -> Flask:
     }
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["UPLOAD_FOLDER"] = os.path.join(app.instance_path, "uploads")
+    app.config["UPLOAD_MAX_SIZE"] = 16 * 1024 * 1024
+    app.config["REQUEST_PAGE_SIZE"] = 50
+    app.config["BATCH_MAX_FILES"] = 1000
 
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
@@ -60,19 +101,82 @@ def create_app(test_config=None) -> Flask:
     def send_uploaded_file(name):
         return send_from_directory(app.config["UPLOAD_FOLDER"], name)
 
+    @app.route("/thumbnails/<path:name>")
+    @roles_required([Role.ADMIN, Role.USER1, Role.USER2])
+    def send_thumbnail(name):
+        upload = safe_join(app.config["UPLOAD_FOLDER"], name)
+        if upload is None:
+            abort(404)
+        # Only uploads of requests the user can see, deleted ones are gone
+        query = select(Request.public_id).where(Request.input_file == name)
+        if g.user.role != Role.ADMIN:
+            query = query.where(Request.user_id == g.user.public_id)
+        if not db.session.scalar(select(exists(query))) or not os.path.isfile(upload):
+            abort(404)
+
+        # Thumbnails never change, browsers only have to ask whether they still exist
+        etag = thumbnails.thumbnail_name(name)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            try:
+                path = thumbnails.get(name)
+            except OSError:
+                abort(404)
+            response = send_file(path, etag=etag)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = app.config["THUMBNAIL_MAX_AGE"]
+        response.cache_control.immutable = True
+        return response
+
     app.register_blueprint(auth_bp)
     app.register_blueprint(user_bp)
     app.register_blueprint(request_bp)
+    app.register_blueprint(batch_bp)
     app.register_blueprint(source_bp)
     app.register_blueprint(model_bp)
+    app.register_blueprint(metrics_bp)
+
+    app.cli.add_command(worker_command)
+    app.cli.add_command(redeploy_model_command)
+    app.cli.add_command(model_timeout_command)
+    app.cli.add_command(add_endpoint_command)
+    app.cli.add_command(remove_endpoint_command)
+    app.cli.add_command(migrate_uploads_command)
+    app.cli.add_command(migrate_outputs_command)
 
     # init flask-sqlalchemy orm
     # db.init_app(app)
     app.config.from_prefixed_env()
-    db.init_app(app)
+    database.init_app(app)
 
     with app.app_context():
         Base.metadata.create_all(db.engine)
+        upgrade_schema(db.engine)
+
+    # start the inference workers, which resume any queued requests
+    model_client.init_app(app)
+    async_model_client.init_app(app)
+    model_registry.init_app(app)
+    job_queue.init_app(app)
+    deadlines.init_app(app)
+    result_cache.init_app(app)
+    blob_store.init_app(app)
+    preprocessing.init_app(app)
+    principal_cache.init_app(app)
+    rate_limits.init_app(app)
+    source_tokens.init_app(app)
+    thumbnails.init_app(app)
+    status_events.init_app(app)
+    status_writer.init_app(app)
+    dispatcher.init_app(
+        app,
+        process_requests,
+        claim=job_queue.claim_jobs,
+        async_handler=process_requests_async,
+        abandoned=job_queue.abandoned_jobs,
+    )
 
     # init flask-marshmallow object serializer/deserializer
     # ma.init_app(app)
@@ -0,0 +1,125 @@
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from .models import (
+    blob_store,
+    db,
+    dispatcher,
+    model_registry,
+    preprocessing,
+    result_cache,
+    status_writer,
+)
+from .models.models import Model, ModelEndpoint
+from .models.schema import migrate_outputs
+
+
+@click.command("worker")
+@with_appcontext
+def worker_command():
+    """Process queued requests until interrupted"""
+    dispatcher.start()
+    model_registry.start()
+    click.echo("Worker started, press CTRL+C to quit")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        click.echo("Finishing running requests")
+        dispatcher.shutdown()
+        model_registry.shutdown()
+        preprocessing.shutdown()
+        status_writer.shutdown()
+
+
+def get_model(name: str) -> Model:
+    model = db.session.scalar(select(Model).filter_by(name=name))
+    if model is None:
+        raise click.BadParameter(f"No model named {name}", param_hint="NAME")
+    return model
+
+
+@click.command("redeploy-model")
+@click.argument("name")
+@with_appcontext
+def redeploy_model_command(name):
+    """Mark a model as redeployed and drop its cached results"""
+    model = get_model(name)
+    model.revision += 1
+    db.session.commit()
+    result_cache.invalidate(model)
+    click.echo(f"Model {name} is now at revision {model.revision}")
+
+
+@click.command("model-timeout")
+@click.argument("name")
+@click.argument("seconds", type=float, required=False)
+@with_appcontext
+def model_timeout_command(name, seconds):
+    """Set the seconds requests of a model may take, or clear them"""
+    model = get_model(name)
+    model.request_timeout = seconds
+    db.session.commit()
+    if seconds is None:
+        click.echo(f"Requests of model {name} take the REQUEST_TIMEOUT")
+    else:
+        click.echo(f"Requests of model {name} have to finish within {seconds} s")
+
+
+@click.command("add-endpoint")
+@click.argument("name")
+@click.argument("url")
+@click.option("--weight", default=1.0, help="Share of the calls of the model")
+@with_appcontext
+def add_endpoint_command(name, url, weight):
+    """Serve a model by another model server, once it is warmed up"""
+    model = get_model(name)
+    endpoint = db.session.scalar(
+        select(ModelEndpoint).filter_by(model_id=model.public_id, url=url)
+    )
+    if endpoint is None:
+        endpoint = ModelEndpoint(model=model, url=url)
+        db.session.add(endpoint)
+    endpoint.weight = weight
+    db.session.commit()
+    click.echo(f"Model {name} is served by {url} with weight {weight}")
+
+
+@click.command("remove-endpoint")
+@click.argument("name")
+@click.argument("url")
+@with_appcontext
+def remove_endpoint_command(name, url):
+    """Stop serving a model by a model server"""
+    model = get_model(name)
+    endpoint = db.session.scalar(
+        select(ModelEndpoint).filter_by(model_id=model.public_id, url=url)
+    )
+    if endpoint is None:
+        raise click.BadParameter(f"{name} is not served by {url}", param_hint="URL")
+
+    db.session.delete(endpoint)
+    db.session.commit()
+    click.echo(f"Model {name} is no longer served by {url}")
+
+
+@click.command("migrate-uploads")
+@with_appcontext
+def migrate_uploads_command():
+    """Move uploads of older versions into the deduplicated blob store"""
+    migrated, missing = blob_store.migrate_uploads()
+    click.echo(f"Moved the inputs of {migrated} requests into the blob store")
+    for input_file in missing:
+        click.echo(f"Missing input file {input_file}", err=True)
+
+
+@click.command("migrate-outputs")
+@with_appcontext
+def migrate_outputs_command():
+    """Move pickled outputs of older versions into the request_output table"""
+    migrated = migrate_outputs(db.engine)
+    click.echo(f"Moved the outputs of {migrated} requests")
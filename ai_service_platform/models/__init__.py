@@ -1,3 +1,12 @@
 from flask_sqlalchemy_lite import SQLAlchemy
 
+# Created first, the clients reach the database through the model registry
 db = SQLAlchemy()
+
+from .async_client import AsyncModelServerClient
+from .dispatcher import Dispatcher
+from .model_client import ModelServerClient
+
+dispatcher = Dispatcher()
+model_client = ModelServerClient()
+async_model_client = AsyncModelServerClient()
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any
+
+from flask import Flask, current_app
+
+from .input_body import InputBody
+from .model_client import ClientState, PredictionCall
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+class _AsyncClientState(ClientState):
+    def __init__(self, app: Flask):
+        super().__init__(app)
+        concurrency = app.config.get("DISPATCHER_WORKERS", 4)
+        self.limits = httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency
+        )
+        # Created on first use, because it is bound to the running event loop
+        self.client: httpx.AsyncClient | None = None
+
+
+class AsyncModelServerClient:
+    """Asyncio counterpart of :class:`ModelServerClient` used by the asyncio engine
+
+    It shares the retry, timeout and circuit breaker configuration of the
+    synchronous client and requires the optional ``httpx`` dependency
+    (``pip install ai-service-platform[async]``).
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Registers the client if the app uses the asyncio engine"""
+        if app.config.get("DISPATCHER_ENGINE", "threads") != "asyncio":
+            return
+        if httpx is None:
+            raise RuntimeError("The asyncio engine requires the httpx package")
+
+        app.extensions["async_model_client"] = _AsyncClientState(app)
+
+    def _get_state(self) -> _AsyncClientState:
+        return current_app.extensions["async_model_client"]
+
+    async def predict(
+        self, model_key: str, input_paths: list[str], deadline: float | None = None
+    ) -> list[Any]:
+        """Runs the model on the given input files
+
+        See :meth:`ModelServerClient.predict` for the protocol and errors. The
+        dispatcher aborts the call of a cancelled batch by cancelling its task.
+        """
+        state = self._get_state()
+        call = PredictionCall(state, model_key, input_paths, deadline)
+        if state.client is None:
+            state.client = httpx.AsyncClient(limits=state.limits)
+
+        body = InputBody(input_paths, state.chunk_size)
+        for delay in call.attempts():
+            await asyncio.sleep(delay)
+            if not call.start():
+                continue
+            connect, read = call.timeout
+            try:
+                response = await state.client.post(
+                    f"{call.endpoint.url}/predictions/{model_key}",
+                    content=body.aiter_chunks(),
+                    headers=body.headers,
+                    timeout=httpx.Timeout(read, connect=connect),
+                )
+                call.answered(response.status_code)
+            except httpx.TransportError as e:
+                call.unreachable(e, timed_out=isinstance(e, httpx.TimeoutException))
+                continue
+            finally:
+                call.release()
+            if call.retry(response.status_code):
+                continue
+            return call.output(response)
+        raise call.give_up()
+
+    def stats(self) -> dict:
+        """Returns call counters and the models with an open circuit"""
+        return self._get_state().stats()
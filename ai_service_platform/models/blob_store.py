@@ -0,0 +1,275 @@
+"""Deduplicated storage of uploaded input files
+
+Files are stored once per content under their SHA-256 hash in a sharded directory
+layout below the ``UPLOAD_FOLDER``, e.g. ``ab/cd/abcd1234....jpg``. The ``blob``
+table counts the requests referencing a file. Deleting a request releases its
+blob, and the file is removed once the last reference is gone.
+
+A reference is always added before the file is written or reused, and a file is
+only removed together with a blob row that still has no reference, in the same
+transaction. So an upload that reuses a file either keeps it from being removed
+or waits until it is gone and writes it again.
+"""
+
+import glob
+import os
+import shutil
+import tempfile
+from typing import IO
+
+from flask import Flask, current_app
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import db, thumbnails
+from .models import Blob, Request
+from .result_cache import hash_file
+
+# Insert statements with ON CONFLICT support, by dialect name
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default blob store configuration and creates its folders"""
+    # Number of two character directory levels above the files
+    app.config.setdefault("BLOB_STORE_SHARD_DEPTH", 2)
+    # Inside the upload folder, so finished files can be renamed into place
+    os.makedirs(os.path.join(app.config["UPLOAD_FOLDER"], ".tmp"), exist_ok=True)
+
+
+def temp_folder() -> str:
+    """Returns the folder for files that are not moved into the store yet"""
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], ".tmp")
+
+
+def blob_path(input_hash: str, extension: str) -> str:
+    """Returns the path of a blob relative to the ``UPLOAD_FOLDER``
+
+    Args:
+        input_hash: The hex SHA-256 digest of the file
+        extension: The file extension including the leading dot
+    """
+    depth = current_app.config["BLOB_STORE_SHARD_DEPTH"]
+    shards = [input_hash[2 * level : 2 * level + 2] for level in range(depth)]
+    return "/".join([*shards, input_hash + extension])
+
+
+def absolute_path(path: str) -> str:
+    """Returns the absolute location of a path relative to the ``UPLOAD_FOLDER``"""
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], *path.split("/"))
+
+
+def put(file: IO[bytes], input_hash: str, extension: str) -> str:
+    """Stores a file unless its content is already stored and adds a reference
+
+    The reference is added to the current session and takes effect when it is
+    committed together with the request using the blob.
+
+    Args:
+        file: The binary file, read from its current position
+        input_hash: The hex SHA-256 digest of the file
+        extension: The file extension including the leading dot
+
+    Returns:
+        The path of the blob relative to the ``UPLOAD_FOLDER``
+    """
+    # Write to a temporary file first, so no one can see a partial blob
+    with tempfile.NamedTemporaryFile(dir=temp_folder(), delete=False) as temp:
+        shutil.copyfileobj(file, temp)
+    try:
+        return put_temporary(temp.name, input_hash, extension)
+    finally:
+        if os.path.exists(temp.name):
+            os.remove(temp.name)
+
+
+def put_temporary(temp_path: str, input_hash: str, extension: str) -> str:
+    """Moves a complete file from the :func:`temp_folder` into the store
+
+    Works like :func:`put` without copying the file. If the content is already
+    stored, the temporary file is left for the caller to remove.
+
+    Args:
+        temp_path: Path of the temporary file
+        input_hash: The hex SHA-256 digest of the file
+        extension: The file extension including the leading dot
+
+    Returns:
+        The path of the blob relative to the ``UPLOAD_FOLDER``
+    """
+    return put_temporary_many([(temp_path, input_hash, extension)])[0]
+
+
+def put_temporary_many(files: list[tuple[str, str, str]]) -> list[str]:
+    """Moves many complete files from the :func:`temp_folder` into the store
+
+    Works like :func:`put_temporary` with one query for the stored files and one
+    statement for all references.
+
+    Args:
+        files: The path of the temporary file, the hex SHA-256 digest and the
+            extension of each file
+
+    Returns:
+        The paths of the blobs relative to the ``UPLOAD_FOLDER``, in order
+    """
+    hashes = {input_hash for _, input_hash, _ in files}
+    stored = dict(
+        db.session.execute(
+            select(Blob.hash, Blob.path).where(Blob.hash.in_(hashes))
+        ).all()
+    )
+
+    paths = []
+    references: dict[str, tuple[str, int, int]] = {}
+    for temp_path, input_hash, extension in files:
+        path = stored.setdefault(input_hash, blob_path(input_hash, extension))
+        if input_hash in references:
+            _, size, count = references[input_hash]
+            references[input_hash] = (path, size, count + 1)
+        else:
+            references[input_hash] = (path, os.path.getsize(temp_path), 1)
+        paths.append(path)
+
+    # Held from here on, so the files are not removed while they are placed
+    _add_references(references)
+    for temp_path, input_hash, _ in files:
+        target = absolute_path(stored[input_hash])
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(temp_path, target)
+    return paths
+
+
+def _add_references(references: dict[str, tuple[str, int, int]]) -> None:
+    """Adds references to blobs, given as path, size and count by hash"""
+    dialect = db.session.get_bind().dialect.name
+    insert = _UPSERT_INSERTS.get(dialect)
+    if insert is None:
+        # Without upserts concurrent first uploads of a file may conflict
+        for input_hash, (path, size, count) in references.items():
+            result = db.session.execute(
+                update(Blob)
+                .where(Blob.hash == input_hash)
+                .values(ref_count=Blob.ref_count + count)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 0:
+                db.session.add(
+                    Blob(hash=input_hash, path=path, size=size, ref_count=count)
+                )
+        return
+
+    statement = insert(Blob)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Blob.hash],
+            set_={"ref_count": Blob.ref_count + statement.excluded.ref_count},
+        ),
+        [
+            {"hash": input_hash, "path": path, "size": size, "ref_count": count}
+            for input_hash, (path, size, count) in references.items()
+        ],
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _release_deleted_requests(session, flush_context, instances):
+    hashes = [
+        obj.input_hash
+        for obj in session.deleted
+        if isinstance(obj, Request) and obj.input_hash is not None
+    ]
+    if not hashes:
+        return
+
+    for input_hash in hashes:
+        session.execute(
+            update(Blob)
+            .where(Blob.hash == input_hash)
+            .values(ref_count=Blob.ref_count - 1)
+            .execution_options(synchronize_session=False)
+        )
+    session.info.setdefault("released_blobs", set()).update(hashes)
+
+
+@event.listens_for(Session, "after_commit")
+def _remove_unused_blobs(session):
+    hashes = session.info.pop("released_blobs", None)
+    if not hashes:
+        return
+
+    # The session cannot run statements anymore, the blobs are removed in a
+    # transaction of their own that is committed after their files are gone
+    with session.get_bind().begin() as connection:
+        paths = connection.scalars(
+            delete(Blob)
+            .where(Blob.hash.in_(hashes), Blob.ref_count <= 0)
+            .returning(Blob.path)
+        ).all()
+        for path in paths:
+            _remove_files(absolute_path(path))
+            thumbnails.remove(path)
+
+
+def _remove_files(path: str) -> None:
+    # Files derived from a blob share its name up to the first dot
+    folder, name = os.path.split(path)
+    stem = name.split(".", 1)[0]
+    for derived in [path, *glob.glob(os.path.join(folder, stem + ".*"))]:
+        try:
+            os.remove(derived)
+        except FileNotFoundError:
+            pass
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _keep_unused_blobs(session, previous_transaction):
+    session.info.pop("released_blobs", None)
+
+
+def migrate_uploads(chunk_size: int = 100) -> tuple[int, list[str]]:
+    """Moves uploads of the flat ``{uuid}_{filename}`` layout into the blob store
+
+    Requests are updated in chunks, each committed before its old files are
+    removed. Running it again continues where an interrupted run stopped.
+
+    Args:
+        chunk_size: Number of requests per transaction
+
+    Returns:
+        The number of migrated requests and the input files that were missing
+    """
+    # Blob paths always contain a directory, old uploads never do
+    request_ids = db.session.scalars(
+        select(Request.public_id).where(~Request.input_file.contains("/"))
+    ).all()
+
+    migrated = 0
+    missing = []
+    for start in range(0, len(request_ids), chunk_size):
+        chunk = request_ids[start : start + chunk_size]
+        old_paths = []
+        for request in db.session.scalars(
+            select(Request).where(Request.public_id.in_(chunk))
+        ):
+            old_path = absolute_path(request.input_file)
+            if not os.path.exists(old_path):
+                missing.append(request.input_file)
+                continue
+
+            with open(old_path, "rb") as file:
+                input_hash = hash_file(file)
+                file.seek(0)
+                extension = os.path.splitext(request.input_file)[1].lower()
+                request.input_file = put(file, input_hash, extension)
+            request.input_hash = input_hash
+            old_paths.append(old_path)
+
+        db.session.commit()
+        for old_path in old_paths:
+            os.remove(old_path)
+        migrated += len(old_paths)
+
+    return migrated, missing
@@ -0,0 +1,86 @@
+"""Cooperative cancellation of running jobs
+
+The dispatcher runs every batch with its own :class:`CancelToken` as the current
+token of the worker thread or task. Once all requests of a batch are paused or
+deleted, the token is cancelled. Code that waits for a long time checks the
+current token, and the model clients register a callback on it that aborts the
+call in flight, so the worker is free for other jobs right away.
+"""
+
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class Cancelled(Exception):
+    """Raised when the requests of a running batch were paused or deleted"""
+
+
+class CancelToken:
+    """Tells a running batch to stop and runs the callbacks that abort its work"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """Cancels the token and runs its callbacks, only the first time"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Registers a callback, which runs right away if already cancelled
+
+        Returns:
+            A function that unregisters the callback
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self) -> None:
+        """Raises :class:`Cancelled` if the token was cancelled"""
+        if self._event.is_set():
+            raise Cancelled()
+
+    def sleep(self, seconds: float) -> None:
+        """Sleeps, but raises :class:`Cancelled` as soon as the token is cancelled"""
+        if self._event.wait(seconds):
+            raise Cancelled()
+
+
+_current: ContextVar[CancelToken | None] = ContextVar("cancel_token", default=None)
+
+
+def current() -> CancelToken:
+    """Returns the token of the running batch, one that is never cancelled outside"""
+    return _current.get() or CancelToken()
+
+
+@contextmanager
+def scope(token: CancelToken) -> Iterator[CancelToken]:
+    """Makes the token the current one of the thread or task"""
+    previous = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(previous)
@@ -0,0 +1,155 @@
+"""Deadlines of requests and shedding of the requests that cannot meet them
+
+A request may carry a deadline, the time after which nobody waits for its output.
+It is set when the request is queued from the ``timeout`` its submitter asked for
+and the ``request_timeout`` of its model, or ``REQUEST_TIMEOUT`` if the model has
+none, whichever ends first. Requests that cannot meet their deadline are failed
+instead of being sent to the model server:
+
+- Pending requests whose deadline passed, when workers claim new jobs
+- Requests of a batch that is about to be sent, if less time is left than the
+  model server took for recent calls, see :func:`.model_registry.expected_latency`
+- Requests of a call that did not answer before the latest deadline of its batch,
+  which bounds the timeouts of the call
+
+The number of shed requests per stage and model is reported by :func:`stats`.
+"""
+
+import threading
+from collections import defaultdict
+from datetime import UTC, datetime, timedelta
+
+from flask import Flask, current_app
+from sqlalchemy import select, update
+
+from . import db, model_registry, status_events
+from .models import Model, Request, RequestStatus, utcnow
+from .status_events import StatusEvent
+
+# Stages at which requests are shed
+QUEUED = "queued"
+DISPATCHED = "dispatched"
+TIMED_OUT = "timed_out"
+
+
+class _DeadlineState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shed: dict[str, int] = dict.fromkeys((QUEUED, DISPATCHED, TIMED_OUT), 0)
+        self.shed_per_model: dict[str, int] = defaultdict(int)
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default deadline configuration of the app"""
+    # Seconds requests of models without a request_timeout may take, None for
+    # no deadline
+    app.config.setdefault("REQUEST_TIMEOUT", None)
+
+    app.extensions["deadlines"] = _DeadlineState()
+
+
+def _get_state() -> _DeadlineState:
+    return current_app.extensions["deadlines"]
+
+
+def deadline(model: Model, timeout: float | None = None) -> datetime | None:
+    """Returns the deadline of a request for a model that is queued now
+
+    Args:
+        model: The requested model
+        timeout: The seconds the submitter is willing to wait, if given
+
+    Returns:
+        The deadline as naive UTC time, None if the request may take any time
+    """
+    limit = model.request_timeout
+    if limit is None:
+        limit = current_app.config["REQUEST_TIMEOUT"]
+    timeouts = [t for t in (timeout, limit) if t is not None]
+    if not timeouts:
+        return None
+    return utcnow() + timedelta(seconds=min(timeouts))
+
+
+def timestamp(deadline: datetime) -> float:
+    """Returns a deadline of the database as seconds since the epoch"""
+    return deadline.replace(tzinfo=UTC).timestamp()
+
+
+def shed_queued() -> int:
+    """Fails the pending requests whose deadline passed
+
+    Returns:
+        The number of failed requests
+    """
+    shed = db.session.execute(
+        update(Request)
+        .where(Request.status == RequestStatus.PENDING, Request.deadline < utcnow())
+        .values(status=RequestStatus.FAILED, lease_expires_at=None)
+        .returning(Request.public_id, Request.user_id, Request.model_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    if not shed:
+        return 0
+
+    model_keys = dict(
+        db.session.execute(
+            select(Model.public_id, Model.server_model_name).where(
+                Model.public_id.in_({row.model_id for row in shed})
+            )
+        ).all()
+    )
+    counts: dict[str, int] = defaultdict(int)
+    for row in shed:
+        counts[model_keys[row.model_id]] += 1
+    for model_key, count in counts.items():
+        record(QUEUED, model_key, count)
+    status_events.publish(
+        [StatusEvent(row.user_id, row.public_id, RequestStatus.FAILED) for row in shed]
+    )
+    return len(shed)
+
+
+def shed_late(requests: list[Request], model_key: str) -> list[Request]:
+    """Picks the requests of a batch that cannot be answered before their deadline
+
+    The caller has to fail them, they are counted as shed here.
+
+    Args:
+        requests: The requests that are about to be sent to the model server
+        model_key: The server_model_name of their model
+
+    Returns:
+        The requests with less time left than a call to the model takes
+    """
+    latency = timedelta(seconds=model_registry.expected_latency(model_key))
+    cutoff = utcnow() + latency
+    late = [r for r in requests if r.deadline is not None and r.deadline < cutoff]
+    if late:
+        record(DISPATCHED, model_key, len(late))
+    return late
+
+
+def record(stage: str, model_key: str, count: int) -> None:
+    """Counts requests that were shed
+
+    Args:
+        stage: One of ``QUEUED``, ``DISPATCHED`` and ``TIMED_OUT``
+        model_key: The server_model_name of their model
+        count: The number of requests
+    """
+    state = _get_state()
+    with state.lock:
+        state.shed[stage] += count
+        state.shed_per_model[model_key] += count
+
+
+def stats() -> dict:
+    """Returns the number of shed requests per stage and per model"""
+    state = _get_state()
+    with state.lock:
+        return {
+            "shed": dict(state.shed),
+            "shed_per_model": dict(state.shed_per_model),
+        }
@@ -0,0 +1,597 @@
+import asyncio
+import heapq
+import itertools
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable, Hashable, Iterator
+from dataclasses import dataclass, field
+
+from flask import Flask, current_app
+
+from .cancellation import Cancelled, CancelToken, scope
+
+
+@dataclass
+class Job:
+    """A queued inference job"""
+
+    request_id: uuid.UUID
+    model_key: str
+    enqueued_at: float = field(default_factory=time.time)
+    # Jobs with lower values are served first
+    priority: int = 0
+    # Jobs of one tenant, e.g. a user or source, share its weight
+    tenant: Hashable = None
+    weight: float = 1.0
+
+
+class _FairQueue:
+    """Queued jobs of one model, by priority and fair between tenants
+
+    Jobs of the lowest priority go first. Within a priority, tenants take turns by
+    self-clocked weighted fair queuing: a job is tagged with the tag of its
+    tenant's previous job, or the tag of the job served last if the tenant was
+    idle, plus ``1 / weight``, and the job with the smallest tag goes next. A
+    tenant with twice the weight gets twice the share of a busy model, and one
+    with a long backlog cannot delay a tenant that just arrived.
+    """
+
+    def __init__(self):
+        self.heaps: dict[int, list[tuple[float, int, Job]]] = {}
+        self.virtual_time: dict[int, float] = defaultdict(float)
+        self.tags: dict[tuple[int, Hashable], float] = {}
+        self.order = itertools.count()
+        self.size = 0
+
+    def append(self, job: Job) -> None:
+        key = (job.priority, job.tenant)
+        start = max(self.virtual_time[job.priority], self.tags.get(key, 0.0))
+        tag = self.tags[key] = start + 1 / job.weight
+        heap = self.heaps.setdefault(job.priority, [])
+        heapq.heappush(heap, (tag, next(self.order), job))
+        self.size += 1
+
+    def popleft(self) -> Job:
+        priority = min(priority for priority, heap in self.heaps.items() if heap)
+        heap = self.heaps[priority]
+        tag, _, job = heapq.heappop(heap)
+        self.virtual_time[priority] = tag
+        if not heap:
+            # All tenants of the priority are idle, their turns start over
+            del self.heaps[priority], self.virtual_time[priority]
+            self.tags = {
+                key: tag for key, tag in self.tags.items() if key[0] != priority
+            }
+        self.size -= 1
+        return job
+
+    def remove(self, request_ids: set[uuid.UUID]) -> list[Job]:
+        """Removes the jobs of the requests and returns them"""
+        removed = []
+        for priority, heap in self.heaps.items():
+            kept = []
+            for entry in heap:
+                if entry[2].request_id in request_ids:
+                    removed.append(entry[2])
+                else:
+                    kept.append(entry)
+            if len(kept) < len(heap):
+                heapq.heapify(kept)
+                self.heaps[priority] = kept
+        self.size -= len(removed)
+        return removed
+
+    def __iter__(self) -> Iterator[Job]:
+        for heap in self.heaps.values():
+            for _, _, job in heap:
+                yield job
+
+    def __len__(self) -> int:
+        return self.size
+
+
+@dataclass
+class _Batch:
+    """Jobs of one model handled together and the token that cancels them"""
+
+    model_key: str
+    jobs: list[Job] = field(default_factory=list)
+    token: CancelToken = field(default_factory=CancelToken)
+
+
+class _DispatcherState:
+    """Per app queue, worker threads and metrics of the dispatcher"""
+
+    def __init__(
+        self,
+        app: Flask,
+        handler: Callable[[list[uuid.UUID]], None],
+        claim: Callable[[int], list[Job]] | None,
+        async_handler: Callable[[list[uuid.UUID]], Awaitable[None]] | None,
+        abandoned: Callable[[list[uuid.UUID]], list[uuid.UUID]] | None,
+    ):
+        self.app = app
+        self.handler = handler
+        self.claim = claim
+        self.async_handler = async_handler
+        self.abandoned = abandoned
+        self.engine: str = app.config["DISPATCHER_ENGINE"]
+        self.num_workers: int = app.config["DISPATCHER_WORKERS"]
+        self.prefetch: int = app.config["DISPATCHER_PREFETCH"]
+        self.batch_size: int = app.config["DISPATCHER_BATCH_SIZE"]
+        self.batch_wait: float = app.config["DISPATCHER_BATCH_WAIT"]
+        self.poll_interval: float = app.config["DISPATCHER_POLL_INTERVAL"]
+        self.model_concurrency: int = app.config["DISPATCHER_MODEL_CONCURRENCY"]
+        self.model_limits: dict[str, int] = app.config["DISPATCHER_MODEL_LIMITS"]
+
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.pending: dict[str, _FairQueue] = {}
+        self.running: dict[str, int] = defaultdict(int)
+        # Batches by the request ids of their jobs that were not cancelled
+        self.batches_by_request: dict[uuid.UUID, _Batch] = {}
+        self.depth = 0
+        self.active = 0
+        self.started = False
+        self.stopping = False
+        self.threads: list[threading.Thread] = []
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_wakeup: asyncio.Event | None = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.batches = 0
+        self.wait_times: deque[float] = deque(maxlen=1000)
+        self.priority_wait_times: dict[int, deque[float]] = defaultdict(
+            lambda: deque(maxlen=1000)
+        )
+
+    def limit(self, model_key: str) -> int:
+        return self.model_limits.get(model_key, self.model_concurrency)
+
+
+class Dispatcher:
+    """Runs inference jobs on a fixed size pool of worker threads
+
+    Jobs wait in a queue in memory, which the feeder keeps at
+    ``DISPATCHER_PREFETCH`` jobs. Uploads are admitted by the number of pending
+    requests instead, see :func:`.job_queue.queue_full`. Each model (keyed on ``Model.server_model_name``) may only occupy a
+    limited number of workers at the same time. The jobs of a model are served by
+    priority and weighted fair between tenants, see :class:`_FairQueue`.
+
+    Workers take up to ``DISPATCHER_BATCH_SIZE`` jobs of the same model at once.
+    If fewer are queued, they wait up to ``DISPATCHER_BATCH_WAIT`` seconds for
+    more jobs of that model before handing the batch to the handler.
+
+    If a ``claim`` function is given, a feeder thread keeps the local queue
+    filled with jobs claimed from a durable queue, so jobs survive restarts and
+    can be shared between several worker processes.
+
+    With ``DISPATCHER_ENGINE = "asyncio"`` the batches are run as tasks of a single
+    event loop by ``async_handler`` instead of on worker threads. Then
+    ``DISPATCHER_WORKERS`` limits the number of batches in flight, which can be
+    much higher than a sensible number of threads.
+
+    Jobs can be cancelled, e.g. because their requests were paused or deleted.
+    Queued jobs are dropped. A running batch is only told to stop once all of its
+    jobs are cancelled, see :mod:`.cancellation`. If an ``abandoned`` function is
+    given, the feeder also asks it for jobs that were paused or deleted by other
+    processes every ``DISPATCHER_POLL_INTERVAL`` seconds.
+    """
+
+    def init_app(
+        self,
+        app: Flask,
+        handler: Callable[[list[uuid.UUID]], None],
+        claim: Callable[[int], list[Job]] | None = None,
+        async_handler: Callable[[list[uuid.UUID]], Awaitable[None]] | None = None,
+        abandoned: Callable[[list[uuid.UUID]], list[uuid.UUID]] | None = None,
+    ) -> None:
+        """Registers the dispatcher on the app
+
+        The workers are started right away unless ``DISPATCHER_EMBEDDED`` is
+        disabled, e.g. because they run in a separate ``flask worker`` process.
+
+        Args:
+            app: The flask app
+            handler: Called with the request ids of each batch inside an app context
+            claim: Called with a maximum number of jobs to take from a durable
+                queue inside an app context
+            async_handler: Coroutine function used instead of ``handler`` by the
+                asyncio engine. It runs in an app context shared by all tasks.
+            abandoned: Called with the request ids of the queued and running jobs
+                inside an app context, returns those that should be cancelled
+        """
+        app.config.setdefault("DISPATCHER_EMBEDDED", True)
+        app.config.setdefault("DISPATCHER_ENGINE", "threads")
+        app.config.setdefault("DISPATCHER_WORKERS", 4)
+        # Pending requests above which uploads are answered with 429
+        app.config.setdefault("DISPATCHER_QUEUE_SIZE", 100)
+        app.config.setdefault("DISPATCHER_BATCH_SIZE", 1)
+        app.config.setdefault("DISPATCHER_BATCH_WAIT", 0.02)
+        app.config.setdefault(
+            "DISPATCHER_PREFETCH",
+            app.config["DISPATCHER_WORKERS"] * app.config["DISPATCHER_BATCH_SIZE"],
+        )
+        app.config.setdefault("DISPATCHER_POLL_INTERVAL", 1.0)
+        app.config.setdefault("DISPATCHER_MODEL_CONCURRENCY", 2)
+        app.config.setdefault("DISPATCHER_MODEL_LIMITS", {})
+
+        app.extensions["dispatcher"] = _DispatcherState(
+            app, handler, claim, async_handler, abandoned
+        )
+
+        if app.config["DISPATCHER_EMBEDDED"]:
+            with app.app_context():
+                self.start()
+
+    def _get_state(self) -> _DispatcherState:
+        return current_app.extensions["dispatcher"]
+
+    def start(self) -> None:
+        """Starts the worker threads of the current app if not running yet"""
+        state = self._get_state()
+        with state.cond:
+            if state.started:
+                return
+            state.started = True
+
+        if state.engine == "asyncio":
+            self._spawn(state, self._run_event_loop, "dispatcher-event-loop")
+        else:
+            for i in range(state.num_workers):
+                self._spawn(state, self._work, f"dispatcher-worker-{i}")
+        if state.claim is not None:
+            self._spawn(state, self._feed, "dispatcher-feeder")
+
+    def _spawn(self, state: _DispatcherState, target, name: str) -> None:
+        thread = threading.Thread(target=target, args=(state,), name=name, daemon=True)
+        thread.start()
+        state.threads.append(thread)
+
+    def wake(self) -> None:
+        """Tells the feeder to look for new jobs in the durable queue"""
+        self._get_state().wakeup.set()
+
+    def submit(self, request_id: uuid.UUID, model_key: str) -> None:
+        """Adds a job to the queue of the current app, bypassing the durable queue
+
+        Args:
+            request_id: The public_id of the request to process
+            model_key: The server_model_name of the requested model
+        """
+        state = self._get_state()
+        job = Job(request_id, model_key)
+        with state.cond:
+            state.pending.setdefault(job.model_key, _FairQueue()).append(job)
+            state.depth += 1
+            state.submitted += 1
+            self._notify(state)
+
+    def cancel(self, request_ids: list[uuid.UUID]) -> int:
+        """Cancels the jobs of requests in the current app
+
+        Queued jobs are removed from the queue. Running batches whose jobs are all
+        cancelled get their token cancelled, which aborts their model server call.
+
+        Args:
+            request_ids: The public_ids of the requests
+
+        Returns:
+            The number of jobs that were queued or running
+        """
+        return self._cancel(self._get_state(), request_ids)
+
+    def _cancel(self, state: _DispatcherState, request_ids: list[uuid.UUID]) -> int:
+        request_ids = set(request_ids)
+        stopped = []
+        with state.cond:
+            removed = 0
+            for jobs in state.pending.values():
+                removed += len(jobs.remove(request_ids))
+            state.depth -= removed
+
+            batches = []
+            for request_id in request_ids:
+                batch = state.batches_by_request.pop(request_id, None)
+                if batch is not None:
+                    batches.append(batch)
+            for batch in batches:
+                if not any(
+                    job.request_id in state.batches_by_request for job in batch.jobs
+                ):
+                    stopped.append(batch.token)
+            state.cancelled += removed + len(batches)
+            self._notify(state)
+
+        # Outside of the lock, the callbacks may close connections
+        for token in stopped:
+            token.cancel()
+        return removed + len(batches)
+
+    def stats(self) -> dict:
+        """Returns queue depth, wait time and throughput counters"""
+        state = self._get_state()
+        with state.cond:
+            waits = sorted(state.wait_times)
+            return {
+                "engine": state.engine,
+                "workers": state.num_workers,
+                "queue_depth": state.depth,
+                "queue_depth_per_model": {
+                    key: len(jobs) for key, jobs in state.pending.items() if jobs
+                },
+                "running_per_model": {
+                    key: count for key, count in state.running.items() if count
+                },
+                "submitted": state.submitted,
+                "completed": state.completed,
+                "failed": state.failed,
+                "cancelled": state.cancelled,
+                "batches": state.batches,
+                "batch_size_mean": (state.completed + state.failed) / state.batches
+                if state.batches
+                else 0.0,
+                "wait_time_mean": statistics.fmean(waits) if waits else 0.0,
+                "wait_time_p50": _percentile(waits, 0.50),
+                "wait_time_p99": _percentile(waits, 0.99),
+                "wait_time_max": waits[-1] if waits else 0.0,
+                "wait_time_per_priority": {
+                    priority: _wait_stats(sorted(waits))
+                    for priority, waits in sorted(state.priority_wait_times.items())
+                },
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the workers of the current app after their current job"""
+        state = self._get_state()
+        with state.cond:
+            state.stopping = True
+            self._notify(state)
+        state.wakeup.set()
+        if wait:
+            for thread in state.threads:
+                thread.join()
+
+    def _notify(self, state: _DispatcherState) -> None:
+        """Wakes up waiting workers, must be called with the lock held"""
+        state.cond.notify_all()
+        if state.loop is not None:
+            try:
+                state.loop.call_soon_threadsafe(state.loop_wakeup.set)
+            except RuntimeError:
+                # The event loop already stopped
+                pass
+
+    def _feed(self, state: _DispatcherState) -> None:
+        """Claims jobs from the durable queue whenever workers run idle"""
+        next_check = time.monotonic() + state.poll_interval
+        while not state.stopping:
+            with state.cond:
+                busy = state.depth + state.active
+            free = state.num_workers + state.prefetch - busy
+
+            jobs = []
+            if free > 0:
+                try:
+                    with state.app.app_context():
+                        jobs = state.claim(free)
+                except Exception:
+                    state.app.logger.exception("Failed to claim jobs")
+
+                with state.cond:
+                    for job in jobs:
+                        queue = state.pending.setdefault(job.model_key, _FairQueue())
+                        queue.append(job)
+                    state.depth += len(jobs)
+                    state.submitted += len(jobs)
+                    self._notify(state)
+
+            # Keep claiming while the durable queue has more work than we took
+            if free > 0 and len(jobs) == free:
+                continue
+            state.wakeup.wait(state.poll_interval)
+            state.wakeup.clear()
+
+            if state.abandoned is not None and time.monotonic() >= next_check:
+                next_check = time.monotonic() + state.poll_interval
+                self._cancel_abandoned(state)
+
+    def _cancel_abandoned(self, state: _DispatcherState) -> None:
+        """Cancels the queued and running jobs that ``abandoned`` returns"""
+        with state.cond:
+            request_ids = list(state.batches_by_request)
+            for jobs in state.pending.values():
+                request_ids.extend(job.request_id for job in jobs)
+        if not request_ids:
+            return
+
+        try:
+            with state.app.app_context():
+                abandoned = state.abandoned(request_ids)
+        except Exception:
+            state.app.logger.exception("Failed to check for abandoned jobs")
+            return
+        if abandoned:
+            self._cancel(state, abandoned)
+
+    def _next_model(self, state: _DispatcherState) -> str | None:
+        """Returns the first model with queued jobs that is below its limit"""
+        for model_key, jobs in state.pending.items():
+            if jobs and state.running[model_key] < state.limit(model_key):
+                return model_key
+        return None
+
+    def _start_batch(self, state: _DispatcherState, model_key: str) -> _Batch:
+        state.running[model_key] += 1
+        batch = _Batch(model_key)
+        self._pop(state, batch, state.batch_size)
+
+        # Move the model to the back so models take turns
+        jobs = state.pending.pop(model_key)
+        if jobs:
+            state.pending[model_key] = jobs
+        return batch
+
+    def _pop(self, state: _DispatcherState, batch: _Batch, count: int) -> None:
+        """Moves up to ``count`` queued jobs of the model of a batch into it"""
+        jobs = state.pending.get(batch.model_key)
+        popped = []
+        while jobs and len(popped) < count:
+            popped.append(jobs.popleft())
+        state.depth -= len(popped)
+        state.active += len(popped)
+
+        now = time.time()
+        for job in popped:
+            state.batches_by_request[job.request_id] = batch
+            state.wait_times.append(now - job.enqueued_at)
+            state.priority_wait_times[job.priority].append(now - job.enqueued_at)
+        batch.jobs += popped
+
+    def _request_ids(self, state: _DispatcherState, batch: _Batch) -> list[uuid.UUID]:
+        """Returns the request ids of the jobs of a batch that were not cancelled"""
+        with state.cond:
+            return [
+                job.request_id
+                for job in batch.jobs
+                if job.request_id in state.batches_by_request
+            ]
+
+    def _finish_batch(self, state: _DispatcherState, batch: _Batch, failed: bool):
+        with state.cond:
+            # Cancelled jobs were counted when they were cancelled
+            finished = 0
+            for job in batch.jobs:
+                if state.batches_by_request.pop(job.request_id, None) is not None:
+                    finished += 1
+            state.running[batch.model_key] -= 1
+            state.active -= len(batch.jobs)
+            state.batches += 1
+            if failed:
+                state.failed += finished
+            else:
+                state.completed += finished
+            self._notify(state)
+        state.wakeup.set()
+
+    def _handle(self, state: _DispatcherState, batch: _Batch) -> None:
+        request_ids = self._request_ids(state, batch)
+        failed = False
+        if request_ids:
+            try:
+                with state.app.app_context(), scope(batch.token):
+                    state.handler(request_ids)
+            except Cancelled:
+                pass
+            except Exception:
+                state.app.logger.exception("Failed to process requests %s", request_ids)
+                failed = True
+        self._finish_batch(state, batch, failed)
+
+    def _take(self, state: _DispatcherState) -> _Batch | None:
+        """Blocks until jobs of a model below its concurrency limit are queued"""
+        with state.cond:
+            while not state.stopping:
+                model_key = self._next_model(state)
+                if model_key is None:
+                    state.cond.wait()
+                    continue
+
+                batch = self._start_batch(state, model_key)
+                deadline = time.monotonic() + state.batch_wait
+                while len(batch.jobs) < state.batch_size and not state.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    state.cond.wait(remaining)
+                    self._pop(state, batch, state.batch_size - len(batch.jobs))
+                return batch
+            return None
+
+    def _work(self, state: _DispatcherState) -> None:
+        while (batch := self._take(state)) is not None:
+            self._handle(state, batch)
+
+    def _run_event_loop(self, state: _DispatcherState) -> None:
+        # Tasks share this app context. The handler has to push its own context
+        # for database work, because tearing it down inside the loop is not
+        # possible.
+        with state.app.app_context():
+            asyncio.run(self._pump(state))
+
+    async def _pump(self, state: _DispatcherState) -> None:
+        """Starts a task per batch while fewer than ``num_workers`` are in flight"""
+        state.loop_wakeup = asyncio.Event()
+        state.loop = asyncio.get_running_loop()
+        tasks: set[asyncio.Task] = set()
+
+        while True:
+            state.loop_wakeup.clear()
+            with state.cond:
+                if state.stopping:
+                    break
+                model_key = None
+                if sum(state.running.values()) < state.num_workers:
+                    model_key = self._next_model(state)
+                batch = self._start_batch(state, model_key) if model_key else None
+
+            if batch is None:
+                await state.loop_wakeup.wait()
+                continue
+
+            task = asyncio.create_task(self._run_batch(state, batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+
+    async def _run_batch(self, state: _DispatcherState, batch: _Batch) -> None:
+        # Cancelling the task aborts whatever the batch is waiting for
+        task = asyncio.current_task()
+        unregister = batch.token.on_cancel(
+            lambda: state.loop.call_soon_threadsafe(task.cancel)
+        )
+        failed = False
+        try:
+            if len(batch.jobs) < state.batch_size and state.batch_wait > 0:
+                await asyncio.sleep(state.batch_wait)
+                with state.cond:
+                    self._pop(state, batch, state.batch_size - len(batch.jobs))
+
+            request_ids = self._request_ids(state, batch)
+            if request_ids:
+                with scope(batch.token):
+                    await state.async_handler(request_ids)
+        except Cancelled:
+            pass
+        except asyncio.CancelledError:
+            if not batch.token.cancelled:
+                raise
+        except Exception:
+            state.app.logger.exception(
+                "Failed to process requests %s", self._request_ids(state, batch)
+            )
+            failed = True
+        finally:
+            unregister()
+            self._finish_batch(state, batch, failed)
+
+
+def _wait_stats(waits: list[float]) -> dict:
+    return {
+        "count": len(waits),
+        "p50": _percentile(waits, 0.50),
+        "p99": _percentile(waits, 0.99),
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
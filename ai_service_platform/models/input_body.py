@@ -0,0 +1,92 @@
+"""Streamed request bodies for calls to the model server
+
+Input files are memory mapped and sent in slices of the mapping, so their content
+is never copied into Python objects. Only the socket copies the mapped pages into
+the kernel. A body can be iterated any number of times, which lets the clients
+retry a call without reading the inputs into memory.
+"""
+
+import mmap
+import os
+import uuid
+from collections.abc import AsyncIterator, Iterator
+
+
+class InputBody:
+    """Body of a prediction call for one or several input files
+
+    A single input is sent as is. Several inputs are sent as a multipart body with
+    a ``data`` field per input. The length is known from the file sizes, so the
+    body is framed with ``Content-Length`` even though it is sent in chunks.
+
+    Args:
+        input_paths: Paths of the input files
+        chunk_size: Number of bytes sent at once
+    """
+
+    def __init__(self, input_paths: list[str], chunk_size: int = 256 * 1024):
+        self.chunk_size = chunk_size
+        # Literal bytes of the multipart framing and paths of the files between
+        self._parts: list[bytes | str] = []
+
+        if len(input_paths) == 1:
+            self.content_type = "application/octet-stream"
+            self._parts.append(input_paths[0])
+        else:
+            boundary = uuid.uuid4().hex
+            self.content_type = f"multipart/form-data; boundary={boundary}"
+            for path in input_paths:
+                filename = os.path.basename(path)
+                self._parts.append(
+                    f"--{boundary}\r\n"
+                    f'Content-Disposition: form-data; name="data"; '
+                    f'filename="{filename}"\r\n'
+                    f"Content-Type: application/octet-stream\r\n\r\n".encode()
+                )
+                self._parts.append(path)
+                self._parts.append(b"\r\n")
+            self._parts.append(f"--{boundary}--\r\n".encode())
+
+        self.length = sum(
+            len(part) if isinstance(part, bytes) else os.path.getsize(part)
+            for part in self._parts
+        )
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"Content-Type": self.content_type, "Content-Length": str(self.length)}
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes | memoryview]:
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from _map_file(part, self.chunk_size)
+
+    async def aiter_chunks(self) -> AsyncIterator[bytes | memoryview]:
+        """Iterates over the body for asynchronous clients
+
+        Chunks are slices of the mapped files, so no read calls block the event
+        loop. Pages that are not cached yet are still loaded on first access.
+        """
+        for chunk in self:
+            yield chunk
+
+
+def _map_file(path: str, chunk_size: int) -> Iterator[memoryview]:
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            # Empty files cannot be mapped
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            for offset in range(0, size, chunk_size):
+                chunk = memoryview(mapping)[offset : offset + chunk_size]
+                try:
+                    yield chunk
+                finally:
+                    # Released slices do not keep the mapping from closing
+                    chunk.release()
@@ -0,0 +1,224 @@
+"""Durable job queue on top of the ``Request.status`` column
+
+Pending requests are claimed by moving them to ``RUNNING`` together with a lease.
+Requests whose lease ran out, e.g. because the worker process died, are put back
+to ``PENDING`` until they exceeded the maximum number of attempts. Paused
+requests are not claimed until they are resumed to ``PENDING``.
+
+Requests are claimed by priority and, within a priority, take turns between
+tenants (the source of a request, or its user): the n-th pending request of a
+tenant is claimed at virtual time ``n / weight``, with the weights of
+``DISPATCHER_TENANT_WEIGHTS`` (default 1). The pending requests are numbered per
+tenant in the database, so however long the backlog of one tenant is, the oldest
+requests of the others are claimed right after its first ones.
+"""
+
+import uuid
+from datetime import UTC, timedelta
+
+from flask import current_app
+from sqlalchemy import func, or_, select, update
+
+from . import db, deadlines
+from .dispatcher import Job
+from .models import Model, Priority, Request, RequestStatus, utcnow
+
+
+def init_app(app) -> None:
+    """Sets the default queue configuration of the app"""
+    app.config.setdefault("DISPATCHER_LEASE_SECONDS", 300)
+    app.config.setdefault("DISPATCHER_MAX_ATTEMPTS", 3)
+    # Shares of users and sources by public_id, e.g. {"<uuid>": 2}
+    app.config.setdefault("DISPATCHER_TENANT_WEIGHTS", {})
+    # Candidates per claimed request, read by their position within the tenant
+    app.config.setdefault("DISPATCHER_CLAIM_WINDOW", 4)
+
+
+def lease_expiry():
+    """Returns the expiry time for a lease taken now"""
+    return utcnow() + timedelta(seconds=current_app.config["DISPATCHER_LEASE_SECONDS"])
+
+
+def requeue_expired() -> None:
+    """Puts running requests with an expired lease back into the queue
+
+    Requests that already used up all attempts are marked as failed instead.
+    """
+    expired = or_(
+        Request.lease_expires_at < utcnow(), Request.lease_expires_at.is_(None)
+    )
+    max_attempts = current_app.config["DISPATCHER_MAX_ATTEMPTS"]
+
+    db.session.execute(
+        update(Request)
+        .where(Request.status == RequestStatus.RUNNING, expired)
+        .where(Request.attempts >= max_attempts)
+        .values(status=RequestStatus.FAILED, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(Request)
+        .where(Request.status == RequestStatus.RUNNING, expired)
+        .values(status=RequestStatus.PENDING, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def _fair_share(rows: list, count: int) -> list:
+    """Picks ``count`` of the pending rows of one priority, tenants taking turns
+
+    The row at ``position`` n of its tenant gets the virtual time ``n / weight``,
+    rows are picked by virtual time and then by queue time.
+    """
+    weights = current_app.config["DISPATCHER_TENANT_WEIGHTS"]
+    ranked = []
+    for row in rows:
+        weight = float(weights.get(str(row.tenant), 1))
+        ranked.append((row.position / weight, row.queued_at or utcnow(), row))
+    ranked.sort(key=lambda item: item[:2])
+    return [row for _, _, row in ranked[:count]]
+
+
+def claim_jobs(limit: int) -> list[Job]:
+    """Atomically claims the next pending requests by priority and fair share
+
+    For each priority, the pending requests are numbered per tenant in the order
+    they were queued, and the ``limit * DISPATCHER_CLAIM_WINDOW`` requests with
+    the lowest numbers are the candidates among which tenants take turns. The
+    picked requests are locked, skipping rows locked by other workers, and
+    claimed with a single conditional update, so concurrent workers never claim
+    the same request twice. Pending requests whose deadline passed are failed
+    first.
+
+    Args:
+        limit: The maximum number of requests to claim
+
+    Returns:
+        The claimed jobs
+    """
+    requeue_expired()
+    deadlines.shed_queued()
+
+    window = limit * current_app.config["DISPATCHER_CLAIM_WINDOW"]
+    tenant = func.coalesce(Request.source_id, Request.user_id)
+    picked = []
+    for priority in sorted(Priority, key=lambda p: p.value):
+        if len(picked) >= limit:
+            break
+        pending = (
+            select(
+                Request.public_id,
+                Request.queued_at,
+                tenant.label("tenant"),
+                func.row_number()
+                .over(partition_by=tenant, order_by=Request.queued_at)
+                .label("position"),
+            )
+            .where(
+                Request.status == RequestStatus.PENDING, Request.priority == priority
+            )
+            .subquery()
+        )
+        rows = db.session.execute(
+            select(pending)
+            .order_by(pending.c.position, pending.c.queued_at)
+            .limit(window)
+        ).all()
+        picked += [row.public_id for row in _fair_share(rows, limit - len(picked))]
+    # Queries with window functions cannot lock rows, the picked ones are locked
+    # on their own
+    if picked:
+        picked = db.session.scalars(
+            select(Request.public_id)
+            .where(
+                Request.public_id.in_(picked),
+                Request.status == RequestStatus.PENDING,
+            )
+            .with_for_update(skip_locked=True)
+        ).all()
+    if not picked:
+        db.session.commit()
+        return []
+
+    claimed = db.session.execute(
+        update(Request)
+        .where(
+            Request.public_id.in_(picked),
+            Request.status == RequestStatus.PENDING,
+        )
+        .values(
+            status=RequestStatus.RUNNING,
+            lease_expires_at=lease_expiry(),
+            attempts=Request.attempts + 1,
+        )
+        .returning(
+            Request.public_id,
+            Request.model_id,
+            Request.queued_at,
+            Request.priority,
+            func.coalesce(Request.source_id, Request.user_id).label("tenant"),
+        )
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+
+    if not claimed:
+        return []
+
+    model_keys = dict(
+        db.session.execute(
+            select(Model.public_id, Model.server_model_name).where(
+                Model.public_id.in_({row.model_id for row in claimed})
+            )
+        ).all()
+    )
+
+    weights = current_app.config["DISPATCHER_TENANT_WEIGHTS"]
+    jobs = []
+    # Handed to the dispatcher by priority, then in the order they were queued
+    claimed.sort(key=lambda row: (row.priority.value, row.queued_at or utcnow()))
+    for row in claimed:
+        job = Job(
+            row.public_id,
+            model_keys[row.model_id],
+            priority=row.priority.value,
+            tenant=row.tenant,
+            weight=float(weights.get(str(row.tenant), 1)),
+        )
+        if row.queued_at is not None:
+            job.enqueued_at = row.queued_at.replace(tzinfo=UTC).timestamp()
+        jobs.append(job)
+    return jobs
+
+
+def abandoned_jobs(request_ids: list[uuid.UUID]) -> list[uuid.UUID]:
+    """Returns the claimed requests that were paused or deleted since
+
+    Args:
+        request_ids: The public_ids of the requests of the queued and running jobs
+    """
+    kept = db.session.scalars(
+        select(Request.public_id).where(
+            Request.public_id.in_(request_ids),
+            Request.status != RequestStatus.PAUSED,
+        )
+    )
+    return list(set(request_ids).difference(kept))
+
+
+def count_pending(limit: int) -> int:
+    """Counts pending requests, but stops counting at ``limit``"""
+    pending = (
+        select(Request.public_id)
+        .where(Request.status == RequestStatus.PENDING)
+        .limit(limit)
+        .subquery()
+    )
+    return db.session.scalar(select(func.count()).select_from(pending))
+
+
+def queue_full(count: int = 1) -> bool:
+    """Checks if ``count`` more pending requests exceed ``DISPATCHER_QUEUE_SIZE``"""
+    size = current_app.config["DISPATCHER_QUEUE_SIZE"]
+    return count_pending(size) + count > size
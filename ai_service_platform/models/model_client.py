@@ -0,0 +1,428 @@
+import random
+import socket
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+import requests
+from flask import Flask, current_app
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import cancellation, model_registry
+from .input_body import InputBody
+
+# Gateway errors of the model server that are worth another try
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+class ModelServerError(Exception):
+    """Raised when the model server could not answer a prediction call"""
+
+
+class CircuitOpen(ModelServerError):
+    """Raised when calls to a model are suspended after repeated failures"""
+
+
+class DeadlineExceeded(ModelServerError):
+    """Raised when the deadline of a call passed before the model server answered"""
+
+
+def call_timeout(
+    timeout: tuple[float, float], deadline: float | None
+) -> tuple[float, float]:
+    """Returns the connect and read timeout of a call, bounded by its deadline
+
+    Args:
+        timeout: The configured connect and read timeout
+        deadline: Seconds since the epoch by which the call has to be answered
+
+    Raises:
+        DeadlineExceeded: If the deadline already passed
+    """
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded("The deadline passed before the model server answered")
+    return min(timeout[0], remaining), min(timeout[1], remaining)
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures per model and suspends calls to broken models
+
+    After ``threshold`` consecutive failures the circuit of a model opens and all
+    calls fail fast. Once ``reset_timeout`` seconds passed, a single trial call is
+    let through. Its outcome closes the circuit again or keeps it open.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures: dict[str, int] = {}
+        self._opened_at: dict[str, float] = {}
+
+    def allow(self, key: str) -> bool:
+        with self._lock:
+            opened_at = self._opened_at.get(key)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at < self.reset_timeout:
+                return False
+            # Half open: let one trial through and keep the others waiting
+            self._opened_at[key] = time.monotonic()
+            return True
+
+    def record_success(self, key: str) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+
+    def record_failure(self, key: str) -> None:
+        with self._lock:
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] >= self.threshold:
+                self._opened_at[key] = time.monotonic()
+
+    def open_circuits(self) -> list[str]:
+        with self._lock:
+            return list(self._opened_at)
+
+
+class _AbortableConnection:
+    """Connection that is shut down when the current cancel token is cancelled
+
+    Shutting down the socket fails the send or receive the calling thread is
+    blocked in, so a cancelled call returns right away instead of waiting for the
+    model server.
+    """
+
+    def request(self, *args, **kwargs):
+        token = cancellation.current()
+        token.check()
+        self._unregister = token.on_cancel(self._abort)
+        try:
+            super().request(*args, **kwargs)
+        except BaseException:
+            self._unregister()
+            raise
+
+    def getresponse(self):
+        try:
+            return super().getresponse()
+        finally:
+            self._unregister()
+
+    def _abort(self) -> None:
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _AbortableHTTPConnection(_AbortableConnection, HTTPConnection):
+    pass
+
+
+class _AbortableHTTPSConnection(_AbortableConnection, HTTPSConnection):
+    pass
+
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+
+class _AbortableAdapter(HTTPAdapter):
+    """Adapter whose calls are aborted by cancelling the current token"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _AbortableHTTPConnectionPool,
+            "https": _AbortableHTTPSConnectionPool,
+        }
+
+
+class ClientState:
+    """Configuration and counters shared by the synchronous and asyncio clients"""
+
+    def __init__(self, app: Flask):
+        config = app.config
+        self.timeout = (
+            config["MODEL_SERVER_CONNECT_TIMEOUT"],
+            config["MODEL_SERVER_READ_TIMEOUT"],
+        )
+        self.retries: int = config["MODEL_SERVER_RETRIES"]
+        self.backoff: float = config["MODEL_SERVER_BACKOFF"]
+        self.chunk_size: int = config["MODEL_SERVER_CHUNK_SIZE"]
+        self.breaker = CircuitBreaker(
+            config["MODEL_SERVER_BREAKER_THRESHOLD"],
+            config["MODEL_SERVER_BREAKER_RESET"],
+        )
+
+        # Guards the counters, which are updated by all workers
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retried = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        """Returns call counters and the models with an open circuit"""
+        with self.lock:
+            counters = {
+                "calls": self.calls,
+                "retried": self.retried,
+                "failures": self.failures,
+            }
+        return {**counters, "open_circuits": self.breaker.open_circuits()}
+
+
+class _ClientState(ClientState):
+    def __init__(self, app: Flask):
+        super().__init__(app)
+
+        # One pooled keep-alive connection per concurrent caller and endpoint
+        self.session = requests.Session()
+        adapter = _AbortableAdapter(
+            pool_connections=16,
+            pool_maxsize=app.config["MODEL_SERVER_POOL_SIZE"],
+            pool_block=True,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+class PredictionCall:
+    """Decisions of one prediction call across its attempts
+
+    Picks endpoints and timeouts, retries, records to the circuit breaker and the
+    model registry and reads the predictions of the answer. The clients only send
+    the HTTP requests, see :meth:`ModelServerClient.predict` for the loop.
+    """
+
+    def __init__(
+        self,
+        state: ClientState,
+        model_key: str,
+        input_paths: list[str],
+        deadline: float | None,
+    ):
+        if not state.breaker.allow(model_key):
+            raise CircuitOpen(f"Calls to model {model_key} are suspended")
+        self.state = state
+        self.model_key = model_key
+        self.input_paths = input_paths
+        self.deadline = deadline
+        self.token = cancellation.current()
+        self.endpoint: model_registry.Endpoint | None = None
+        self.timeout = state.timeout
+        self.error: ModelServerError | None = None
+        self._ok = False
+        self._started = 0.0
+        self._elapsed: float | None = None
+
+    def attempts(self) -> Iterator[float]:
+        """Yields the seconds to back off before each attempt, jittered
+
+        The backoff ends at the deadline at the latest.
+
+        Raises:
+            DeadlineExceeded: If the deadline passed before a retry
+        """
+        yield 0
+        for attempt in range(1, self.state.retries + 1):
+            delay = random.uniform(0, self.state.backoff * 2 ** (attempt - 1))
+            if self.deadline is not None:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded(
+                        f"The deadline passed before a retry: {self.error}"
+                    )
+                delay = min(delay, remaining)
+            with self.state.lock:
+                self.state.retried += 1
+            yield delay
+
+    def start(self) -> bool:
+        """Picks the endpoint and timeout of the next attempt
+
+        Returns:
+            False if no endpoint serves the model
+
+        Raises:
+            DeadlineExceeded: If the deadline already passed
+        """
+        self.timeout = call_timeout(self.state.timeout, self.deadline)
+        self.endpoint = model_registry.acquire(self.model_key, avoid=self.endpoint)
+        if self.endpoint is None:
+            self.error = ModelServerError(f"No endpoint serves model {self.model_key}")
+            return False
+        with self.state.lock:
+            self.state.calls += 1
+        self._ok = False
+        self._elapsed = None
+        self._started = time.monotonic()
+        return True
+
+    def answered(self, status_code: int) -> None:
+        """Notes that the endpoint answered the attempt"""
+        self._elapsed = time.monotonic() - self._started
+        self._ok = status_code not in RETRY_STATUS_CODES
+
+    def unreachable(self, error: Exception, timed_out: bool) -> None:
+        """Notes that the attempt got no answer, so it is retried
+
+        Raises:
+            DeadlineExceeded: If the timeout that ran out was the deadline
+            Cancelled: If the attempt was aborted by the cancel token
+        """
+        # Aborted calls are no failures of the endpoint
+        self.token.check()
+        if timed_out and self.timeout != self.state.timeout:
+            # Neither are calls cut short by the deadline
+            self._ok = True
+            raise DeadlineExceeded(f"Model server did not answer in time: {error!r}")
+        self.error = ModelServerError(f"Model server unreachable: {error!r}")
+
+    def release(self) -> None:
+        """Returns the endpoint of the attempt to the registry"""
+        model_registry.release(
+            self.endpoint, self._ok or self.token.cancelled, self._elapsed
+        )
+
+    def retry(self, status_code: int) -> bool:
+        """Checks if the answer is a gateway error that is worth another try"""
+        if status_code not in RETRY_STATUS_CODES:
+            return False
+        self.error = ModelServerError(f"Model server answered {status_code}")
+        return True
+
+    def output(self, response) -> list[Any]:
+        """Returns the predictions of an answer, one per input
+
+        Raises:
+            ModelServerError: If the model rejected the input or the answer holds
+                no prediction per input
+        """
+        if response.status_code >= 400:
+            # The model server works, but trying again would not help
+            self.state.breaker.record_success(self.model_key)
+            raise ModelServerError(f"Model server answered {response.status_code}")
+        try:
+            output = response.json()
+        except ValueError as e:
+            self.error = ModelServerError(f"Model server answered no JSON: {e}")
+            raise self.give_up() from e
+        outputs = [output] if len(self.input_paths) == 1 else output
+        if not isinstance(outputs, list) or len(outputs) != len(self.input_paths):
+            count = len(outputs) if isinstance(outputs, list) else "no list of"
+            self.error = ModelServerError(
+                f"Model server answered {count} predictions "
+                f"for {len(self.input_paths)} inputs"
+            )
+            raise self.give_up()
+        self.state.breaker.record_success(self.model_key)
+        return outputs
+
+    def give_up(self) -> ModelServerError:
+        """Counts the call as failed and returns the error of its last attempt"""
+        with self.state.lock:
+            self.state.failures += 1
+        self.state.breaker.record_failure(self.model_key)
+        return self.error
+
+
+class ModelServerClient:
+    """Shared client for the prediction API of the model server
+
+    Connections are pooled and kept alive between calls. Every call has a connect
+    and read timeout and goes to the endpoint picked by the model registry.
+    Connection errors, timeouts and gateway errors are retried with jittered
+    exponential backoff, on another endpoint if the model has one, and a circuit
+    breaker per ``server_model_name`` stops calling models that keep failing.
+    Calls of a batch are aborted as soon as its cancel token is cancelled, see
+    :mod:`.cancellation`.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        app.config.setdefault("MODEL_SERVER_URL", "http://multi-model-server:8080")
+        app.config.setdefault("MODEL_SERVER_CONNECT_TIMEOUT", 3.05)
+        app.config.setdefault("MODEL_SERVER_READ_TIMEOUT", 60)
+        app.config.setdefault("MODEL_SERVER_RETRIES", 2)
+        app.config.setdefault("MODEL_SERVER_BACKOFF", 0.5)
+        app.config.setdefault("MODEL_SERVER_BREAKER_THRESHOLD", 5)
+        app.config.setdefault("MODEL_SERVER_BREAKER_RESET", 30)
+        # Bytes of an input file sent at once, see InputBody
+        app.config.setdefault("MODEL_SERVER_CHUNK_SIZE", 256 * 1024)
+        app.config.setdefault(
+            "MODEL_SERVER_POOL_SIZE", app.config.get("DISPATCHER_WORKERS", 4)
+        )
+
+        app.extensions["model_client"] = _ClientState(app)
+
+    def _get_state(self) -> _ClientState:
+        return current_app.extensions["model_client"]
+
+    def predict(
+        self, model_key: str, input_paths: list[str], deadline: float | None = None
+    ) -> list[Any]:
+        """Runs the model on the given input files
+
+        A single input is posted as the raw file, several inputs are posted in one
+        multipart call with a ``data`` field per input. The model server answers a
+        batch with one prediction per input in the same order. The inputs are
+        streamed from disk and sent again from disk on retries.
+
+        Args:
+            model_key: The server_model_name of the model
+            input_paths: Paths of the input files
+            deadline: Seconds since the epoch after which the answer is of no use,
+                the timeouts of every attempt end there at the latest
+
+        Returns:
+            One prediction per input
+
+        Raises:
+            CircuitOpen: If the model failed too often recently
+            ModelServerError: If the model server did not answer after all retries
+            DeadlineExceeded: If the deadline passed before the model server
+                answered
+            Cancelled: If the current cancel token was cancelled
+        """
+        state = self._get_state()
+        call = PredictionCall(state, model_key, input_paths, deadline)
+        body = InputBody(input_paths, state.chunk_size)
+        for delay in call.attempts():
+            call.token.sleep(delay)
+            if not call.start():
+                continue
+            try:
+                response = state.session.post(
+                    f"{call.endpoint.url}/predictions/{model_key}",
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=call.timeout,
+                )
+                call.answered(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                call.unreachable(e, timed_out=isinstance(e, requests.Timeout))
+                continue
+            finally:
+                call.release()
+            if call.retry(response.status_code):
+                continue
+            return call.output(response)
+        raise call.give_up()
+
+    def stats(self) -> dict:
+        """Returns call counters and the models with an open circuit"""
+        return self._get_state().stats()
@@ -0,0 +1,365 @@
+"""Registry of the model servers serving each model
+
+A model can be served by several model servers, its rows in the ``model_endpoint``
+table. Each call goes to the ready endpoint of the model with the fewest calls of
+this process in flight relative to its weight, so slow or busy replicas get less
+traffic. Models without a ready endpoint are served by ``MODEL_SERVER_URL``.
+
+A prober thread reloads the endpoints every ``MODEL_REGISTRY_PROBE_INTERVAL``
+seconds and pings each of them. New endpoints get ``MODEL_REGISTRY_WARMUP_CALLS``
+predictions of a small image before any traffic. Endpoints that fail
+``MODEL_REGISTRY_MAX_FAILURES`` calls in a row, or a probe, get no traffic until a
+probe succeeds again. The prober runs next to the dispatcher, in the web app if it
+is embedded and in ``flask worker`` otherwise, and writes the health of the
+endpoints to their rows.
+
+The registry also keeps a moving average of the duration of the calls to each
+endpoint, which tells how long a call to a model is expected to take.
+"""
+
+import io
+import threading
+import uuid
+from functools import cache
+
+import requests
+from flask import Flask, current_app
+from PIL import Image
+from sqlalchemy import select, update
+
+from . import db
+from .models import Model, ModelEndpoint, utcnow
+
+# Weight of the latest call in the moving average of the call durations
+LATENCY_SMOOTHING = 0.2
+
+
+class Endpoint:
+    """A model server of a model as seen by the current process
+
+    Args:
+        public_id: The id of its row, None for ``MODEL_SERVER_URL``
+        model_key: The server_model_name of the model
+        url: The base URL of the model server
+        weight: Share of the calls relative to the other endpoints of the model
+    """
+
+    def __init__(
+        self, public_id: uuid.UUID | None, model_key: str, url: str, weight: float
+    ):
+        self.public_id = public_id
+        self.model_key = model_key
+        self.url = url.rstrip("/")
+        self.weight = weight
+        self.ready = public_id is None
+        self.warmed_at = None
+        # Calls of this process in flight
+        self.outstanding = 0
+        # Consecutive failed calls
+        self.failures = 0
+        self.calls = 0
+        # Moving average of the seconds answered calls took
+        self.latency: float | None = None
+
+
+class _RegistryState:
+    def __init__(self, app: Flask):
+        config = app.config
+        self.app = app
+        self.interval: float = config["MODEL_REGISTRY_PROBE_INTERVAL"]
+        self.timeout = (
+            config["MODEL_SERVER_CONNECT_TIMEOUT"],
+            config["MODEL_REGISTRY_PROBE_TIMEOUT"],
+        )
+        self.warmup_timeout = (
+            config["MODEL_SERVER_CONNECT_TIMEOUT"],
+            config["MODEL_SERVER_READ_TIMEOUT"],
+        )
+        self.warmup_calls: int = config["MODEL_REGISTRY_WARMUP_CALLS"]
+        self.max_failures: int = config["MODEL_REGISTRY_MAX_FAILURES"]
+        self.session = requests.Session()
+
+        self.lock = threading.Lock()
+        self.endpoints: dict[str, list[Endpoint]] = {}
+        # Endpoints of the MODEL_SERVER_URL by model key
+        self.fallbacks: dict[str, Endpoint] = {}
+        self.loaded = False
+        # Rotates the first endpoint, so ties are broken round robin
+        self.turn = 0
+        self.stopping = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.probes = 0
+        self.warmups = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default registry configuration of the app
+
+    The prober is started right away if the dispatcher is embedded into the app.
+    """
+    app.config.setdefault("MODEL_REGISTRY_PROBE_INTERVAL", 10)
+    # Seconds a ping may take, warmup calls take up to MODEL_SERVER_READ_TIMEOUT
+    app.config.setdefault("MODEL_REGISTRY_PROBE_TIMEOUT", 2)
+    app.config.setdefault("MODEL_REGISTRY_WARMUP_CALLS", 3)
+    app.config.setdefault("MODEL_REGISTRY_MAX_FAILURES", 3)
+
+    app.extensions["model_registry"] = _RegistryState(app)
+    if app.config.get("DISPATCHER_EMBEDDED", True):
+        with app.app_context():
+            start()
+
+
+def _get_state() -> _RegistryState:
+    return current_app.extensions["model_registry"]
+
+
+def start() -> None:
+    """Starts the prober thread of the current app if not running yet"""
+    state = _get_state()
+    with state.lock:
+        if state.thread is not None:
+            return
+        state.stopping.clear()
+        state.thread = threading.Thread(
+            target=_run, args=(state,), name="model-registry-prober", daemon=True
+        )
+        state.thread.start()
+
+
+def shutdown() -> None:
+    """Stops the prober thread"""
+    state = _get_state()
+    with state.lock:
+        thread, state.thread = state.thread, None
+    state.stopping.set()
+    if thread is not None:
+        thread.join()
+
+
+def acquire(model_key: str, avoid: Endpoint | None = None) -> Endpoint | None:
+    """Picks the endpoint for a call to a model, see :func:`release`
+
+    Args:
+        model_key: The server_model_name of the model
+        avoid: An endpoint that is only picked if no other one is ready, e.g.
+            the one a retried call failed on
+
+    Returns:
+        The ready endpoint with the fewest calls in flight per weight, the
+        ``MODEL_SERVER_URL`` if none is ready, or None if that is not set either
+    """
+    state = _get_state()
+    if not state.loaded:
+        reload()
+
+    with state.lock:
+        ready = [e for e in state.endpoints.get(model_key, ()) if e.ready]
+        if len(ready) > 1 and avoid in ready:
+            ready.remove(avoid)
+        if ready:
+            state.turn += 1
+            first = state.turn % len(ready)
+            endpoint = min(
+                ready[first:] + ready[:first],
+                key=lambda e: (e.outstanding + 1) / e.weight,
+            )
+        else:
+            url = current_app.config["MODEL_SERVER_URL"]
+            if not url:
+                return None
+            endpoint = state.fallbacks.get(model_key)
+            if endpoint is None or endpoint.url != url.rstrip("/"):
+                endpoint = state.fallbacks[model_key] = Endpoint(
+                    None, model_key, url, 1.0
+                )
+        endpoint.outstanding += 1
+        endpoint.calls += 1
+    return endpoint
+
+
+def release(endpoint: Endpoint, ok: bool, elapsed: float | None = None) -> None:
+    """Finishes a call of :func:`acquire`
+
+    Args:
+        endpoint: The endpoint that was called
+        ok: Whether the endpoint answered, failed predictions of an input count as
+            answered
+        elapsed: Seconds until the endpoint answered, if it did
+    """
+    state = _get_state()
+    with state.lock:
+        endpoint.outstanding -= 1
+        if ok:
+            endpoint.failures = 0
+            if elapsed is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += LATENCY_SMOOTHING * (elapsed - endpoint.latency)
+            return
+        endpoint.failures += 1
+        # Without a registered endpoint there is nowhere else to go
+        if endpoint.public_id is not None and endpoint.failures >= state.max_failures:
+            endpoint.ready = False
+
+
+def expected_latency(model_key: str) -> float:
+    """Returns the seconds a call to a model is expected to take
+
+    That is the average duration of the calls to its fastest ready endpoint, or 0
+    as long as none of them answered a call of this process.
+    """
+    state = _get_state()
+    with state.lock:
+        endpoints = [e for e in state.endpoints.get(model_key, ()) if e.ready]
+        if not endpoints and model_key in state.fallbacks:
+            endpoints = [state.fallbacks[model_key]]
+        latencies = [e.latency for e in endpoints if e.latency is not None]
+    return min(latencies, default=0.0)
+
+
+def reload() -> None:
+    """Reads the endpoints of all models, keeping the state of known endpoints
+
+    Endpoints that are new to this process are ready if another process already
+    warmed them up and found them healthy.
+    """
+    query = select(
+        ModelEndpoint.public_id,
+        ModelEndpoint.url,
+        ModelEndpoint.weight,
+        ModelEndpoint.healthy,
+        ModelEndpoint.warmed_at,
+        Model.server_model_name,
+    ).join(Model)
+    # Outside of the session, which may be in use by the caller
+    with db.engine.connect() as connection:
+        rows = connection.execute(query).all()
+
+    state = _get_state()
+    with state.lock:
+        known = {
+            endpoint.public_id: endpoint
+            for endpoints in state.endpoints.values()
+            for endpoint in endpoints
+        }
+        state.endpoints = {}
+        for row in rows:
+            endpoint = known.get(row.public_id)
+            if endpoint is None:
+                endpoint = Endpoint(
+                    row.public_id, row.server_model_name, row.url, row.weight
+                )
+                endpoint.warmed_at = row.warmed_at
+                endpoint.ready = bool(row.healthy) and row.warmed_at is not None
+            endpoint.weight = row.weight
+            state.endpoints.setdefault(row.server_model_name, []).append(endpoint)
+        state.loaded = True
+
+
+def probe() -> None:
+    """Reloads the endpoints, checks their health and warms up new ones
+
+    The results are written to the ``model_endpoint`` table.
+    """
+    reload()
+    state = _get_state()
+    with state.lock:
+        endpoints = [e for group in state.endpoints.values() for e in group]
+
+    rows = []
+    for endpoint in endpoints:
+        healthy = _ping(state, endpoint)
+        if healthy and endpoint.warmed_at is None:
+            healthy = _warm_up(state, endpoint)
+            if healthy:
+                endpoint.warmed_at = utcnow()
+        with state.lock:
+            endpoint.ready = healthy
+            if healthy:
+                endpoint.failures = 0
+            state.probes += 1
+        rows.append(
+            {
+                "public_id": endpoint.public_id,
+                "healthy": healthy,
+                "warmed_at": endpoint.warmed_at,
+                "checked_at": utcnow(),
+            }
+        )
+
+    if rows:
+        db.session.execute(update(ModelEndpoint), rows)
+        db.session.commit()
+
+
+def _ping(state: _RegistryState, endpoint: Endpoint) -> bool:
+    try:
+        response = state.session.get(f"{endpoint.url}/ping", timeout=state.timeout)
+    except (requests.ConnectionError, requests.Timeout):
+        return False
+    return response.ok
+
+
+def _warm_up(state: _RegistryState, endpoint: Endpoint) -> bool:
+    url = f"{endpoint.url}/predictions/{endpoint.model_key}"
+    for _ in range(state.warmup_calls):
+        try:
+            response = state.session.post(
+                url, data=_warmup_image(), timeout=state.warmup_timeout
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+        if not response.ok:
+            return False
+        with state.lock:
+            state.warmups += 1
+    return True
+
+
+@cache
+def _warmup_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (224, 224), (128, 128, 128)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _run(state: _RegistryState) -> None:
+    with state.app.app_context():
+        while True:
+            try:
+                probe()
+            except Exception:
+                db.session.rollback()
+                state.app.logger.exception("Failed to probe the model endpoints")
+            finally:
+                db.session.close()
+            if state.stopping.wait(state.interval):
+                return
+
+
+def stats() -> dict:
+    """Returns the state of every endpoint and the number of probes and warmups"""
+    state = _get_state()
+    with state.lock:
+        endpoints = [
+            *(e for group in state.endpoints.values() for e in group),
+            *state.fallbacks.values(),
+        ]
+        return {
+            "probes": state.probes,
+            "warmups": state.warmups,
+            "endpoints": [
+                {
+                    "model": endpoint.model_key,
+                    "url": endpoint.url,
+                    "weight": endpoint.weight,
+                    "ready": endpoint.ready,
+                    "outstanding": endpoint.outstanding,
+                    "calls": endpoint.calls,
+                    "latency": endpoint.latency,
+                    "failures": endpoint.failures,
+                }
+                for endpoint in endpoints
+            ],
+        }
@@ -1,10 +1,10 @@
+from datetime import UTC, datetime
 from typing import Optional, Any
-from typing_extensions import Annotated
 import uuid
 from sqlalchemy.orm.properties import MappedColumn
 
 from . import db
-from sqlalchemy import PickleType, event, ForeignKey
+from sqlalchemy import event, text, ForeignKey, Index
 from sqlalchemy.orm import mapped_column, Mapped, relationship, DeclarativeBase
 from sqlalchemy.dialects.sqlite import JSON
 from flask import current_app
@@ -32,13 +32,29 @@ class RequestStatus(enum.Enum):
     FINISHED = "finished"
 
 
-bytes_pickle = Annotated[Any, "pickle"]
+class Priority(enum.Enum):
+    """Scheduling class of a request, classes with lower values are served first"""
+
+    INTERACTIVE = 0
+    BULK = 1
+
+    @classmethod
+    def of(cls, role: Role, batch: bool = False) -> "Priority":
+        """Returns the class of a request submitted by a role
+
+        Sources and batches are bulk work, single uploads of users are interactive.
+        """
+        return cls.BULK if batch or role is Role.SOURCE else cls.INTERACTIVE
+
+
+def utcnow() -> datetime:
+    """Current UTC time without tzinfo, as stored by the database"""
+    return datetime.now(UTC).replace(tzinfo=None)
 
 
 class Base(DeclarativeBase):
     type_annotation_map = {
         dict[str, Any]: JSON,
-        bytes_pickle: PickleType,
     }
 
 
@@ -83,6 +99,20 @@ def create_users(*args, **kwargs):
 
 class Request(Base):
     __tablename__ = "request"
+    __table_args__ = (
+        # Workers claim the oldest pending requests of each priority first
+        Index(
+            "ix_request_status_priority_queued_at", "status", "priority", "queued_at"
+        ),
+        # and fail those whose deadline passed before, see :mod:`.deadlines`
+        Index("ix_request_status_deadline", "status", "deadline"),
+        # Request lists poll for the status changes since their last poll
+        Index("ix_request_user_id_updated_at", "user_id", "updated_at"),
+        Index("ix_request_updated_at", "updated_at"),
+        # Request lists are paginated by creation time, newest first
+        Index("ix_request_user_id_created_at", "user_id", "created_at", "public_id"),
+        Index("ix_request_created_at", "created_at", "public_id"),
+    )
     public_id: MappedColumn[uuid.UUID] = mapped_column(
         primary_key=True, default=uuid.uuid4
     )
@@ -95,14 +125,85 @@ class Request(Base):
     model_id: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("model.public_id", ondelete="CASCADE")
     )
+    batch_id: Mapped[Optional[uuid.UUID]] = mapped_column(
+        ForeignKey("batch.public_id", ondelete="CASCADE"), index=True
+    )
     patient_id: Mapped[Optional[str]]
     # input_name: Mapped[str]
     input_file: Mapped[str]
-    output: Mapped[Optional[bytes_pickle]]
+    input_hash: Mapped[Optional[str]] = mapped_column(index=True)
+    # The most probable classes of the output, shown in request lists
+    summary: Mapped[Optional[list[dict[str, Any]]]] = mapped_column(JSON)
     status: Mapped[RequestStatus] = mapped_column(default=RequestStatus.PENDING)
+    priority: Mapped[Priority] = mapped_column(
+        default=Priority.INTERACTIVE, server_default=text("'INTERACTIVE'")
+    )
+    created_at: Mapped[Optional[datetime]] = mapped_column(
+        default=utcnow,
+        info={"backfill": "COALESCE(queued_at, CURRENT_TIMESTAMP)"},
+    )
+    queued_at: Mapped[Optional[datetime]] = mapped_column(default=utcnow)
+    # Time after which nobody waits for the output anymore
+    deadline: Mapped[Optional[datetime]]
+    lease_expires_at: Mapped[Optional[datetime]]
+    attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+    updated_at: Mapped[Optional[datetime]] = mapped_column(
+        default=utcnow, onupdate=utcnow
+    )
     user: Mapped[User] = relationship(back_populates="requests")
     source: Mapped["Source"] = relationship(back_populates="requests")
     model: Mapped["Model"] = relationship(back_populates="requests")
+    batch: Mapped[Optional["Batch"]] = relationship(back_populates="requests")
+    result: Mapped[Optional["RequestOutput"]] = relationship(
+        cascade="all, delete-orphan"
+    )
+
+    @property
+    def output(self) -> Any:
+        """The output of the model, loaded from its own table on first access"""
+        return self.result.output if self.result is not None else None
+
+    @output.setter
+    def output(self, output: Any) -> None:
+        if output is None:
+            self.result = None
+        elif self.result is None:
+            self.result = RequestOutput(output=output)
+        else:
+            self.result.output = output
+        self.summary = summarize(output)
+
+
+class RequestOutput(Base):
+    """The output of a request, kept apart so that loading requests stays cheap"""
+
+    __tablename__ = "request_output"
+    request_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("request.public_id", ondelete="CASCADE"), primary_key=True
+    )
+    output: Mapped[Any] = mapped_column(JSON)
+
+
+def summarize(output: Any, size: int = 3) -> list[dict[str, Any]] | None:
+    """Returns the most probable classes of a classification output
+
+    Args:
+        output: The output of a model
+        size: The maximum number of classes to return
+
+    Returns:
+        The classes with their probability or None if the output has another form
+    """
+    if not isinstance(output, list) or not all(
+        isinstance(prediction, dict) and "probability" in prediction
+        for prediction in output
+    ):
+        return None
+    top = sorted(output, key=lambda prediction: prediction["probability"], reverse=True)
+    return [
+        {"class": prediction.get("class"), "probability": prediction["probability"]}
+        for prediction in top[:size]
+    ]
 
 
 class Model(Base):
@@ -112,9 +213,43 @@ class Model(Base):
     )
     name: Mapped[str] = mapped_column(unique=True)
     server_model_name: Mapped[str] = mapped_column(unique=True)
+    # Increased on every redeployment, which invalidates cached results
+    revision: Mapped[int] = mapped_column(default=0, server_default="0")
+    # Optional preprocessing of the inputs, see :mod:`.preprocessing`. Inputs are
+    # downscaled until their shorter side has input_size pixels, converted to the
+    # Pillow mode input_mode and encoded as JPEG with input_quality.
+    input_size: Mapped[Optional[int]]
+    input_mode: Mapped[Optional[str]]
+    input_quality: Mapped[Optional[int]]
+    # Seconds its requests may take from upload to output, see :mod:`.deadlines`
+    request_timeout: Mapped[Optional[float]]
     requests: Mapped[list[Request]] = relationship(
         back_populates="model", cascade="all, delete"
     )
+    endpoints: Mapped[list["ModelEndpoint"]] = relationship(
+        back_populates="model", cascade="all, delete"
+    )
+
+
+class ModelEndpoint(Base):
+    """Model server serving a model, see :mod:`.model_registry`"""
+
+    __tablename__ = "model_endpoint"
+    __table_args__ = (Index("ix_model_endpoint_model_id_url", "model_id", "url"),)
+    public_id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    model_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("model.public_id", ondelete="CASCADE")
+    )
+    # Base URL of the model server, e.g. http://gpu-1:8080
+    url: Mapped[str]
+    # Share of the calls relative to the other endpoints of the model
+    weight: Mapped[float] = mapped_column(default=1.0)
+    # None until the endpoint is probed for the first time
+    healthy: Mapped[Optional[bool]]
+    # Set once the endpoint answered its warmup calls
+    warmed_at: Mapped[Optional[datetime]]
+    checked_at: Mapped[Optional[datetime]]
+    model: Mapped[Model] = relationship(back_populates="endpoints")
 
 
 @event.listens_for(Model.__table__, "after_create")
@@ -126,6 +261,9 @@ def create_models(*args, **kwargs):
             public_id=uuid.uuid4(),
             name="SqueezeNet",
             server_model_name="squeezenet",
+            input_size=256,
+            input_mode="RGB",
+            input_quality=90,
         ))
 
     db.session.add(
@@ -133,11 +271,74 @@ def create_models(*args, **kwargs):
             public_id=uuid.uuid4(),
             name="FERPlus",
             server_model_name="FERPlus",
+            input_size=64,
+            input_mode="L",
+            input_quality=90,
         ))
 
     db.session.commit()
 
 
+class InferenceResult(Base):
+    """Persistent tier of the result cache, see :mod:`.result_cache`"""
+
+    __tablename__ = "inference_result"
+    model_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("model.public_id", ondelete="CASCADE"), primary_key=True
+    )
+    revision: Mapped[int] = mapped_column(primary_key=True)
+    input_hash: Mapped[str] = mapped_column(primary_key=True)
+    output: Mapped[Any] = mapped_column(JSON)
+    size: Mapped[int]
+    last_used_at: Mapped[datetime] = mapped_column(default=utcnow, index=True)
+
+
+class Batch(Base):
+    """Requests submitted together for one model"""
+
+    __tablename__ = "batch"
+    public_id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("user.public_id", ondelete="CASCADE")
+    )
+    source_id: Mapped[Optional[uuid.UUID]] = mapped_column(
+        ForeignKey("source.public_id", ondelete="CASCADE")
+    )
+    model_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("model.public_id", ondelete="CASCADE")
+    )
+    size: Mapped[int]
+    created_at: Mapped[datetime] = mapped_column(default=utcnow)
+    # Deleted through the session, so their blobs are released, see blob_store
+    requests: Mapped[list[Request]] = relationship(
+        back_populates="batch", cascade="all, delete"
+    )
+
+
+class Blob(Base):
+    """Uploaded file in the blob store, see :mod:`.blob_store`"""
+
+    __tablename__ = "blob"
+    hash: Mapped[str] = mapped_column(primary_key=True)
+    # Relative to the UPLOAD_FOLDER
+    path: Mapped[str]
+    size: Mapped[int]
+    # Number of requests using the blob, it is deleted when this drops to zero
+    ref_count: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(default=utcnow)
+
+
+class RateLimit(Base):
+    """Token bucket shared by all processes, see :mod:`.rate_limits`"""
+
+    __tablename__ = "rate_limit"
+    key: Mapped[str] = mapped_column(primary_key=True)
+    tokens: Mapped[float]
+    # Seconds since the epoch, the bucket is full again or unused at expires_at
+    updated_at: Mapped[float]
+    expires_at: Mapped[float] = mapped_column(index=True)
+
+
 class Source(Base):
     __tablename__ = "source"
     public_id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
@@ -145,5 +346,9 @@ class Source(Base):
     name: Mapped[str]
     password: Mapped[str]
     role: Mapped[Role] = mapped_column(default=Role.SOURCE)
+    # Increased to revoke all API tokens of the source, see source_tokens
+    token_version: Mapped[int] = mapped_column(default=0, server_default="0")
     owner: Mapped[list[User]] = relationship(back_populates="sources")
-    requests: Mapped[list[Request]] = relationship(back_populates="source")
+    requests: Mapped[list[Request]] = relationship(
+        back_populates="source", cascade="all, delete"
+    )
@@ -0,0 +1,223 @@
+"""Downscaling of input images before they are sent to the model server
+
+Models that only need small inputs can define an :class:`InputFormat` with the
+``input_*`` columns of :class:`.models.Model`. The inputs of their requests are
+then resized, converted and re-encoded in a pool of worker processes, so the
+dispatcher threads are not blocked by the CPU bound work. Every result is stored
+next to the original file, named after the original and the format, and reused by
+later requests with the same input.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+from flask import Flask, current_app
+from PIL import Image
+
+from .models import Model
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class InputFormat:
+    """Input format expected by a model
+
+    Attributes:
+        size: Pixels of the shorter side, larger inputs are downscaled to it
+        mode: Pillow mode of the input, e.g. ``RGB`` or ``L``
+        quality: JPEG quality of the re-encoded input
+    """
+
+    size: int
+    mode: str = "RGB"
+    quality: int = 90
+
+    @classmethod
+    def of(cls, model: Model) -> "InputFormat | None":
+        """Returns the input format of a model or None if it takes the originals"""
+        if model.input_size is None:
+            return None
+        return cls(
+            model.input_size, model.input_mode or "RGB", model.input_quality or 90
+        )
+
+    @property
+    def suffix(self) -> str:
+        return f".{self.size}{self.mode.lower()}q{self.quality}.jpg"
+
+
+def preprocessed_path(path: str, input_format: InputFormat) -> str:
+    """Returns the path of the preprocessed version of an input file
+
+    It is placed next to the original and shares its name up to the first dot, so
+    it is removed together with the blob of the original.
+    """
+    folder, name = os.path.split(path)
+    return os.path.join(folder, name.split(".", 1)[0] + input_format.suffix)
+
+
+def preprocess(path: str, input_format: InputFormat) -> str:
+    """Creates the preprocessed version of an input file
+
+    Runs in the worker processes of the pool. Inputs that are already small enough
+    and in the right mode are left as they are.
+
+    Args:
+        path: Path of the original input file
+        input_format: The format to convert the input to
+
+    Returns:
+        The path of the file to send to the model server
+    """
+    target = preprocessed_path(path, input_format)
+    if os.path.exists(target):
+        return target
+
+    with Image.open(path) as image:
+        scale = input_format.size / min(image.size)
+        if scale >= 1 and image.mode == input_format.mode:
+            return path
+
+        size = image.size
+        if scale < 1:
+            size = (round(image.width * scale), round(image.height * scale))
+            # Lets the JPEG decoder skip most of the work for large reductions
+            image.draft(input_format.mode, size)
+        converted = image.convert(input_format.mode)
+        if converted.size != size:
+            converted = converted.resize(size, Image.Resampling.LANCZOS, reducing_gap=3)
+
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(target), suffix=".jpg", delete=False
+    ) as temp:
+        converted.save(temp, "JPEG", quality=input_format.quality)
+    os.replace(temp.name, target)
+    return target
+
+
+class _PreprocessingState:
+    def __init__(self, app: Flask):
+        self.enabled: bool = app.config["PREPROCESS_ENABLED"]
+        self.workers: int = app.config["PREPROCESS_WORKERS"]
+        # Started on first use, so processes without preprocessed models pay nothing
+        self.pool: ProcessPoolExecutor | None = None
+        self.lock = threading.Lock()
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default preprocessing configuration of the app"""
+    app.config.setdefault("PREPROCESS_ENABLED", True)
+    app.config.setdefault("PREPROCESS_WORKERS", os.cpu_count() or 1)
+
+    app.extensions["preprocessing"] = _PreprocessingState(app)
+
+
+def _get_state() -> _PreprocessingState:
+    return current_app.extensions["preprocessing"]
+
+
+def _pool(state: _PreprocessingState) -> ProcessPoolExecutor:
+    with state.lock:
+        if state.pool is None:
+            # Forking would copy the locks of the running dispatcher threads
+            state.pool = ProcessPoolExecutor(
+                state.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return state.pool
+
+
+def _discard(state: _PreprocessingState, pool: ProcessPoolExecutor) -> None:
+    """Drops a broken pool so that the next call starts a new one"""
+    with state.lock:
+        if state.pool is not pool:
+            return
+        state.pool = None
+    logger.warning("Preprocessing pool broke, starting a new one")
+    pool.shutdown(wait=False)
+
+
+def _submit(
+    input_format: InputFormat, input_paths: list[str]
+) -> tuple[ProcessPoolExecutor, list[str | Future]]:
+    state = _get_state()
+    pool = _pool(state)
+    results = []
+    for path in input_paths:
+        target = preprocessed_path(path, input_format)
+        if os.path.exists(target):
+            results.append(target)
+            continue
+        try:
+            results.append(pool.submit(preprocess, path, input_format))
+        except BrokenProcessPool:
+            _discard(state, pool)
+            pool = _pool(state)
+            results.append(pool.submit(preprocess, path, input_format))
+    return pool, results
+
+
+def _result(pool: ProcessPoolExecutor, future: Future, path: str) -> str:
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        _discard(_get_state(), pool)
+        logger.exception("Could not preprocess %s, sending the original", path)
+        return path
+    except Exception:
+        logger.exception("Could not preprocess %s, sending the original", path)
+        return path
+
+
+def prepare(input_format: InputFormat | None, input_paths: list[str]) -> list[str]:
+    """Returns the paths of the inputs to send to the model server
+
+    Missing preprocessed inputs are created in the process pool. Inputs that
+    cannot be preprocessed are sent as they are. A pool that broke, e.g. because
+    a worker process was killed, is replaced by a new one.
+
+    Args:
+        input_format: The input format of the model or None
+        input_paths: Paths of the original input files
+    """
+    if input_format is None or not _get_state().enabled:
+        return input_paths
+
+    pool, results = _submit(input_format, input_paths)
+    return [
+        _result(pool, result, path) if isinstance(result, Future) else result
+        for result, path in zip(results, input_paths)
+    ]
+
+
+async def prepare_async(
+    input_format: InputFormat | None, input_paths: list[str]
+) -> list[str]:
+    """Same as :func:`prepare`, but waits for the pool without blocking a thread"""
+    if input_format is None or not _get_state().enabled:
+        return input_paths
+
+    pool, results = _submit(input_format, input_paths)
+    futures = [result for result in results if isinstance(result, Future)]
+    if futures:
+        await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+    return [
+        _result(pool, result, path) if isinstance(result, Future) else result
+        for result, path in zip(results, input_paths)
+    ]
+
+
+def shutdown() -> None:
+    """Stops the worker processes of the pool"""
+    state = _get_state()
+    with state.lock:
+        if state.pool is not None:
+            state.pool.shutdown()
+            state.pool = None
@@ -0,0 +1,170 @@
+"""Per process cache of the authenticated users and sources
+
+Every HTTP request of a logged in user needs its principal, including status polls
+and uploaded files. Principals are kept in a size bounded LRU for
+``PRINCIPAL_CACHE_TTL`` seconds, so most requests are answered without a query.
+Entries are dropped as soon as a session commits changes to, or the deletion of,
+their ``User`` or ``Source``. Other processes see such changes once their entries
+expire. Bulk statements bypass the session events, call ``invalidate`` after them.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from flask import Flask, current_app, has_app_context
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Role, Source, User
+
+_CHANGES_KEY = "principal_cache_changes"
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The columns of a user or source that identify and authorize it"""
+
+    public_id: uuid.UUID
+    name: str
+    role: Role
+    # The owning user of a source, None for users
+    owner_id: uuid.UUID | None = None
+    # The version of the source that its valid API tokens were issued for
+    token_version: int = 0
+
+    @property
+    def user_id(self) -> uuid.UUID:
+        """The user that requests of the principal belong to"""
+        return self.owner_id or self.public_id
+
+
+class _PrincipalCacheState:
+    def __init__(self, app: Flask):
+        self.ttl: float = app.config["PRINCIPAL_CACHE_TTL"]
+        self.size: int = app.config["PRINCIPAL_CACHE_SIZE"]
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple[str, uuid.UUID], tuple[Principal, float]] = (
+            OrderedDict()
+        )
+        # Increased by every invalidation, so loads that raced one are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default cache configuration of the app"""
+    # Seconds a principal is used without reading it again
+    app.config.setdefault("PRINCIPAL_CACHE_TTL", 60)
+    app.config.setdefault("PRINCIPAL_CACHE_SIZE", 10_000)
+
+    app.extensions["principal_cache"] = _PrincipalCacheState(app)
+
+
+def _get_state() -> _PrincipalCacheState:
+    return current_app.extensions["principal_cache"]
+
+
+def get_user(public_id: uuid.UUID) -> Principal | None:
+    """Returns the principal of a user, None if it does not exist"""
+    return _get("user", public_id)
+
+
+def get_source(public_id: uuid.UUID) -> Principal | None:
+    """Returns the principal of a source, None if it does not exist"""
+    return _get("source", public_id)
+
+
+def invalidate(public_id: uuid.UUID) -> None:
+    """Drops the cached principal of a user or source"""
+    state = _get_state()
+    with state.lock:
+        state.entries.pop(("user", public_id), None)
+        state.entries.pop(("source", public_id), None)
+        state.generation += 1
+        state.invalidations += 1
+
+
+def stats() -> dict:
+    """Returns the hit rate and the number of cached principals"""
+    state = _get_state()
+    with state.lock:
+        lookups = state.hits + state.misses
+        return {
+            "size": len(state.entries),
+            "hits": state.hits,
+            "misses": state.misses,
+            "hit_rate": state.hits / lookups if lookups else 0.0,
+            "invalidations": state.invalidations,
+        }
+
+
+def _get(kind: str, public_id: uuid.UUID) -> Principal | None:
+    state = _get_state()
+    key = (kind, public_id)
+    now = time.monotonic()
+    with state.lock:
+        entry = state.entries.get(key)
+        if entry is not None and entry[1] > now:
+            state.entries.move_to_end(key)
+            state.hits += 1
+            return entry[0]
+        state.misses += 1
+        generation = state.generation
+
+    principal = _load(kind, public_id)
+    if principal is None:
+        return None
+
+    with state.lock:
+        if state.generation == generation:
+            state.entries[key] = (principal, now + state.ttl)
+            state.entries.move_to_end(key)
+            while len(state.entries) > state.size:
+                state.entries.popitem(last=False)
+    return principal
+
+
+def _load(kind: str, public_id: uuid.UUID) -> Principal | None:
+    if kind == "user":
+        query = select(User.public_id, User.name, User.role).where(
+            User.public_id == public_id
+        )
+    else:
+        query = select(
+            Source.public_id,
+            Source.name,
+            Source.role,
+            Source.owner_id,
+            Source.token_version,
+        ).where(Source.public_id == public_id)
+    row = db.session.execute(query).one_or_none()
+    return None if row is None else Principal(*row)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    for obj in (*session.dirty, *session.deleted):
+        if isinstance(obj, (User, Source)):
+            session.info.setdefault(_CHANGES_KEY, set()).add(obj.public_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changes(session: Session) -> None:
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if not changes or not has_app_context():
+        return
+    if "principal_cache" not in current_app.extensions:
+        return
+    for public_id in changes:
+        invalidate(public_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session) -> None:
+    session.info.pop(_CHANGES_KEY, None)
@@ -0,0 +1,317 @@
+"""Rate limits and daily quotas of uploads
+
+Uploads take tokens from token buckets: one per user or source, with the rate and
+burst of its role (``RATE_LIMITS``), one per model (``RATE_LIMIT_MODEL``, or
+``RATE_LIMIT_MODELS`` by server model name) and two per user or source for the daily
+requests and bytes of its role (``RATE_LIMIT_QUOTAS``). Quotas are buckets that are
+not refilled and start over every UTC day. A batch takes one token per image from
+all buckets at once, or none if one of them is short.
+
+The buckets are kept in memory by default, so every web server process enforces the
+limits on its own. With ``RATE_LIMIT_BACKEND="database"`` the processes share them
+in the ``rate_limit`` table, at the cost of a few statements per upload. Setting
+``RATE_LIMIT_BACKEND`` to None disables the limits.
+"""
+
+import threading
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from flask import Flask, current_app
+from sqlalchemy import case, delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import db
+from .models import RateLimit, Role
+from .principal_cache import Principal
+
+# Insert statements with ON CONFLICT support, by dialect name
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+DAY = 24 * 60 * 60
+# Checks between removals of buckets that are full or of a past day
+_PRUNE_INTERVAL = 1000
+
+_MESSAGES = {
+    "principal": "Too many uploads, try again later",
+    "model": "Too many uploads for this model, try again later",
+    "quota": "Daily upload quota exceeded",
+}
+
+
+class RateLimited(Exception):
+    """Raised when uploads exceed a rate limit or quota
+
+    Args:
+        message: The limit that was exceeded
+        retry_after: Seconds until the uploads would be accepted, None if they
+            never would be
+    """
+
+    def __init__(self, message: str, retry_after: float | None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Limit(NamedTuple):
+    """Tokens to take from a bucket, which is full while it is not stored"""
+
+    # A tuple, which is cheaper to build and hash than a string
+    key: tuple
+    cost: float
+    # Tokens added per second, up to burst
+    rate: float
+    burst: float
+    # One of principal, model or quota
+    kind: str
+
+    def expires_at(self, tokens: float, now: float) -> float:
+        """Returns when the bucket does not need to be stored anymore"""
+        if self.rate == 0:
+            # The key of a quota contains its day
+            return (now // DAY + 1) * DAY
+        return now + (self.burst - tokens) / self.rate
+
+    def retry_after(self, tokens: float, now: float) -> float | None:
+        """Returns the seconds until the bucket holds enough tokens"""
+        if self.cost > self.burst:
+            return None
+        if self.rate == 0:
+            return self.expires_at(tokens, now) - now
+        return (self.cost - tokens) / self.rate
+
+
+class MemoryStore:
+    """Buckets of the current process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Tokens, update time and expiry by key
+        self.buckets: dict[tuple, tuple[float, float, float]] = {}
+        self.checks = 0
+
+    def take(self, limits: list[Limit], now: float) -> tuple[Limit, float] | None:
+        """Takes the tokens of all limits or, if one bucket is short, none
+
+        Returns:
+            None if the tokens were taken, otherwise the first short limit and the
+            tokens of its bucket
+        """
+        with self.lock:
+            buckets = self.buckets
+            remaining = []
+            for limit in limits:
+                bucket = buckets.get(limit.key)
+                if bucket is None:
+                    tokens = limit.burst
+                else:
+                    tokens = bucket[0] + (now - bucket[1]) * limit.rate
+                    if tokens > limit.burst:
+                        tokens = limit.burst
+                if tokens < limit.cost:
+                    return limit, tokens
+                remaining.append(tokens - limit.cost)
+
+            for limit, tokens in zip(limits, remaining):
+                buckets[limit.key] = (tokens, now, limit.expires_at(tokens, now))
+
+            self.checks += 1
+            if self.checks % _PRUNE_INTERVAL == 0:
+                self.buckets = {
+                    key: bucket
+                    for key, bucket in self.buckets.items()
+                    if bucket[2] > now
+                }
+        return None
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class DatabaseStore:
+    """Buckets in the ``rate_limit`` table, shared by all processes
+
+    Each bucket is updated with a conditional statement, so concurrent processes
+    never take more tokens than it holds. The current session is committed after
+    the tokens are taken, and rolled back if a bucket is short.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checks = 0
+
+    def take(self, limits: list[Limit], now: float) -> tuple[Limit, float] | None:
+        """Takes the tokens of all limits or, if one bucket is short, none
+
+        Returns:
+            None if the tokens were taken, otherwise the first short limit and the
+            tokens of its bucket
+        """
+        keys = [":".join(map(str, limit.key)) for limit in limits]
+        self._add_missing(limits, keys, now)
+        for limit, key in zip(limits, keys):
+            refilled = RateLimit.tokens + (now - RateLimit.updated_at) * limit.rate
+            tokens = case((refilled > limit.burst, limit.burst), else_=refilled)
+            if limit.rate == 0:
+                expires_at = limit.expires_at(0, now)
+            else:
+                expires_at = now + (limit.burst - tokens + limit.cost) / limit.rate
+            result = db.session.execute(
+                update(RateLimit)
+                .where(RateLimit.key == key, tokens >= limit.cost)
+                .values(
+                    tokens=tokens - limit.cost, updated_at=now, expires_at=expires_at
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 0:
+                available = db.session.scalar(
+                    select(tokens).where(RateLimit.key == key)
+                )
+                db.session.rollback()
+                return limit, available or 0.0
+
+        with self.lock:
+            self.checks += 1
+            prune = self.checks % _PRUNE_INTERVAL == 0
+        if prune:
+            db.session.execute(delete(RateLimit).where(RateLimit.expires_at <= now))
+        db.session.commit()
+        return None
+
+    def _add_missing(self, limits: list[Limit], keys: list[str], now: float) -> None:
+        rows = [
+            {
+                "key": key,
+                "tokens": limit.burst,
+                "updated_at": now,
+                "expires_at": limit.expires_at(limit.burst, now),
+            }
+            for limit, key in zip(limits, keys)
+        ]
+        insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+        if insert is not None:
+            db.session.execute(insert(RateLimit).on_conflict_do_nothing(), rows)
+            return
+
+        # Without upserts concurrent first uploads may conflict
+        stored = set(
+            db.session.scalars(
+                select(RateLimit.key).where(
+                    RateLimit.key.in_([row["key"] for row in rows])
+                )
+            )
+        )
+        db.session.add_all(RateLimit(**row) for row in rows if row["key"] not in stored)
+        db.session.flush()
+
+
+_STORES = {"memory": MemoryStore, "database": DatabaseStore}
+
+
+class _RateLimitState:
+    def __init__(self, app: Flask):
+        backend = app.config["RATE_LIMIT_BACKEND"]
+        self.store = _STORES[backend]() if backend else None
+        self.limits: dict[Role, tuple[float, float]] = {
+            Role[name]: tuple(limit)
+            for name, limit in app.config["RATE_LIMITS"].items()
+        }
+        model_limit = app.config["RATE_LIMIT_MODEL"]
+        self.model_limit = tuple(model_limit) if model_limit else None
+        self.model_limits: dict[str, tuple[float, float]] = {
+            key: tuple(limit) for key, limit in app.config["RATE_LIMIT_MODELS"].items()
+        }
+        self.quotas: dict[Role, tuple[int, int]] = {
+            Role[name]: tuple(quota)
+            for name, quota in app.config["RATE_LIMIT_QUOTAS"].items()
+        }
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected: Counter[str] = Counter()
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default rate limit configuration of the app"""
+    # "memory" per process, "database" shared by all processes, None to disable
+    app.config.setdefault("RATE_LIMIT_BACKEND", "memory")
+    # Uploads per second and burst by role name, roles without one are unlimited.
+    # The burst also limits the size of a batch.
+    app.config.setdefault("RATE_LIMITS", {"USER1": (10, 1000), "SOURCE": (100, 5000)})
+    # Uploads per second and burst of every model, and by server model name
+    app.config.setdefault("RATE_LIMIT_MODEL", (200, 10_000))
+    app.config.setdefault("RATE_LIMIT_MODELS", {})
+    # Uploaded requests and bytes per UTC day by role name
+    app.config.setdefault(
+        "RATE_LIMIT_QUOTAS",
+        {"USER1": (10_000, 2 * 1024**3), "SOURCE": (200_000, 20 * 1024**3)},
+    )
+
+    app.extensions["rate_limits"] = _RateLimitState(app)
+
+
+def _get_state() -> _RateLimitState:
+    return current_app.extensions["rate_limits"]
+
+
+def check(principal: Principal, model_key: str, count: int = 1, size: int = 0) -> None:
+    """Takes the tokens for uploads of a user or source, or none if one is short
+
+    With the database backend the current session is committed, call this before
+    adding anything to it.
+
+    Args:
+        principal: The uploading user or source
+        model_key: The server model name of the model the uploads are for
+        count: The number of uploaded images
+        size: The number of uploaded bytes
+
+    Raises:
+        RateLimited: If a limit or quota is exceeded
+    """
+    state = _get_state()
+    if state.store is None:
+        return
+
+    now = time.time()
+    limits = []
+    limit = state.limits.get(principal.role)
+    if limit is not None:
+        key = ("principal", principal.public_id.int)
+        limits.append(Limit(key, count, *limit, "principal"))
+    limit = state.model_limits.get(model_key, state.model_limit)
+    if limit is not None:
+        limits.append(Limit(("model", model_key), count, *limit, "model"))
+    quota = state.quotas.get(principal.role)
+    if quota is not None:
+        day = int(now // DAY)
+        requests, size_quota = quota
+        key = ("requests", day, principal.public_id.int)
+        limits.append(Limit(key, count, 0, requests, "quota"))
+        key = ("bytes", day, principal.public_id.int)
+        limits.append(Limit(key, size, 0, size_quota, "quota"))
+
+    short = state.store.take(limits, now) if limits else None
+    with state.lock:
+        if short is None:
+            state.accepted += 1
+            return
+        limit, tokens = short
+        state.rejected[limit.kind] += 1
+    raise RateLimited(_MESSAGES[limit.kind], limit.retry_after(tokens, now))
+
+
+def stats() -> dict:
+    """Returns the number of accepted and, by limit, rejected uploads"""
+    state = _get_state()
+    with state.lock:
+        return {
+            "backend": current_app.config["RATE_LIMIT_BACKEND"],
+            # Shared buckets are not counted
+            "buckets": (
+                len(state.store) if isinstance(state.store, MemoryStore) else None
+            ),
+            "accepted": state.accepted,
+            "rejected": dict(state.rejected),
+        }
@@ -1,33 +1,267 @@
+import asyncio
+from dataclasses import dataclass
 from flask import current_app
 import os
-import requests
+import uuid
+from typing import Any
+from sqlalchemy import select
 
-from . import db
+from . import (
+    async_model_client,
+    db,
+    deadlines,
+    model_client,
+    preprocessing,
+    result_cache,
+    status_writer,
+)
+from .cancellation import Cancelled
+from .job_queue import lease_expiry
+from .model_client import DeadlineExceeded
 from .models import Request, RequestStatus
+from .preprocessing import InputFormat
+from .status_writer import Transition
+
+# Statuses of requests that are not done, before they are marked as running
+QUEUED = (RequestStatus.PENDING, RequestStatus.RUNNING)
+
+
+@dataclass
+class Batch:
+    """Requests for the same model that are sent to the model server together"""
+
+    model_key: str
+    input_format: InputFormat | None
+    request_ids: list[uuid.UUID]
+    input_paths: list[str]
+    # Seconds since the epoch after which none of the requests needs an answer
+    deadline: float | None = None
 
 
 def process_request(request_id: str) -> None:
-    """Handles the predictions of an ai request. The request is loaded from the database an then the model is run
+    """Handles the predictions of a single ai request
 
     Args:
         request_id: The public_id of the request to process
+    """
+    process_requests([request_id])
 
-    Returns:
-        A list of predictions
+
+def process_requests(request_ids: list[uuid.UUID]) -> None:
+    """Handles the predictions of a batch of ai requests for the same model.
+
+    The requests are loaded from the database and their inputs are sent to the
+    model server in a single call. If any step fails, e.g. the model server does
+    not answer before the latest deadline of the requests, the requests that are
+    not finished yet are marked as failed and the error is raised again. Requests
+    that are paused or deleted in the meantime keep their status. Cancelling the
+    token of the batch aborts the model server call, see :mod:`.cancellation`.
+
+    Args:
+        request_ids: The public_ids of the requests to process
+    """
+    batch = start_batch(request_ids)
+    if batch is None:
+        return
+
+    try:
+        input_paths = preprocessing.prepare(batch.input_format, batch.input_paths)
+        outputs = model_client.predict(batch.model_key, input_paths, batch.deadline)
+        finish_batch(batch.request_ids, outputs)
+    except Cancelled:
+        raise
+    except Exception as e:
+        _fail(batch, e)
+        raise
+
+
+async def process_requests_async(request_ids: list[uuid.UUID]) -> None:
+    """Same as :func:`process_requests`, but waits for the model server without
+    blocking a thread.
+
+    Database work runs in the default executor, each step in its own app context
+    so that concurrent batches do not share a session.
+
+    Args:
+        request_ids: The public_ids of the requests to process
     """
-    request = db.session.get(Request, request_id)
-    if not request:
+    batch = await _in_app_context(start_batch, request_ids)
+    if batch is None:
         return
 
-    request.status = RequestStatus.RUNNING
+    try:
+        input_paths = await preprocessing.prepare_async(
+            batch.input_format, batch.input_paths
+        )
+        outputs = await async_model_client.predict(
+            batch.model_key, input_paths, batch.deadline
+        )
+        await _in_app_context(finish_batch, batch.request_ids, outputs)
+    except Cancelled:
+        raise
+    except Exception as e:
+        await _in_app_context(_fail, batch, e)
+        raise
+
+
+def _fail(batch: Batch, error: Exception) -> None:
+    # The error may have left the session in a failed transaction
+    db.session.rollback()
+    if isinstance(error, DeadlineExceeded):
+        deadlines.record(deadlines.TIMED_OUT, batch.model_key, len(batch.request_ids))
+    fail_batch(batch.request_ids)
+
+
+async def _in_app_context(func, *args):
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return func(*args)
+
+    return await asyncio.to_thread(run)
+
+
+def start_batch(request_ids: list[uuid.UUID]) -> Batch | None:
+    """Marks the requests that still need processing as running
+
+    Requests that cannot be answered before their deadline anymore are marked as
+    failed instead, see :func:`.deadlines.shed_late`.
+
+    Args:
+        request_ids: The public_ids of the requests to process
+
+    Returns:
+        The requests to process or None if none of them needs processing
+    """
+    batch = db.session.scalars(
+        select(Request).where(
+            Request.public_id.in_(request_ids),
+            Request.status.in_(QUEUED),
+        )
+    ).all()
+    if not batch:
+        return None
+
+    # Inputs that were processed since they were queued need no prediction
+    cached = {}
+    for request in batch:
+        if request.input_hash is not None:
+            output = result_cache.lookup(request.model, request.input_hash)
+            if output is not None:
+                cached[request.public_id] = output
+    if cached:
+        finish_batch(list(cached), list(cached.values()), store=False, origins=QUEUED)
+        batch = [request for request in batch if request.public_id not in cached]
+        if not batch:
+            return None
+
+    model = batch[0].model
+    model_key = model.server_model_name
+    input_format = InputFormat.of(model)
+    late = deadlines.shed_late(batch, model_key)
+    transitions = [
+        Transition(
+            request.public_id, request.user_id, RequestStatus.FAILED, origins=QUEUED
+        )
+        for request in late
+    ]
+    batch = [request for request in batch if request not in late]
+
+    request_ids = [request.public_id for request in batch]
+    input_paths = [
+        os.path.join(current_app.config["UPLOAD_FOLDER"], request.input_file)
+        for request in batch
+    ]
+    deadline = None
+    if batch and all(request.deadline is not None for request in batch):
+        deadline = deadlines.timestamp(max(request.deadline for request in batch))
+
+    transitions += [
+        Transition(
+            request.public_id, request.user_id, RequestStatus.RUNNING, lease_expiry()
+        )
+        for request in batch
+    ]
+    # Committing returns the connection, so it is not held during the prediction
     db.session.commit()
+    # The prediction does not wait for the new status, the writer keeps the order
+    status_writer.submit(transitions, wait=False)
 
-    input_path = os.path.join(current_app.config["UPLOAD_FOLDER"], request.input_file)
-    prediction_url = f"http://multi-model-server:8080/predictions/{request.model.server_model_name}"
+    if not batch:
+        return None
+    return Batch(model_key, input_format, request_ids, input_paths, deadline)
 
-    with open(input_path, "rb") as file:
-        response = requests.post(prediction_url, data=file).json()
 
-    request.status = RequestStatus.FINISHED
-    request.output = response
+def finish_batch(
+    request_ids: list[uuid.UUID],
+    outputs: list[Any],
+    store: bool = True,
+    origins: tuple[RequestStatus, ...] | None = None,
+) -> None:
+    """Stores the predictions of the requests and marks them as finished
+
+    Requests that were paused, deleted or failed while they were processed are
+    skipped, as are requests that were resumed in the meantime.
+
+    Args:
+        request_ids: The public_ids of the processed requests
+        outputs: The prediction of each request
+        store: Whether to add the predictions to the result cache
+        origins: The statuses the requests may have, by default only running
+            requests are finished
+    """
+    requests = _load(request_ids)
+    transitions = []
+    # Outputs to cache by model and input hash
+    finished = {}
+    for request_id, output in zip(request_ids, outputs, strict=True):
+        request = requests.get(request_id)
+        if request is None:
+            continue
+        transitions.append(
+            Transition(
+                request_id,
+                request.user_id,
+                RequestStatus.FINISHED,
+                output=output,
+                origins=origins,
+            )
+        )
+        if request.input_hash is not None:
+            finished.setdefault(request.model, {})[request.input_hash] = output
+    _wait_for_writer(transitions)
+
+    if store:
+        for model, cached in finished.items():
+            result_cache.store_many(model, cached)
+
+
+def fail_batch(request_ids: list[uuid.UUID]) -> None:
+    """Marks the requests as failed, except those paused or deleted meanwhile"""
+    requests = _load(request_ids)
+    _wait_for_writer(
+        [
+            Transition(request_id, request.user_id, RequestStatus.FAILED)
+            for request_id, request in requests.items()
+        ]
+    )
+
+
+def _wait_for_writer(transitions: list[Transition]) -> None:
+    # Returns the connection, which the writer may need while this waits. The
+    # loaded requests are expired as well, so they are reloaded with what the
+    # writer committed.
     db.session.commit()
+    status_writer.submit(transitions)
+
+
+def _load(request_ids: list[uuid.UUID]) -> dict[uuid.UUID, Request]:
+    """Loads the requests that are still queued or running"""
+    requests = db.session.scalars(
+        select(Request).where(
+            Request.public_id.in_(request_ids),
+            Request.status.in_(QUEUED),
+        )
+    )
+    return {request.public_id: request for request in requests}
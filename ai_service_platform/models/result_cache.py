@@ -0,0 +1,338 @@
+"""Content addressed cache of inference results
+
+Results are keyed on the model, its revision and the SHA-256 hash of the input.
+A size bounded in-memory LRU sits in front of the ``inference_result`` table, which
+is trimmed to a maximum total size by evicting the least recently used entries.
+Redeploying a model increases ``Model.revision``, so older results are never hit
+again, even by other processes that still hold them in memory.
+"""
+
+import hashlib
+import json
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from typing import IO, Any
+
+from flask import Flask, current_app
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import db
+from .models import InferenceResult, Model, utcnow
+
+CacheKey = tuple[uuid.UUID, int, str]
+
+# Insert statements with ON CONFLICT support, by dialect name
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def hash_file(file: IO[bytes]) -> str:
+    """Returns the hex SHA-256 digest of a binary file"""
+    return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+class _LRU:
+    """Thread safe LRU mapping that is bounded by the summed size of its values"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[CacheKey, tuple[Any, int]] = OrderedDict()
+
+    def get(self, key: CacheKey) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: CacheKey, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def remove_model(self, model_id: uuid.UUID) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_id]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _CacheState:
+    def __init__(self, app: Flask):
+        self.enabled: bool = app.config["RESULT_CACHE_ENABLED"]
+        self.db_max_bytes: int = app.config["RESULT_CACHE_DB_BYTES"]
+        self.evict_interval: int = app.config["RESULT_CACHE_EVICT_INTERVAL"]
+        self.touch_interval = timedelta(
+            seconds=app.config["RESULT_CACHE_TOUCH_INTERVAL"]
+        )
+        self.memory = _LRU(app.config["RESULT_CACHE_MEMORY_BYTES"])
+
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default cache configuration and creates the memory tier"""
+    app.config.setdefault("RESULT_CACHE_ENABLED", True)
+    app.config.setdefault("RESULT_CACHE_MEMORY_BYTES", 16 * 1024 * 1024)
+    app.config.setdefault("RESULT_CACHE_DB_BYTES", 256 * 1024 * 1024)
+    # Number of stored results between two checks of the table size
+    app.config.setdefault("RESULT_CACHE_EVICT_INTERVAL", 100)
+    # Seconds before the last use of a result in the table is updated again
+    app.config.setdefault("RESULT_CACHE_TOUCH_INTERVAL", 600)
+
+    app.extensions["result_cache"] = _CacheState(app)
+
+
+def _get_state() -> _CacheState:
+    return current_app.extensions["result_cache"]
+
+
+def _touch(state: _CacheState, result: InferenceResult) -> bool:
+    """Updates the last use of a result unless it was updated recently"""
+    now = utcnow()
+    if result.last_used_at > now - state.touch_interval:
+        return False
+    result.last_used_at = now
+    return True
+
+
+def lookup(model: Model, input_hash: str) -> Any | None:
+    """Looks up the output of a model for an input
+
+    Args:
+        model: The model that should process the input
+        input_hash: The hex SHA-256 digest of the input
+
+    Returns:
+        The cached output or None
+    """
+    state = _get_state()
+    if not state.enabled:
+        return None
+
+    key = (model.public_id, model.revision, input_hash)
+    output = state.memory.get(key)
+    if output is not None:
+        with state.lock:
+            state.memory_hits += 1
+        return output
+
+    result = db.session.get(InferenceResult, key)
+    if result is None:
+        with state.lock:
+            state.misses += 1
+        return None
+
+    if _touch(state, result):
+        db.session.commit()
+    state.memory.put(key, result.output, result.size)
+    with state.lock:
+        state.db_hits += 1
+    return result.output
+
+
+def lookup_many(model: Model, input_hashes: list[str]) -> dict[str, Any]:
+    """Looks up the outputs of a model for many inputs with at most one query
+
+    Unlike :func:`lookup`, the last use of results found in the table is updated
+    in the session but not committed. Like there, it is only updated once per
+    ``RESULT_CACHE_TOUCH_INTERVAL``.
+
+    Args:
+        model: The model that should process the inputs
+        input_hashes: The hex SHA-256 digests of the inputs
+
+    Returns:
+        The cached outputs by input hash, inputs without one are left out
+    """
+    state = _get_state()
+    if not state.enabled:
+        return {}
+
+    outputs = {}
+    for input_hash in set(input_hashes):
+        output = state.memory.get((model.public_id, model.revision, input_hash))
+        if output is not None:
+            outputs[input_hash] = output
+    memory_hits = len(outputs)
+
+    missing = set(input_hashes) - outputs.keys()
+    if missing:
+        found = db.session.scalars(
+            select(InferenceResult).where(
+                InferenceResult.model_id == model.public_id,
+                InferenceResult.revision == model.revision,
+                InferenceResult.input_hash.in_(missing),
+            )
+        )
+        for result in found:
+            _touch(state, result)
+            key = (model.public_id, model.revision, result.input_hash)
+            state.memory.put(key, result.output, result.size)
+            outputs[result.input_hash] = result.output
+
+    with state.lock:
+        state.memory_hits += memory_hits
+        state.db_hits += len(outputs) - memory_hits
+        state.misses += len(set(input_hashes)) - len(outputs)
+    return outputs
+
+
+def store(model: Model, input_hash: str, output: Any) -> None:
+    """Stores the output of a model for an input in both tiers
+
+    Args:
+        model: The model that processed the input
+        input_hash: The hex SHA-256 digest of the input
+        output: The JSON serializable output of the model
+    """
+    store_many(model, {input_hash: output})
+
+
+def store_many(model: Model, outputs: dict[str, Any]) -> None:
+    """Stores the outputs of a model for many inputs in both tiers
+
+    The outputs are added to the table with one insert and one commit. Results
+    that were stored meanwhile, e.g. by another worker, are kept as they are.
+
+    Args:
+        model: The model that processed the inputs
+        outputs: The JSON serializable outputs by hex SHA-256 digest of the input
+    """
+    state = _get_state()
+    if not state.enabled or not outputs:
+        return
+
+    now = utcnow()
+    values = []
+    for input_hash, output in outputs.items():
+        size = len(json.dumps(output))
+        state.memory.put((model.public_id, model.revision, input_hash), output, size)
+        values.append(
+            {
+                "model_id": model.public_id,
+                "revision": model.revision,
+                "input_hash": input_hash,
+                "output": output,
+                "size": size,
+                "last_used_at": now,
+            }
+        )
+
+    upsert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert is None:
+        # Without upserts results stored concurrently may conflict
+        stored = db.session.scalars(
+            select(InferenceResult.input_hash).where(
+                InferenceResult.model_id == model.public_id,
+                InferenceResult.revision == model.revision,
+                InferenceResult.input_hash.in_(outputs),
+            )
+        ).all()
+        values = [value for value in values if value["input_hash"] not in stored]
+        if values:
+            db.session.execute(insert(InferenceResult), values)
+    else:
+        db.session.execute(
+            upsert(InferenceResult).on_conflict_do_nothing(
+                index_elements=[
+                    InferenceResult.model_id,
+                    InferenceResult.revision,
+                    InferenceResult.input_hash,
+                ]
+            ),
+            values,
+        )
+    db.session.commit()
+
+    with state.lock:
+        before = state.puts
+        state.puts += len(outputs)
+        check_size = (
+            state.puts // state.evict_interval != before // state.evict_interval
+        )
+    if check_size:
+        evict()
+
+
+def evict() -> None:
+    """Deletes the least recently used results until the table fits its size"""
+    state = _get_state()
+    total = db.session.scalar(select(func.coalesce(func.sum(InferenceResult.size), 0)))
+    excess = total - state.db_max_bytes
+    if excess <= 0:
+        return
+
+    oldest = db.session.execute(
+        select(
+            InferenceResult.model_id,
+            InferenceResult.revision,
+            InferenceResult.input_hash,
+            InferenceResult.size,
+        ).order_by(InferenceResult.last_used_at)
+    )
+    keys = []
+    for model_id, revision, input_hash, size in oldest:
+        keys.append((model_id, revision, input_hash))
+        excess -= size
+        if excess <= 0:
+            break
+    oldest.close()
+
+    for key in keys:
+        db.session.execute(
+            delete(InferenceResult).where(
+                InferenceResult.model_id == key[0],
+                InferenceResult.revision == key[1],
+                InferenceResult.input_hash == key[2],
+            )
+        )
+    db.session.commit()
+    with state.lock:
+        state.evictions += len(keys)
+
+
+def invalidate(model: Model) -> None:
+    """Drops all cached results of a model, e.g. after it was redeployed"""
+    state = _get_state()
+    state.memory.remove_model(model.public_id)
+    db.session.execute(
+        delete(InferenceResult).where(InferenceResult.model_id == model.public_id)
+    )
+    db.session.commit()
+
+
+def stats() -> dict:
+    """Returns hit and miss counters and the size of the memory tier"""
+    state = _get_state()
+    with state.lock:
+        lookups = state.memory_hits + state.db_hits + state.misses
+        return {
+            "memory_hits": state.memory_hits,
+            "db_hits": state.db_hits,
+            "misses": state.misses,
+            "hit_rate": (lookups - state.misses) / lookups if lookups else 0.0,
+            "evictions": state.evictions,
+            "memory_entries": len(state.memory),
+            "memory_bytes": state.memory.bytes,
+        }
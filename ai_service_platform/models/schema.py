@@ -0,0 +1,110 @@
+import pickle
+
+from sqlalchemy import (
+    JSON,
+    Engine,
+    LargeBinary,
+    Uuid,
+    column,
+    insert,
+    inspect,
+    select,
+    table,
+    text,
+    update,
+)
+
+from .models import Base, RequestOutput, summarize
+
+
+def upgrade_schema(engine: Engine) -> None:
+    """Adds columns and indexes that are missing in an existing database
+
+    ``create_all`` only creates missing tables, so databases created by an older
+    version of the app would lack newly added columns. New columns have to be
+    nullable or define a ``server_default`` to be added this way. Columns can set
+    an SQL expression as ``info["backfill"]`` to fill in the existing rows.
+
+    Args:
+        engine: The engine of the database to upgrade
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            backfills = []
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = (
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)}"
+                    f" {column.type.compile(engine.dialect)}"
+                )
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                connection.execute(text(ddl))
+                if "backfill" in column.info:
+                    backfills.append(
+                        f"UPDATE {quote(table.name)} SET {quote(column.name)}"
+                        f" = {column.info['backfill']}"
+                    )
+            # The expressions may use any of the columns added before
+            for backfill in backfills:
+                connection.execute(text(backfill))
+
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def migrate_outputs(engine: Engine, chunk_size: int = 500) -> int:
+    """Moves the pickled outputs of older versions into the ``request_output`` table
+
+    The pickles were written by the app itself, so they are trusted. The column is
+    cleared but not dropped, which SQLite only supports in recent versions.
+
+    Args:
+        engine: The engine of the database to migrate
+        chunk_size: The number of requests migrated per transaction
+
+    Returns:
+        The number of migrated outputs
+    """
+    columns = inspect(engine).get_columns("request")
+    if "output" not in {info["name"] for info in columns}:
+        return 0
+
+    legacy = table(
+        "request",
+        column("public_id", Uuid()),
+        column("output", LargeBinary()),
+        column("summary", JSON()),
+    )
+    migrated = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(legacy.c.public_id, legacy.c.output)
+                .where(legacy.c.output.is_not(None))
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                return migrated
+
+            for public_id, pickled in rows:
+                output = pickle.loads(pickled)
+                connection.execute(
+                    insert(RequestOutput.__table__).values(
+                        request_id=public_id, output=output
+                    )
+                )
+                connection.execute(
+                    update(legacy)
+                    .where(legacy.c.public_id == public_id)
+                    .values(output=None, summary=summarize(output))
+                )
+            migrated += len(rows)
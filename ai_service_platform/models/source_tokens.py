@@ -0,0 +1,140 @@
+"""Signed API tokens of sources
+
+Devices authenticate with a bearer token instead of logging in with the deliberately
+slow password hash. A token names its source, the ``token_version`` of the source it
+was issued for, its expiry and its scopes, and is signed with an HMAC-SHA256 over
+these fields. Verifying a token checks the signature in constant time and reads the
+source from the principal cache, so the hot path neither hashes passwords nor
+queries the database. Increasing ``Source.token_version`` revokes all tokens of a
+source, other processes notice once their cached principal expires.
+
+The signing key is derived from ``SOURCE_TOKEN_SECRET``, or ``SECRET_KEY`` if unset.
+"""
+
+import base64
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+
+from flask import Flask, current_app
+
+from . import principal_cache
+from .models import Source
+from .principal_cache import Principal
+
+# Scopes a token can grant
+UPLOAD = "upload"
+STATUS = "status"
+SCOPES = (UPLOAD, STATUS)
+
+
+class _SourceTokenState:
+    def __init__(self, app: Flask):
+        secret = app.config["SOURCE_TOKEN_SECRET"] or app.config["SECRET_KEY"]
+        # Keeps tokens from being valid signatures of anything else
+        self.key = hashlib.sha256(b"source-token:" + _to_bytes(secret)).digest()
+        self.max_age: int = app.config["SOURCE_TOKEN_MAX_AGE"]
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default token configuration of the app"""
+    app.config.setdefault("SOURCE_TOKEN_SECRET", None)
+    # Seconds a token is valid if the issuer does not ask for less
+    app.config.setdefault("SOURCE_TOKEN_MAX_AGE", 365 * 24 * 3600)
+
+    app.extensions["source_tokens"] = _SourceTokenState(app)
+
+
+def _get_state() -> _SourceTokenState:
+    return current_app.extensions["source_tokens"]
+
+
+def issue(source: Source, scopes: list[str], max_age: int | None = None) -> str:
+    """Creates a token for a source
+
+    Args:
+        source: The source the token authenticates
+        scopes: The scopes granted by the token, see ``SCOPES``
+        max_age: Seconds until the token expires, at most ``SOURCE_TOKEN_MAX_AGE``
+
+    Raises:
+        ValueError: If a scope is unknown or no scope is given
+    """
+    state = _get_state()
+    if not scopes or any(scope not in SCOPES for scope in scopes):
+        raise ValueError(f"Scopes must be some of {', '.join(SCOPES)}")
+    if max_age is None or max_age > state.max_age:
+        max_age = state.max_age
+
+    expires = int(time.time()) + max_age
+    payload = f"{source.public_id.hex}.{source.token_version}.{expires}."
+    payload += ",".join(sorted(set(scopes)))
+    with state.lock:
+        state.issued += 1
+    return f"{payload}.{_sign(state.key, payload)}"
+
+
+def verify(token: str, scope: str) -> Principal | None:
+    """Returns the source authenticated by a token, None if it is not valid
+
+    A token is valid if its signature matches, it has not expired, grants
+    ``scope`` and was issued for the current ``token_version`` of its source.
+    """
+    state = _get_state()
+    principal = _verify(state, token, scope)
+    with state.lock:
+        if principal is None:
+            state.rejected += 1
+        else:
+            state.verified += 1
+    return principal
+
+
+def revoke(source: Source) -> None:
+    """Invalidates all tokens of a source, takes effect on commit"""
+    source.token_version += 1
+
+
+def stats() -> dict:
+    """Returns the number of tokens issued, verified and rejected"""
+    state = _get_state()
+    with state.lock:
+        return {
+            "issued": state.issued,
+            "verified": state.verified,
+            "rejected": state.rejected,
+        }
+
+
+def _verify(state: _SourceTokenState, token: str, scope: str) -> Principal | None:
+    payload, _, signature = token.rpartition(".")
+    # compare_digest only takes ASCII strings
+    if not token.isascii():
+        return None
+    if not hmac.compare_digest(_sign(state.key, payload), signature):
+        return None
+
+    # The signature proves that the fields were written by issue
+    source_id, version, expires, scopes = payload.split(".")
+    if int(expires) < time.time() or scope not in scopes.split(","):
+        return None
+
+    principal = principal_cache.get_source(uuid.UUID(hex=source_id))
+    if principal is None or principal.token_version != int(version):
+        return None
+    return principal
+
+
+def _sign(key: bytes, payload: str) -> str:
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def _to_bytes(secret: str | bytes) -> bytes:
+    return secret if isinstance(secret, bytes) else secret.encode()
@@ -0,0 +1,157 @@
+"""In-process publish/subscribe of request status changes
+
+The request handler publishes every status change after it is committed. Open
+request lists subscribe to the changes of their user and receive them over a single
+server-sent events connection, instead of polling each request separately.
+
+Only changes made in the same process are delivered, so push is enabled by default
+only if the dispatcher is embedded into the web app. Subscribers that do not keep
+up lose events; the request list still polls slowly to catch up with those. Each
+subscriber holds a thread of the WSGI server, so only ``STATUS_PUSH_MAX_STREAMS``
+of them are admitted at once.
+"""
+
+import queue
+import threading
+import uuid
+from dataclasses import dataclass
+
+from flask import Flask, current_app
+
+from .models import RequestStatus
+
+
+class TooManyStreams(Exception):
+    """Raised when a subscriber would exceed ``STATUS_PUSH_MAX_STREAMS``"""
+
+
+@dataclass(frozen=True)
+class StatusEvent:
+    """A request that changed its status"""
+
+    user_id: uuid.UUID
+    public_id: uuid.UUID
+    status: RequestStatus
+
+
+class Subscription:
+    """The status events a subscriber has not received yet
+
+    Args:
+        user_id: The user whose events are delivered, None for the events of all
+            users
+        max_size: The maximum number of undelivered events
+    """
+
+    def __init__(self, state: "_StatusEventState", user_id, max_size: int):
+        self.user_id = user_id
+        self._state = state
+        self._events: queue.Queue[StatusEvent] = queue.Queue(max_size)
+
+    def get(self, timeout: float) -> StatusEvent | None:
+        """Waits for the next event, returns None if none arrived in time"""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        """Stops the delivery of events"""
+        with self._state.lock:
+            self._state.subscriptions.discard(self)
+
+    def _put(self, event: StatusEvent) -> bool:
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+
+class _StatusEventState:
+    def __init__(self, app: Flask):
+        self.max_size: int = app.config["STATUS_PUSH_QUEUE_SIZE"]
+        self.max_streams: int = app.config["STATUS_PUSH_MAX_STREAMS"]
+        self.lock = threading.Lock()
+        self.subscriptions: set[Subscription] = set()
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default push configuration of the app"""
+    # Status changes of workers in other processes never reach the web app
+    app.config.setdefault("STATUS_PUSH", app.config.get("DISPATCHER_EMBEDDED", True))
+    # Seconds between comments that keep idle connections open through proxies
+    app.config.setdefault("STATUS_PUSH_KEEPALIVE", 15)
+    # Seconds after which a stream is closed, which frees its server thread.
+    # Browsers reconnect on their own.
+    app.config.setdefault("STATUS_PUSH_DURATION", 300)
+    app.config.setdefault("STATUS_PUSH_QUEUE_SIZE", 100)
+    # Streams open at once per process, each one holds a thread of the WSGI server
+    # (waitress has 4 by default). Further lists only poll.
+    app.config.setdefault("STATUS_PUSH_MAX_STREAMS", 2)
+    # Seconds between polls for status changes, without and with push
+    app.config.setdefault("STATUS_POLL_INTERVAL", 1)
+    app.config.setdefault("STATUS_PUSH_POLL_INTERVAL", 10)
+    # Changes committed up to this many seconds after they were made, or made by
+    # a worker with a clock this much behind, are still delivered to polls
+    app.config.setdefault("STATUS_CURSOR_MARGIN", 2)
+
+    app.extensions["status_events"] = _StatusEventState(app)
+
+
+def _get_state() -> _StatusEventState:
+    return current_app.extensions["status_events"]
+
+
+def subscribe(user_id: uuid.UUID | None) -> Subscription:
+    """Starts receiving the status events of a user
+
+    Args:
+        user_id: The public_id of the user, None to receive the events of all users
+
+    Raises:
+        TooManyStreams: If ``STATUS_PUSH_MAX_STREAMS`` subscribers are connected
+    """
+    state = _get_state()
+    subscription = Subscription(state, user_id, state.max_size)
+    with state.lock:
+        if len(state.subscriptions) >= state.max_streams:
+            state.rejected += 1
+            raise TooManyStreams()
+        state.subscriptions.add(subscription)
+    return subscription
+
+
+def publish(events: list[StatusEvent]) -> None:
+    """Delivers status events to the subscribers of their users
+
+    Must be called after the changes are committed, so that subscribers that load
+    the requests see the new status.
+    """
+    state = _get_state()
+    with state.lock:
+        subscriptions = list(state.subscriptions)
+        state.published += len(events)
+    dropped = 0
+    for subscription in subscriptions:
+        for event in events:
+            if subscription.user_id in (None, event.user_id):
+                dropped += not subscription._put(event)
+    if dropped:
+        with state.lock:
+            state.dropped += dropped
+
+
+def stats() -> dict:
+    """Returns the number of subscribers and events"""
+    state = _get_state()
+    with state.lock:
+        return {
+            "subscribers": len(state.subscriptions),
+            "rejected": state.rejected,
+            "published": state.published,
+            "dropped": state.dropped,
+        }
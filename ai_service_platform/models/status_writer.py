@@ -0,0 +1,284 @@
+"""Coalesced writes of the status transitions of requests
+
+Workers hand the transitions of their requests to the writer instead of committing
+each one. A single thread collects them for ``STATUS_WRITER_INTERVAL`` seconds or
+until ``STATUS_WRITER_BATCH_SIZE`` transitions are buffered, and writes them with
+one bulk ``UPDATE`` per kind of transition and one transaction. Transitions of the
+same request are applied in the order they were submitted, those of one flush are
+merged into the last. A transition only applies to a request that still has one
+of the statuses it expects, so late answers of a batch do not override a request
+that was paused, resumed or failed in the meantime. Workers that wait for their transitions are released when
+they are committed, so many workers share one commit instead of queuing up on the
+database lock.
+
+With ``STATUS_WRITER`` disabled, transitions are written right away in the session
+of the caller, with the same bulk statements.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from flask import Flask, current_app
+from sqlalchemy import insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import db, status_events
+from .models import Request, RequestOutput, RequestStatus, summarize
+from .status_events import StatusEvent
+
+# Insert statements with ON CONFLICT support, by dialect name
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# Statuses a request must have for a transition to apply, by the new status
+_ORIGINS = {
+    RequestStatus.RUNNING: (RequestStatus.PENDING, RequestStatus.RUNNING),
+    RequestStatus.FINISHED: (RequestStatus.RUNNING,),
+    RequestStatus.FAILED: (RequestStatus.RUNNING,),
+}
+
+
+@dataclass
+class Transition:
+    """A new status of a request"""
+
+    request_id: uuid.UUID
+    user_id: uuid.UUID
+    status: RequestStatus
+    lease_expires_at: datetime | None = None
+    # The output of a finished request
+    output: Any = None
+    # The statuses the transition applies to, by default those of _ORIGINS
+    origins: tuple[RequestStatus, ...] | None = None
+
+    def expected(self) -> tuple[RequestStatus, ...]:
+        """Returns the statuses the request must have for the transition"""
+        if self.origins is not None:
+            return self.origins
+        return _ORIGINS[self.status]
+
+
+class _StatusWriterState:
+    def __init__(self, app: Flask):
+        self.app = app
+        self.enabled: bool = app.config["STATUS_WRITER"]
+        self.interval: float = app.config["STATUS_WRITER_INTERVAL"]
+        self.batch_size: int = app.config["STATUS_WRITER_BATCH_SIZE"]
+        self.cond = threading.Condition()
+        self.pending: list[tuple[list[Transition], Future]] = []
+        self.buffered = 0
+        self.stopping = False
+        self.thread: threading.Thread | None = None
+        self.flushes = 0
+        self.written = 0
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default writer configuration of the app"""
+    app.config.setdefault("STATUS_WRITER", True)
+    # Seconds to collect transitions before they are written
+    app.config.setdefault("STATUS_WRITER_INTERVAL", 0.005)
+    app.config.setdefault("STATUS_WRITER_BATCH_SIZE", 200)
+
+    app.extensions["status_writer"] = _StatusWriterState(app)
+
+
+def _get_state() -> _StatusWriterState:
+    return current_app.extensions["status_writer"]
+
+
+def submit(transitions: list[Transition], wait: bool = True) -> None:
+    """Writes status transitions of requests
+
+    Args:
+        transitions: The transitions in the order they happened
+        wait: Whether to wait until the transitions are committed. Raises the
+            error of the flush if they could not be written.
+    """
+    state = _get_state()
+    if not state.enabled:
+        written = _write(db.session, transitions)
+        db.session.commit()
+        _publish(transitions, written)
+        return
+
+    future: Future = Future()
+    with state.cond:
+        if state.thread is None:
+            state.thread = threading.Thread(
+                target=_run, args=(state,), name="status-writer", daemon=True
+            )
+            state.thread.start()
+        state.pending.append((transitions, future))
+        state.buffered += len(transitions)
+        state.cond.notify()
+    if wait:
+        future.result()
+
+
+def shutdown() -> None:
+    """Writes the buffered transitions and stops the writer thread"""
+    state = _get_state()
+    with state.cond:
+        thread = state.thread
+        state.stopping = True
+        state.cond.notify()
+    if thread is not None:
+        thread.join()
+
+
+def stats() -> dict:
+    """Returns the number of flushes and of transitions written"""
+    state = _get_state()
+    with state.cond:
+        return {
+            "enabled": state.enabled,
+            "buffered": state.buffered,
+            "flushes": state.flushes,
+            "written": state.written,
+        }
+
+
+def _run(state: _StatusWriterState) -> None:
+    with state.app.app_context():
+        while (pending := _collect(state)) is not None:
+            transitions = [t for submitted, _ in pending for t in submitted]
+            try:
+                written = _write(db.session, transitions)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                state.app.logger.exception("Failed to write status transitions")
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            finally:
+                # Returns the connection and forgets the written objects
+                db.session.close()
+
+            with state.cond:
+                state.flushes += 1
+                state.written += len(transitions)
+            for _, future in pending:
+                future.set_result(None)
+            _publish(transitions, written)
+
+
+def _collect(state: _StatusWriterState) -> list | None:
+    """Waits for the transitions of the next flush, None when stopped"""
+    with state.cond:
+        while not state.pending and not state.stopping:
+            state.cond.wait()
+        if not state.pending:
+            # Later transitions start a new thread
+            state.thread = None
+            state.stopping = False
+            return None
+
+        # Transitions arriving in the meantime are written with the first ones
+        deadline = time.monotonic() + state.interval
+        while state.buffered < state.batch_size and not state.stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            state.cond.wait(remaining)
+
+        pending, state.pending = state.pending, []
+        state.buffered = 0
+        return pending
+
+
+def _write(session: Session, transitions: list[Transition]) -> set[uuid.UUID]:
+    """Writes the transitions and returns the requests that were changed"""
+    # The last transition of each request wins, earlier ones are never visible.
+    # The merged transition expects the status before the first one.
+    rows: dict[uuid.UUID, dict[str, Any]] = {}
+    origins: dict[uuid.UUID, tuple[RequestStatus, ...]] = {}
+    outputs: dict[uuid.UUID, Any] = {}
+    for transition in transitions:
+        row = {
+            "public_id": transition.request_id,
+            "status": transition.status,
+            "lease_expires_at": transition.lease_expires_at,
+        }
+        if transition.status == RequestStatus.FINISHED:
+            row["summary"] = summarize(transition.output)
+            outputs[transition.request_id] = transition.output
+        rows[transition.request_id] = row
+        origins.setdefault(transition.request_id, transition.expected())
+
+    if not rows:
+        return set()
+    # Requests that were deleted, paused or done in the meantime keep their
+    # status. Locking the rows keeps them until the commit.
+    statuses = dict(
+        session.execute(
+            select(Request.public_id, Request.status)
+            .where(Request.public_id.in_(rows))
+            .with_for_update()
+        ).all()
+    )
+    rows = {
+        request_id: row
+        for request_id, row in rows.items()
+        if statuses.get(request_id) in origins[request_id]
+    }
+    outputs = {
+        request_id: output
+        for request_id, output in outputs.items()
+        if request_id in rows
+    }
+
+    # Executemany needs the same columns in every row, and the expected statuses
+    # are part of the statement. They are checked again for databases without
+    # row locks. The check does not fit the synchronization of loaded objects,
+    # but those are expired after the commit anyway.
+    groups: dict[tuple, list[dict[str, Any]]] = {}
+    for request_id, row in rows.items():
+        groups.setdefault((frozenset(row), origins[request_id]), []).append(row)
+    for (_, expected), group in groups.items():
+        session.execute(
+            update(Request)
+            # Expanding IN lists do not work with executemany
+            .where(or_(*(Request.status == status for status in expected)))
+            .execution_options(synchronize_session=None),
+            group,
+        )
+
+    if outputs:
+        values = [
+            {"request_id": request_id, "output": output}
+            for request_id, output in outputs.items()
+        ]
+        upsert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+        if upsert is None:
+            session.execute(insert(RequestOutput), values)
+        else:
+            statement = upsert(RequestOutput)
+            session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[RequestOutput.request_id],
+                    set_={"output": statement.excluded.output},
+                ),
+                values,
+            )
+    return set(rows)
+
+
+def _publish(transitions: list[Transition], written: set[uuid.UUID]) -> None:
+    last = {
+        transition.request_id: transition
+        for transition in transitions
+        if transition.request_id in written
+    }
+    status_events.publish(
+        [
+            StatusEvent(transition.user_id, transition.request_id, transition.status)
+            for transition in last.values()
+        ]
+    )
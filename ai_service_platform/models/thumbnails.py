@@ -0,0 +1,151 @@
+"""Small previews of uploaded images for the request list
+
+Thumbnails are created in a background thread right after an upload, or on first
+access if that did not happen yet, and stored in the ``THUMBNAIL_FOLDER``. The
+folder is bounded to ``THUMBNAIL_CACHE_BYTES``: when it grows larger, the least
+recently served thumbnails are deleted. They are recreated when needed again. The
+thumbnail of a blob is deleted together with the blob.
+"""
+
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, current_app
+from PIL import Image
+
+# Thumbnail formats supported by Pillow and browsers, with their extension
+FORMATS = {"WEBP": ".webp", "JPEG": ".jpg"}
+
+
+class _ThumbnailState:
+    def __init__(self, app: Flask):
+        config = app.config
+        self.folder: str = config["THUMBNAIL_FOLDER"]
+        self.size: int = config["THUMBNAIL_SIZE"]
+        self.format: str = config["THUMBNAIL_FORMAT"]
+        self.quality: int = config["THUMBNAIL_QUALITY"]
+        self.max_bytes: int = config["THUMBNAIL_CACHE_BYTES"]
+        if self.format not in FORMATS:
+            raise ValueError(f"Unsupported thumbnail format {self.format}")
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.bytes = sum(entry.stat().st_size for entry in os.scandir(self.folder))
+        # One thread is enough, thumbnails of the same input are created only once
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="thumbnails")
+
+
+def init_app(app: Flask) -> None:
+    """Sets the default thumbnail configuration of the app"""
+    app.config.setdefault(
+        "THUMBNAIL_FOLDER", os.path.join(app.instance_path, "thumbnails")
+    )
+    # Bounding box in pixels, twice the displayed size for high density screens
+    app.config.setdefault("THUMBNAIL_SIZE", 160)
+    app.config.setdefault("THUMBNAIL_FORMAT", "WEBP")
+    app.config.setdefault("THUMBNAIL_QUALITY", 75)
+    app.config.setdefault("THUMBNAIL_CACHE_BYTES", 64 * 1024 * 1024)
+    # Seconds browsers may keep a thumbnail without asking again
+    app.config.setdefault("THUMBNAIL_MAX_AGE", 365 * 24 * 60 * 60)
+
+    app.extensions["thumbnails"] = _ThumbnailState(app)
+
+
+def _get_state() -> _ThumbnailState:
+    return current_app.extensions["thumbnails"]
+
+
+def thumbnail_name(input_file: str) -> str:
+    """Returns the file name of the thumbnail of an upload
+
+    Uploads have unique names, blobs are even named after their content, so the
+    name identifies the thumbnail and can be used as its ETag.
+    """
+    state = _get_state()
+    stem = os.path.basename(input_file).split(".", 1)[0]
+    return f"{stem}.{state.size}{FORMATS[state.format]}"
+
+
+def get(input_file: str) -> str:
+    """Returns the path of the thumbnail of an upload and creates it if missing
+
+    Args:
+        input_file: The path of the upload relative to the ``UPLOAD_FOLDER``
+    """
+    state = _get_state()
+    path = os.path.join(state.folder, thumbnail_name(input_file))
+    try:
+        # The modification time orders the thumbnails for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        source = os.path.join(current_app.config["UPLOAD_FOLDER"], input_file)
+        _create(state, source, path)
+    return path
+
+
+def create_later(input_file: str) -> None:
+    """Creates the thumbnail of an upload in the background"""
+    state = _get_state()
+    source = os.path.join(current_app.config["UPLOAD_FOLDER"], input_file)
+    path = os.path.join(state.folder, thumbnail_name(input_file))
+    state.executor.submit(_create, state, source, path)
+
+
+def remove(input_file: str) -> None:
+    """Deletes the thumbnail of an upload, e.g. after the upload was deleted"""
+    state = _get_state()
+    path = os.path.join(state.folder, thumbnail_name(input_file))
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    with state.lock:
+        state.bytes -= size
+
+
+def _create(state: _ThumbnailState, source: str, path: str) -> None:
+    if os.path.exists(path):
+        return
+
+    with Image.open(source) as image:
+        # Decodes JPEGs at a reduced scale, which is much faster for large photos
+        image.draft("RGB", (state.size, state.size))
+        image.thumbnail((state.size, state.size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        with tempfile.NamedTemporaryFile(
+            dir=state.folder, prefix=".", delete=False
+        ) as temp:
+            image.save(temp, state.format, quality=state.quality)
+
+    size = os.path.getsize(temp.name)
+    os.replace(temp.name, path)
+    with state.lock:
+        state.bytes += size
+        over_limit = state.bytes > state.max_bytes
+    if over_limit:
+        _evict(state)
+
+
+def _evict(state: _ThumbnailState) -> None:
+    with state.lock:
+        # Temporary files start with a dot and are still being written
+        thumbnails = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(state.folder)
+            if not entry.name.startswith(".")
+        )
+        state.bytes = sum(size for _, size, _ in thumbnails)
+        # Leave some room, so not every new thumbnail triggers another scan
+        target = state.max_bytes * 0.9
+        for _, size, path in thumbnails:
+            if state.bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            state.bytes -= size
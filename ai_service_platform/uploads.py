@@ -0,0 +1,152 @@
+"""Single pass handling of uploaded files
+
+Werkzeug normally spools uploads to memory or a temporary file before the view can
+look at them. :class:`UploadRequest` instead streams every uploaded file in chunks
+into the temporary folder of the blob store, from where it is renamed into place.
+While the chunks arrive, the SHA-256 hash is computed, the magic bytes are checked
+and the size limit is enforced, so invalid uploads are rejected as soon as the
+offending chunk is read.
+"""
+
+import hashlib
+import os
+import tempfile
+from typing import IO
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from .models import blob_store
+
+# Leading bytes of the accepted image formats and the extension they are stored with
+SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": ".png",
+    b"\xff\xd8\xff": ".jpg",
+}
+
+
+def sniff(head: bytes) -> str | None:
+    """Detects the image format from the first bytes of a file
+
+    Args:
+        head: The first bytes of the file, at least one
+
+    Returns:
+        The extension of the format or None if more bytes are needed
+
+    Raises:
+        UnsupportedMediaType: If the file is not one of the accepted formats
+    """
+    undecided = False
+    for signature, extension in SIGNATURES.items():
+        if head.startswith(signature):
+            return extension
+        if signature.startswith(head):
+            undecided = True
+    if not undecided:
+        raise UnsupportedMediaType("Only PNG and JPEG images are supported")
+    return None
+
+
+class UploadStream:
+    """Writable file that hashes, sniffs and limits the data written to it
+
+    The data is written to a temporary file in ``folder``, which is removed on
+    :meth:`close` unless it was moved away before.
+    """
+
+    def __init__(self, folder: str, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.extension: str | None = None
+        self._hash = hashlib.sha256()
+        self._head = b""
+        # Owned by the stream and closed by close(). Opened last, so nothing in
+        # here can fail with the file left open.
+        self._file: IO[bytes] = tempfile.NamedTemporaryFile(  # noqa: SIM115
+            dir=folder, delete=False
+        )
+
+    @property
+    def name(self) -> str:
+        """Path of the temporary file"""
+        return self._file.name
+
+    def hexdigest(self) -> str:
+        """Returns the hex SHA-256 digest of the data written so far"""
+        return self._hash.hexdigest()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(
+                f"Uploads must not be larger than {self.max_size} bytes"
+            )
+
+        if self.extension is None:
+            self._head += data[:8]
+            try:
+                self.extension = sniff(self._head)
+            except UnsupportedMediaType:
+                self.close()
+                raise
+
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._file.readline(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRequest(Request):
+    """Request that streams uploaded files into :class:`UploadStream` objects
+
+    The size limit is read from ``UPLOAD_MAX_SIZE``. No request takes more than
+    ``BATCH_MAX_FILES`` files, the parts after that are not read anymore.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._upload_streams: list[UploadStream] = []
+
+    def _get_file_stream(
+        self,
+        total_content_length: int | None,
+        content_type: str | None,
+        filename: str | None = None,
+        content_length: int | None = None,
+    ) -> UploadStream:
+        if len(self._upload_streams) == current_app.config["BATCH_MAX_FILES"]:
+            for upload in self._upload_streams:
+                upload.close()
+            raise RequestEntityTooLarge("Too many files")
+
+        max_size = current_app.config["UPLOAD_MAX_SIZE"]
+        # Browsers rarely send the size of a file, but if they do it is checked first
+        if content_length is not None and content_length > max_size:
+            raise RequestEntityTooLarge(
+                f"Uploads must not be larger than {max_size} bytes"
+            )
+        upload = UploadStream(blob_store.temp_folder(), max_size)
+        self._upload_streams.append(upload)
+        return upload
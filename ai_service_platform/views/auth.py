@@ -9,12 +9,17 @@ from flask import (
     Blueprint,
 )
 
+import math
+import uuid
+
 from sqlalchemy import select
+from werkzeug.datastructures import WWWAuthenticate
+from werkzeug.exceptions import TooManyRequests, Unauthorized
 from werkzeug.security import check_password_hash
 from functools import wraps
 
-from ai_service_platform.models.models import User, Role
-from ai_service_platform.models import db
+from ai_service_platform.models.models import Model, User, Role
+from ai_service_platform.models import db, principal_cache, rate_limits, source_tokens
 
 bp = Blueprint("auth", __name__, template_folder="templates/auth", url_prefix="/auth")
 
@@ -45,16 +50,65 @@ def roles_required(allowed: list[Role]):
     return decorator
 
 
+def token_required(scope: str):
+    """Authenticates a source by the bearer token of the request
+
+    The source is stored in the g object like logged in users. Requests without a
+    valid token for ``scope`` are answered with 401, see source_tokens.
+
+    Args:
+    scope: The scope the token has to grant
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            token = request.authorization and request.authorization.token
+            g.user = token and source_tokens.verify(token, scope)
+            if not g.user:
+                raise Unauthorized(
+                    "Missing, invalid or expired token",
+                    www_authenticate=WWWAuthenticate("bearer"),
+                )
+
+            return f(*args, **kwargs)
+
+        return decorated
+
+    return decorator
+
+
+def limit_uploads(model: Model, count: int = 1, size: int = 0) -> None:
+    """Takes the uploads from the rate limits and quotas of the current user
+
+    Uploads over a limit are answered with 429 and the seconds until they would be
+    accepted in Retry-After, see rate_limits.
+
+    Args:
+    model: The model the images are uploaded for
+    count: The number of uploaded images
+    size: The number of uploaded bytes
+    """
+    try:
+        rate_limits.check(g.user, model.server_model_name, count, size)
+    except rate_limits.RateLimited as error:
+        retry_after = error.retry_after
+        raise TooManyRequests(
+            str(error),
+            retry_after=None if retry_after is None else math.ceil(retry_after),
+        )
+
+
 @bp.before_app_request
 def load_logged_in_user():
-    """Load user from the current session cookie"""
+    """Load user from the current session cookie, see principal_cache"""
     g.user = None
-    user_id: str | None = session.get("user_id")
+    user_id: uuid.UUID | str | None = session.get("user_id")
 
     if user_id:
         try:
-            g.user = db.session.get_one(User, user_id)
-        except Exception:
+            g.user = principal_cache.get_user(uuid.UUID(str(user_id)))
+        except ValueError:
             pass
 
 
@@ -0,0 +1,368 @@
+"""Submission of many images in one HTTP call
+
+A batch is uploaded as multipart form with several ``input`` files, or as a tar or
+zip archive in the request body with the model in the query string. All requests
+of a batch are inserted in one transaction with one lookup of cached results and
+one statement for the blob references, and are queued together. The batch can be
+polled or streamed as server-sent events until all of its requests are done.
+"""
+
+import json
+import shutil
+import tarfile
+import tempfile
+import time
+import uuid
+import zipfile
+from collections import Counter
+from typing import IO
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    g,
+    request,
+    stream_with_context,
+)
+from sqlalchemy import select
+
+from ai_service_platform.models import (
+    blob_store,
+    db,
+    deadlines,
+    dispatcher,
+    result_cache,
+    status_events,
+    thumbnails,
+)
+from ai_service_platform.models.job_queue import queue_full
+from ai_service_platform.models.models import (
+    Batch,
+    Model,
+    Priority,
+    Request,
+    RequestStatus,
+    Role,
+    utcnow,
+)
+from ai_service_platform.uploads import UploadStream
+
+from .auth import limit_uploads, roles_required
+from .request import requested_timeout
+
+bp = Blueprint("batch", __name__, url_prefix="/batch")
+
+TAR_TYPES = {"application/x-tar", "application/gzip", "application/x-gzip"}
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed"}
+
+# Room for the headers and the index of each file in a zip archive
+ZIP_OVERHEAD_PER_FILE = 64 * 1024
+
+# Statuses after which a request does not change anymore
+DONE = {RequestStatus.FINISHED, RequestStatus.FAILED}
+
+
+def read_uploads() -> list[UploadStream]:
+    """Returns the images of the current request, from its form or its archive
+
+    Raises:
+        HTTPException: If the archive is malformed, a file is not an image or too
+            large, there are more than ``BATCH_MAX_FILES`` files or a zip archive
+            is larger than all of them together
+    """
+    if request.mimetype not in TAR_TYPES | ZIP_TYPES:
+        # Hashed, checked and counted while they were received, see UploadRequest
+        return [file.stream for file in request.files.getlist("input")]
+
+    uploads: list[UploadStream] = []
+    try:
+        for member in _archive_members(request.stream, request.mimetype):
+            if len(uploads) == current_app.config["BATCH_MAX_FILES"]:
+                abort(413, "Too many files")
+            upload = UploadStream(
+                blob_store.temp_folder(), current_app.config["UPLOAD_MAX_SIZE"]
+            )
+            uploads.append(upload)
+            shutil.copyfileobj(member, upload)
+    except (tarfile.TarError, zipfile.BadZipFile):
+        _close(uploads)
+        abort(400, "Malformed archive")
+    except BaseException:
+        _close(uploads)
+        raise
+    return uploads
+
+
+def _archive_members(stream: IO[bytes], mimetype: str):
+    if mimetype in TAR_TYPES:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile():
+                    yield archive.extractfile(member)
+        return
+
+    # The index of a zip archive is at its end, so the body is spooled first
+    with tempfile.TemporaryFile(dir=blob_store.temp_folder()) as spool:
+        _spool(stream, spool)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield member
+
+
+def _spool(stream: IO[bytes], spool: IO[bytes]) -> None:
+    max_files = current_app.config["BATCH_MAX_FILES"]
+    max_size = max_files * (
+        current_app.config["UPLOAD_MAX_SIZE"] + ZIP_OVERHEAD_PER_FILE
+    )
+    size = 0
+    while chunk := stream.read(64 * 1024):
+        size += len(chunk)
+        if size > max_size:
+            abort(413, "Archive is too large")
+        spool.write(chunk)
+    spool.seek(0)
+
+
+def _close(uploads: list[UploadStream]) -> None:
+    for upload in uploads:
+        upload.close()
+
+
+def create_batch() -> dict:
+    """Creates a batch from the images and the model of the current request
+
+    The model and an optional ``timeout`` in seconds are read from the form, or
+    the query string for archives. See :func:`submit_batch` for the response.
+    """
+    uploads = read_uploads()
+    try:
+        archive = request.mimetype in TAR_TYPES | ZIP_TYPES
+        values = request.args if archive else request.form
+        try:
+            model = db.session.get(Model, uuid.UUID(values["model"]))
+        except (KeyError, ValueError):
+            model = None
+        if model is None:
+            abort(400, "Unknown model")
+
+        return submit_batch(uploads, model, requested_timeout(values))
+    finally:
+        _close(uploads)
+
+
+def submit_batch(
+    uploads: list[UploadStream], model: Model, timeout: float | None = None
+) -> dict:
+    """Stores checked uploads and queues their requests as one batch
+
+    Requests of a source belong to its owner. Inputs with a cached result are
+    finished right away, the others are only queued if all of them fit into
+    ``DISPATCHER_QUEUE_SIZE``. The requests share the deadline of the timeout, see
+    :func:`.deadlines.deadline`.
+
+    Returns:
+        The JSON body of the response with the id of the batch and its requests
+    """
+    if not uploads:
+        abort(400, "No input files")
+    if any(upload.extension is None for upload in uploads):
+        abort(415, "Only PNG and JPEG images are supported")
+    limit_uploads(model, len(uploads), sum(upload.size for upload in uploads))
+
+    input_hashes = [upload.hexdigest() for upload in uploads]
+    outputs = result_cache.lookup_many(model, input_hashes)
+    # The whole batch is admitted to the queue or none of it
+    pending = sum(input_hash not in outputs for input_hash in input_hashes)
+    if pending > current_app.config["DISPATCHER_QUEUE_SIZE"]:
+        abort(413, "Batch is larger than the queue, split it up")
+    if pending and queue_full(pending):
+        abort(429, "Too many pending requests, try again later")
+
+    # Identical uploads share one file in the blob store
+    for upload in uploads:
+        upload.flush()
+    filenames = blob_store.put_temporary_many(
+        [
+            (upload.name, input_hash, upload.extension)
+            for upload, input_hash in zip(uploads, input_hashes)
+        ]
+    )
+
+    source_id = g.user.public_id if g.user.role is Role.SOURCE else None
+    batch = Batch(
+        public_id=uuid.uuid4(),
+        user_id=g.user.user_id,
+        source_id=source_id,
+        model_id=model.public_id,
+        size=len(uploads),
+    )
+    # Queued at the same time, so the workers claim them together
+    queued_at = utcnow()
+    deadline = deadlines.deadline(model, timeout)
+    requests = []
+    for filename, input_hash in zip(filenames, input_hashes):
+        new_request = Request(
+            public_id=uuid.uuid4(),
+            user_id=batch.user_id,
+            source_id=source_id,
+            model_id=model.public_id,
+            input_file=filename,
+            input_hash=input_hash,
+            priority=Priority.of(g.user.role, batch=True),
+            created_at=queued_at,
+            queued_at=queued_at,
+            deadline=deadline,
+        )
+        if input_hash in outputs:
+            new_request.status = RequestStatus.FINISHED
+            new_request.output = outputs[input_hash]
+        requests.append(new_request)
+    batch.requests = requests
+    db.session.add(batch)
+    body = {
+        "batch": batch.public_id,
+        "requests": [new_request.public_id for new_request in requests],
+    }
+    db.session.commit()
+
+    for filename in set(filenames):
+        thumbnails.create_later(filename)
+    # The new requests are queued by their pending status, let the workers know
+    if pending:
+        dispatcher.wake()
+
+    return body
+
+
+def get_batch(public_id: uuid.UUID) -> Batch:
+    """Returns a batch of the current user or source, any batch for admins"""
+    batch = db.session.get(Batch, public_id)
+    if batch is None:
+        abort(404, "Could not find batch")
+    if g.user.role is Role.SOURCE:
+        owned = batch.source_id == g.user.public_id
+    else:
+        owned = g.user.role is Role.ADMIN or batch.user_id == g.user.public_id
+    if not owned:
+        abort(404, "Could not find batch")
+    return batch
+
+
+def batch_state(batch: Batch) -> dict:
+    """Returns the status and summarized output of every request of a batch"""
+    rows = db.session.execute(
+        select(Request.public_id, Request.status, Request.summary).where(
+            Request.batch_id == batch.public_id
+        )
+    ).all()
+    counts = Counter(row.status.value for row in rows)
+    return {
+        "batch": batch.public_id,
+        "model": batch.model_id,
+        "size": batch.size,
+        "created_at": batch.created_at.isoformat(),
+        "done": all(row.status in DONE for row in rows),
+        "statuses": counts,
+        "requests": [
+            {
+                "public_id": row.public_id,
+                "status": row.status.value,
+                "summary": row.summary,
+            }
+            for row in rows
+        ],
+    }
+
+
+@bp.route("", methods=["POST"])
+@roles_required([Role.USER1])
+def post():
+    """Creates a batch of requests from the uploaded images"""
+    return create_batch(), 201
+
+
+@bp.route("/<uuid:public_id>")
+@roles_required([Role.ADMIN, Role.USER1, Role.USER2])
+def get(public_id):
+    """Returns the progress of a batch and the outputs of its finished requests"""
+    return batch_state(get_batch(public_id))
+
+
+@bp.route("/<uuid:public_id>/events")
+@roles_required([Role.ADMIN, Role.USER1, Role.USER2])
+def events(public_id):
+    """Streams the status changes of the requests of a batch as server-sent events
+
+    Starts with the current status of every request and ends with a ``done``
+    event carrying the state of the batch once all requests are done.
+    """
+    if not current_app.config["STATUS_PUSH"]:
+        abort(404, "Status changes are not pushed, poll the batch instead")
+
+    batch = get_batch(public_id)
+    batch_id = batch.public_id
+    # Subscribed first, so no change between reading and streaming is missed
+    try:
+        subscription = status_events.subscribe(batch.user_id)
+    except status_events.TooManyStreams:
+        abort(503, "Too many open streams, poll the batch instead")
+    statuses = _statuses(batch_id)
+    remaining = {request_id for request_id, status in statuses if status not in DONE}
+    db.session.close()
+
+    keepalive = current_app.config["STATUS_PUSH_KEEPALIVE"]
+    deadline = time.monotonic() + current_app.config["STATUS_PUSH_DURATION"]
+
+    def stream():
+        try:
+            yield "retry: 1000\n\n"
+            known = {}
+            changes = statuses
+            while True:
+                for request_id, status in changes:
+                    if known.get(request_id) == status:
+                        continue
+                    known[request_id] = status
+                    if status in DONE:
+                        remaining.discard(request_id)
+                    data = {"public_id": str(request_id), "status": status.value}
+                    yield f"event: status\ndata: {json.dumps(data)}\n\n"
+                if not remaining or time.monotonic() >= deadline:
+                    break
+
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    # Catches up on events dropped while the queue was full
+                    changes = _statuses(batch_id, remaining)
+                    db.session.close()
+                    yield ": keepalive\n\n"
+                elif event.public_id in remaining:
+                    changes = [(event.public_id, event.status)]
+                else:
+                    changes = []
+
+            if not remaining:
+                state = batch_state(db.session.get(Batch, batch_id))
+                data = json.dumps(state, default=str)
+                yield f"event: done\ndata: {data}\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Keeps reverse proxies from buffering the events
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _statuses(batch_id: uuid.UUID, request_ids=None) -> list:
+    query = select(Request.public_id, Request.status).where(
+        Request.batch_id == batch_id
+    )
+    if request_ids is not None:
+        query = query.where(Request.public_id.in_(request_ids))
+    return db.session.execute(query).all()
@@ -0,0 +1,42 @@
+from flask import Blueprint, current_app
+
+from .auth import roles_required
+from ai_service_platform.models.models import Priority, Role
+from ai_service_platform.models import (
+    deadlines,
+    dispatcher,
+    model_client,
+    model_registry,
+    principal_cache,
+    rate_limits,
+    result_cache,
+    source_tokens,
+    status_events,
+    status_writer,
+)
+from ai_service_platform.models.job_queue import count_pending
+
+bp = Blueprint("metrics", __name__, url_prefix="/metrics")
+
+
+@bp.route("")
+@roles_required([Role.ADMIN, Role.DEV])
+def metrics():
+    dispatcher_stats = dispatcher.stats()
+    dispatcher_stats["wait_time_per_priority"] = {
+        Priority(priority).name.lower(): waits
+        for priority, waits in dispatcher_stats["wait_time_per_priority"].items()
+    }
+    return {
+        "dispatcher": dispatcher_stats,
+        "deadlines": deadlines.stats(),
+        "model_server": model_client.stats(),
+        "model_registry": model_registry.stats(),
+        "principal_cache": principal_cache.stats(),
+        "rate_limits": rate_limits.stats(),
+        "result_cache": result_cache.stats(),
+        "source_tokens": source_tokens.stats(),
+        "status_events": status_events.stats(),
+        "status_writer": status_writer.stats(),
+        "pending_requests": count_pending(current_app.config["DISPATCHER_QUEUE_SIZE"]),
+    }
@@ -1,27 +1,48 @@
-import os
-from threading import Thread
+import time
 import uuid
+from datetime import date, datetime, timedelta
 
 from flask import (
     Blueprint,
+    Response,
     abort,
-    copy_current_request_context,
     current_app,
     flash,
     g,
     redirect,
     render_template,
     request,
+    stream_with_context,
     url_for,
 )
-from sqlalchemy import select
+from sqlalchemy import Select, select, tuple_, update
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 
-from ai_service_platform.models import db, models
-from ai_service_platform.models.models import Model, Role, Request
-from ai_service_platform.models.request_handler import process_request
+from ai_service_platform.models import (
+    blob_store,
+    db,
+    deadlines,
+    dispatcher,
+    models,
+    result_cache,
+    status_events,
+    thumbnails,
+)
+from ai_service_platform.models.job_queue import queue_full
+from ai_service_platform.models.status_events import StatusEvent
+from ai_service_platform.uploads import UploadStream
+from ai_service_platform.models.models import (
+    Model,
+    Priority,
+    Request,
+    RequestStatus,
+    Role,
+    Source,
+    utcnow,
+)
 
-from .auth import roles_required
+from .auth import limit_uploads, roles_required
 
 ALLOWED_EXTENSIONS = {"png", "jpeg", "jpg"}
 
@@ -33,17 +54,151 @@ def is_allowed_file(filename):
 bp = Blueprint("request", __name__, url_prefix="/request")
 
 
+def status_cursor() -> str:
+    """Returns the cursor for the next poll of status changes
+
+    Must be taken before the statuses are read. It lies ``STATUS_CURSOR_MARGIN``
+    seconds in the past, so changes that are committed late are not missed.
+    """
+    margin = timedelta(seconds=current_app.config["STATUS_CURSOR_MARGIN"])
+    return (utcnow() - margin).isoformat()
+
+
+def page_cursor(request: Request) -> str:
+    """Returns the cursor of the page that starts after a request"""
+    return f"{request.created_at.isoformat()}_{request.public_id}"
+
+
+def list_query(args) -> Select:
+    """Builds the query for a page of the request list from the query args
+
+    Requests are ordered newest first. Pages are selected by the last request of
+    the previous page instead of an offset, so every page is read from the
+    ``created_at`` indexes without counting the requests before it.
+
+    Raises:
+        ValueError: If an arg is malformed
+    """
+    query = (
+        select(Request)
+        .options(joinedload(Request.model))
+        .order_by(Request.created_at.desc(), Request.public_id.desc())
+    )
+    if g.user.role != Role.ADMIN:
+        query = query.where(Request.user_id == g.user.public_id)
+
+    if args.get("status"):
+        query = query.where(Request.status == RequestStatus[args["status"]])
+    if args.get("model"):
+        query = query.where(Request.model_id == uuid.UUID(args["model"]))
+    if args.get("source"):
+        query = query.where(Request.source_id == uuid.UUID(args["source"]))
+    if args.get("from"):
+        start = datetime.combine(date.fromisoformat(args["from"]), datetime.min.time())
+        query = query.where(Request.created_at >= start)
+    if args.get("to"):
+        end = datetime.combine(date.fromisoformat(args["to"]), datetime.min.time())
+        query = query.where(Request.created_at < end + timedelta(days=1))
+    if args.get("after"):
+        created_at, public_id = args["after"].split("_")
+        query = query.where(
+            tuple_(Request.created_at, Request.public_id)
+            < (datetime.fromisoformat(created_at), uuid.UUID(public_id))
+        )
+    return query
+
+
 @bp.route("")
 @roles_required([Role.ADMIN, Role.USER1, Role.USER2])
 def get():
-    requests = None
-    if g.user.role == Role.ADMIN:
-        requests = db.session.scalars(select(Request)).all()
-    else:
-        requests = g.user.requests
+    cursor = status_cursor()
+    page_size = current_app.config["REQUEST_PAGE_SIZE"]
+    try:
+        query = list_query(request.args)
+    except (KeyError, ValueError):
+        abort(400)
+    # One more request tells whether there is a next page
+    requests = db.session.scalars(query.limit(page_size + 1)).all()
+    next_page = None
+    if len(requests) > page_size:
+        requests = requests[:page_size]
+        next_page = page_cursor(requests[-1])
 
     models = db.session.scalars(select(Model)).all()
-    return render_template("request/list.html", requests=requests, models=models)
+    sources = select(Source)
+    if g.user.role != Role.ADMIN:
+        sources = sources.where(Source.owner_id == g.user.public_id)
+    filters = {key: value for key, value in request.args.items() if key != "after"}
+    return render_template(
+        "request/list.html",
+        requests=requests,
+        models=models,
+        sources=db.session.scalars(sources).all(),
+        statuses=list(RequestStatus),
+        filters=filters,
+        next_page=next_page,
+        cursor=cursor,
+    )
+
+
+def requested_timeout(values) -> float | None:
+    """Returns the seconds a submitter is willing to wait, from a ``timeout`` arg
+
+    Aborts with 400 if the timeout is not a positive number.
+    """
+    value = values.get("timeout")
+    if not value:
+        return None
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = 0.0
+    if not timeout > 0:
+        abort(400, "The timeout has to be a positive number of seconds")
+    return timeout
+
+
+def create_request(
+    upload: UploadStream, model: Model, output=None, timeout: float | None = None
+) -> Request:
+    """Stores a checked upload and adds its request for the current user
+
+    Args:
+        upload: The upload, hashed and checked while it was received
+        model: The model that should process the upload
+        output: The cached output of the model for the upload, if any
+        timeout: The seconds the submitter is willing to wait, see
+            :func:`.deadlines.deadline`
+
+    Returns:
+        The request, finished if the output is given and pending otherwise
+    """
+    # Identical uploads share one file in the blob store
+    upload.flush()
+    input_hash = upload.hexdigest()
+    filename = blob_store.put_temporary(upload.name, input_hash, upload.extension)
+
+    # Requests of a source belong to its owner
+    source_id = g.user.public_id if g.user.role is Role.SOURCE else None
+
+    # Prepare request db object columns
+    data = {
+        "model_id": model.public_id,
+        "user_id": g.user.user_id,
+        "source_id": source_id,
+        # "input_name": filename,
+        "input_file": filename,
+        "input_hash": input_hash,
+        "priority": Priority.of(g.user.role),
+        "deadline": deadlines.deadline(model, timeout),
+    }
+    if output is not None:
+        data["status"] = models.RequestStatus.FINISHED
+        data["output"] = output
+
+    new_request = models.Request(**data, model=model)
+    db.session.add(new_request)
+    return new_request
 
 
 @bp.route("", methods=["POST"])
@@ -65,39 +220,31 @@ def users_post():
         flash("Wrong filetype")
         return redirect(request.url)
 
-    input_id = uuid.uuid4()
-    filename = f"{input_id}_{filename}"
-    file.save(os.path.join(current_app.config["UPLOAD_FOLDER"], filename))
-
-    # Set user and/or source of http request
-    source = None
-    if g.user.role is Role.SOURCE:
-        user = g.user.owner
-        source = g.user
-    else:
-        user = g.user
-
-    # Prepare request db object columns
-    data = {
-        "model_id": uuid.UUID(request.form["model"]),
-        "user_id": g.user.public_id,
-        # "input_name": filename,
-        "input_file": filename,
-    }
-
-    model = db.session.get(models.Model, data["model_id"])
-
-    newRequest = models.Request(**data, user=user, source=source, model=model)
-    db.session.add(newRequest)
+    model = db.session.get(models.Model, uuid.UUID(request.form["model"]))
+    if model is None:
+        abort(400, "Unknown model")
+
+    # The upload was hashed and checked while it was received, see UploadRequest
+    upload = file.stream
+    if upload.extension is None:
+        abort(415, "Only PNG and JPEG images are supported")
+    timeout = requested_timeout(request.form)
+    limit_uploads(model, 1, upload.size)
+    input_hash = upload.hexdigest()
+    output = result_cache.lookup(model, input_hash)
+
+    # Reject early if the workers are already saturated, cached results are
+    # still answered because they do not need a worker
+    if output is None and queue_full():
+        abort(429, "Too many pending requests, try again later")
+
+    filename = create_request(upload, model, output, timeout).input_file
     db.session.commit()
+    thumbnails.create_later(filename)
 
-    @copy_current_request_context
-    def process(public_id):
-        """Wrapper to process requests in parallel while staying in the same request context"""
-        process_request(public_id)
-
-    thread = Thread(target=process, kwargs={"public_id": newRequest.public_id})
-    thread.start()
+    # The new request is queued by its pending status, let the workers know
+    if output is None:
+        dispatcher.wake()
 
     return redirect(url_for("request.get"))
 
@@ -128,6 +275,82 @@ def get_table_status(public_id):
     return render_template("request/table_status.html", request=request)
 
 
+@bp.route("/statuses")
+@roles_required([Role.ADMIN, Role.USER1, Role.USER2])
+def get_statuses():
+    """Returns the status cells of the requests that changed since a poll
+
+    The cells are swapped out of band by htmx, next to the poller for the next
+    poll. Changes are read from the ``updated_at`` indexes with one query, however
+    many requests are pending.
+
+    Query args:
+        since: The cursor returned by the previous poll
+        id: Restricts the changes to these requests, can be given multiple times
+    """
+    try:
+        since = datetime.fromisoformat(request.args["since"])
+        request_ids = [uuid.UUID(value) for value in request.args.getlist("id")]
+    except (KeyError, ValueError):
+        abort(400)
+
+    cursor = status_cursor()
+    query = (
+        select(Request.public_id, Request.status)
+        .where(Request.updated_at > since)
+        .order_by(Request.updated_at)
+    )
+    if g.user.role != Role.ADMIN:
+        query = query.where(Request.user_id == g.user.public_id)
+    if request_ids:
+        query = query.where(Request.public_id.in_(request_ids))
+    changed = db.session.execute(query).all()
+
+    return render_template(
+        "request/statuses.html", requests=changed, cursor=cursor, oob=True
+    )
+
+
+@bp.route("/events")
+@roles_required([Role.ADMIN, Role.USER1, Role.USER2])
+def events():
+    """Streams the status changes of the user's requests as server-sent events
+
+    Each event is named after the request and carries its rendered status cell.
+    """
+    user_id = None if g.user.role == Role.ADMIN else g.user.public_id
+    try:
+        subscription = status_events.subscribe(user_id)
+    except status_events.TooManyStreams:
+        abort(503, "Too many open streams, the list polls instead")
+    # The stream does not use the database, so the connection can be returned
+    db.session.close()
+
+    keepalive = current_app.config["STATUS_PUSH_KEEPALIVE"]
+    deadline = time.monotonic() + current_app.config["STATUS_PUSH_DURATION"]
+
+    def stream():
+        try:
+            # Browsers reconnect after this many milliseconds
+            yield "retry: 1000\n\n"
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                html = render_template("request/table_status.html", request=event)
+                data = "".join(f"data: {line}\n" for line in html.splitlines())
+                yield f"event: status-{event.public_id}\n{data}\n"
+        finally:
+            subscription.close()
+
+    response = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Keeps reverse proxies from buffering the events
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @bp.route("/<uuid:public_id>", methods=["DELETE"])
 @roles_required([Role.USER1, Role.USER2])
 def delete(public_id):
@@ -140,5 +363,77 @@ def delete(public_id):
 
     db.session.delete(request)
     db.session.commit()
+    # Stops the work on it if it is queued or running in this process, workers
+    # of other processes notice within DISPATCHER_POLL_INTERVAL seconds
+    dispatcher.cancel([public_id])
 
     return ""
+
+
+def change_status(
+    public_id: uuid.UUID, allowed: list[RequestStatus], status: RequestStatus
+) -> Request:
+    """Moves a request of the current user to a new status
+
+    The status is only changed if it still is one of the allowed statuses, so a
+    request that finishes in the meantime is left alone.
+
+    Returns:
+        The request with its new status
+    """
+    changed = db.session.execute(
+        update(Request)
+        .where(
+            Request.public_id == public_id,
+            Request.user_id == g.user.public_id,
+            Request.status.in_(allowed),
+        )
+        .values(status=status, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    request = db.session.scalar(
+        select(Request).filter_by(public_id=public_id, user_id=g.user.public_id)
+    )
+    if not request:
+        abort(404, "Could not find request")
+    if not changed:
+        abort(409, f"The request is {request.status.name.lower()}")
+
+    status_events.publish([StatusEvent(request.user_id, public_id, status)])
+    return request
+
+
+def render_status(request: Request) -> str:
+    """Renders the pause button of a request and its status cell out of band"""
+    button = render_template("request/pause_button.html", request=request)
+    cell = render_template("request/table_status.html", request=request, oob=True)
+    return button + cell
+
+
+@bp.route("/<uuid:public_id>/pause", methods=["POST"])
+@roles_required([Role.USER1, Role.USER2])
+def pause(public_id):
+    """Pauses a pending or running request
+
+    Its job is dropped from the queue and its call to the model server is
+    aborted, so the worker is free for other requests right away.
+    """
+    request = change_status(
+        public_id, [RequestStatus.PENDING, RequestStatus.RUNNING], RequestStatus.PAUSED
+    )
+    dispatcher.cancel([public_id])
+    return render_status(request)
+
+
+@bp.route("/<uuid:public_id>/resume", methods=["POST"])
+@roles_required([Role.USER1, Role.USER2])
+def resume(public_id):
+    """Queues a paused request again, in its original place"""
+    if queue_full():
+        abort(429, "Too many pending requests, try again later")
+
+    request = change_status(public_id, [RequestStatus.PAUSED], RequestStatus.PENDING)
+    dispatcher.wake()
+    return render_status(request)
@@ -1,10 +1,11 @@
-from flask import abort, g, Blueprint
+from flask import abort, current_app, g, request, Blueprint
 from flask.views import MethodView
+from sqlalchemy import select
 
-from ai_service_platform.models import db
-from ai_service_platform.models import models
+from ai_service_platform.models import db, models, source_tokens
 from ai_service_platform.models.models import Role
-from .auth import roles_required
+from .auth import roles_required, token_required
+from .batch import batch_state, create_batch, get_batch
 
 bp = Blueprint("source", __name__, url_prefix="/source")
 
@@ -14,14 +15,16 @@ class SourceList(MethodView):
     @roles_required([Role.USER2])
     # @bp.response(200, SourceSchema(many=True))
     def get(self):
-        user_sources = g.user.sources
+        user_sources = db.session.scalars(
+            select(models.Source).filter_by(owner_id=g.user.public_id)
+        ).all()
 
         return user_sources
 
     @bp.route("")
     @roles_required([Role.USER2])
     def post(self, data):
-        source = models.Source(**data, owner=g.user)
+        source = models.Source(**data, owner_id=g.user.public_id)
         db.session.add(source)
         db.session.commit()
 
@@ -41,3 +44,108 @@ class Source(MethodView):
         db.session.commit()
 
         return ""
+
+
+def get_owned_source(public_id) -> models.Source:
+    """Returns a source of the current user, any source for admins"""
+    source = db.session.get(models.Source, public_id)
+    if source is None or (
+        g.user.role is not Role.ADMIN and source.owner_id != g.user.public_id
+    ):
+        abort(404, "Could not find source")
+    return source
+
+
+def requested_max_age(data: dict) -> int | None:
+    """Returns the seconds a requested token is valid, from its ``max_age``
+
+    Aborts with 400 if it is not a whole number of seconds between 1 and
+    ``SOURCE_TOKEN_MAX_AGE``.
+    """
+    max_age = data.get("max_age")
+    if max_age is None:
+        return None
+    limit = current_app.config["SOURCE_TOKEN_MAX_AGE"]
+    # bool is an int as well, but surely not meant as seconds
+    if type(max_age) is not int or not 0 < max_age <= limit:
+        abort(400, f"max_age has to be a whole number of seconds from 1 to {limit}")
+    return max_age
+
+
+def requested_scopes(data: dict) -> list[str]:
+    """Returns the scopes of a requested token, all of them by default
+
+    Aborts with 400 if ``scopes`` is not a list of strings.
+    """
+    scopes = data.get("scopes", list(source_tokens.SCOPES))
+    if not isinstance(scopes, list) or not all(
+        isinstance(scope, str) for scope in scopes
+    ):
+        abort(400, "scopes has to be a list of strings")
+    return scopes
+
+
+@bp.route("/<uuid:public_id>/tokens", methods=["POST"])
+@roles_required([Role.ADMIN, Role.USER2])
+def create_token(public_id):
+    """Issues an API token for a source
+
+    Takes the ``scopes`` of the token and its ``max_age`` in seconds as JSON,
+    by default the token grants all scopes for ``SOURCE_TOKEN_MAX_AGE``, which
+    is also the longest ``max_age`` accepted.
+    """
+    source = get_owned_source(public_id)
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        abort(400, "Expected a JSON object")
+    try:
+        token = source_tokens.issue(
+            source, requested_scopes(data), requested_max_age(data)
+        )
+    except ValueError as e:
+        abort(400, str(e))
+
+    return {"token": token}, 201
+
+
+@bp.route("/<uuid:public_id>/tokens", methods=["DELETE"])
+@roles_required([Role.ADMIN, Role.USER2])
+def revoke_tokens(public_id):
+    """Revokes all API tokens of a source"""
+    source = get_owned_source(public_id)
+    source_tokens.revoke(source)
+    db.session.commit()
+
+    return ""
+
+
+@bp.route("/requests", methods=["POST"])
+@token_required(source_tokens.UPLOAD)
+def upload_requests():
+    """Creates a batch of requests from the uploaded images of a device
+
+    Takes the same multipart forms and archives as ``POST /batch``.
+    """
+    return create_batch(), 201
+
+
+@bp.route("/batches/<uuid:public_id>")
+@token_required(source_tokens.STATUS)
+def get_batch_state(public_id):
+    """Returns the progress of a batch of a device, see ``GET /batch/<id>``"""
+    return batch_state(get_batch(public_id))
+
+
+@bp.route("/requests/<uuid:public_id>")
+@token_required(source_tokens.STATUS)
+def get_request_status(public_id):
+    """Returns the status and the summarized output of a request of a device"""
+    row = db.session.execute(
+        select(models.Request.status, models.Request.summary).filter_by(
+            public_id=public_id, source_id=g.user.public_id
+        )
+    ).one_or_none()
+    if row is None:
+        abort(404, "Could not find request")
+
+    return {"public_id": public_id, "status": row.status.value, "summary": row.summary}
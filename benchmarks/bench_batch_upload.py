@@ -0,0 +1,114 @@
+"""Measures the submission overhead per image of single and batch uploads
+
+Uploads distinct images through ``POST /request``, one per call, and through
+``POST /batch`` as multipart forms and tar archives of ``--batch-size`` images.
+Nothing is processed, only the submission is timed.
+
+Run with ``python -m benchmarks.bench_batch_upload``.
+"""
+
+import argparse
+import io
+import tarfile
+import tempfile
+import time
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.models import Role
+from benchmarks.common import create_bench_app
+
+
+def images(count: int) -> list[bytes]:
+    """Returns ``count`` distinct small JPEG images"""
+    result = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (i % 256, i // 256 % 256, 0)).save(buffer, "JPEG")
+        result.append(buffer.getvalue())
+    return result
+
+
+def tar_archive(files: list[bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        for i, data in enumerate(files):
+            info = tarfile.TarInfo(f"{i}.jpg")
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    # Every run uploads new images, so none is deduplicated
+    files = images(3 * args.count)
+
+    def chunks(run: int) -> list[list[bytes]]:
+        offset = run * args.count
+        return [
+            files[start : start + args.batch_size]
+            for start in range(offset, offset + args.count, args.batch_size)
+        ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Nothing is processed, so the queue must take all uploads
+        app = create_bench_app(tmp, "http://unused", DISPATCHER_QUEUE_SIZE=10**6)
+        with app.app_context():
+            user = models.User(
+                name="bench", password=generate_password_hash("bench"), role=Role.USER1
+            )
+            model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+            db.session.add_all([user, model])
+            db.session.commit()
+            model_id = str(model.public_id)
+
+        client = app.test_client()
+        client.post("/auth/login", data={"username": "bench", "password": "bench"})
+
+        def single():
+            for data in files[: args.count]:
+                form = {"model": model_id, "input": (io.BytesIO(data), "image.jpg")}
+                response = client.post("/request", data=form)
+                assert response.status_code == 302
+
+        def multipart():
+            for chunk in chunks(1):
+                form = {
+                    "model": model_id,
+                    "input": [(io.BytesIO(data), "image.jpg") for data in chunk],
+                }
+                assert client.post("/batch", data=form).status_code == 201
+
+        def archive():
+            for chunk in chunks(2):
+                response = client.post(
+                    f"/batch?model={model_id}",
+                    data=tar_archive(chunk),
+                    content_type="application/x-tar",
+                )
+                assert response.status_code == 201
+
+        print(f"{args.count} images, batches of {args.batch_size}")
+        for name, run in [
+            ("one per call", single),
+            ("batch, multipart", multipart),
+            ("batch, tar", archive),
+        ]:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>18}: {elapsed / args.count * 1000:6.2f} ms per image, "
+                f"{args.count / elapsed:8.1f} images/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Compares inference throughput with and without micro-batching
+
+Queues requests for one model and measures how long the dispatcher needs to finish
+them against the stub model server, which charges a fixed overhead per call.
+
+Run with ``python -m benchmarks.bench_batching``.
+"""
+
+import argparse
+import tempfile
+
+from benchmarks.common import create_bench_app, process_all, queue_requests
+from tests.model_server import StubModelServer
+
+
+def run(count: int, batch_size: int, server: StubModelServer, workers: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            server.url,
+            DISPATCHER_WORKERS=workers,
+            DISPATCHER_BATCH_SIZE=batch_size,
+            DISPATCHER_QUEUE_SIZE=count,
+        )
+        with app.app_context():
+            queue_requests(count)
+            return process_all(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--per-input-latency", type=float, default=0.002)
+    args = parser.parse_args()
+
+    with StubModelServer(
+        latency=args.latency, per_input_latency=args.per_input_latency
+    ) as server:
+        for batch_size in (1, 4, 8, 16):
+            server.calls.clear()
+            elapsed = run(args.count, batch_size, server, args.workers)
+            print(
+                f"batch size {batch_size:>2}: {args.count / elapsed:7.1f} requests/s, "
+                f"{len(server.calls)} model server calls"
+            )
+
+
+if __name__ == "__main__":
+    main()
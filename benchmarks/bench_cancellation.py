@@ -0,0 +1,82 @@
+"""Measures how fast the workers get to other requests once running ones are paused
+
+Queues requests for a slow stub model server and starts the workers. Once they are
+busy, the claimed requests are either left running or paused like the pause view
+does, which drops the prefetched jobs and aborts the calls in flight. Reports the
+seconds until all other requests finished.
+
+Run with ``python -m benchmarks.bench_cancellation``.
+"""
+
+import argparse
+import tempfile
+import time
+
+from sqlalchemy import func, select, update
+
+from ai_service_platform.models import db, dispatcher, models
+from ai_service_platform.models.models import RequestStatus
+from benchmarks.common import create_bench_app, queue_requests
+from tests.model_server import StubModelServer
+
+Request = models.Request
+
+
+def run(args, server: StubModelServer, pause: bool) -> tuple[float, int]:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            server.url,
+            DISPATCHER_WORKERS=args.workers,
+            DISPATCHER_MODEL_CONCURRENCY=args.workers,
+            DISPATCHER_QUEUE_SIZE=args.count,
+        )
+        with app.app_context():
+            queue_requests(args.count)
+            start = time.perf_counter()
+            dispatcher.start()
+            while sum(dispatcher.stats()["running_per_model"].values()) < args.workers:
+                time.sleep(0.01)
+
+            claimed = db.session.scalars(
+                select(Request.public_id).where(Request.status == RequestStatus.RUNNING)
+            ).all()
+            if pause:
+                db.session.execute(
+                    update(Request)
+                    .where(Request.public_id.in_(claimed))
+                    .values(status=RequestStatus.PAUSED, lease_expires_at=None)
+                )
+                db.session.commit()
+                dispatcher.cancel(claimed)
+
+            others = select(func.count()).where(
+                Request.status == RequestStatus.FINISHED,
+                Request.public_id.not_in(claimed),
+            )
+            while db.session.scalar(others) < args.count - len(claimed):
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            dispatcher.shutdown()
+            db.engine.dispose()
+    return elapsed, len(claimed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with StubModelServer(latency=args.latency) as server:
+        for name, pause in [("running", False), ("paused", True)]:
+            elapsed, claimed = run(args, server, pause)
+            print(
+                f"{claimed} claimed requests {name:>7}: others finished after "
+                f"{elapsed:5.2f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Measures the status update throughput of the database backends
+
+Worker threads move requests through ``RUNNING`` to ``FINISHED`` like the request
+handler does, while reader threads poll the status changes like open request lists.
+Runs SQLite as configured by older versions (rollback journal, 5 s busy timeout),
+with WAL journaling, and with WAL and the coalescing status writer. PostgreSQL is
+measured as well when ``--postgres-url`` is given.
+
+Run with ``python -m benchmarks.bench_database``.
+"""
+
+import argparse
+import tempfile
+import threading
+import time
+
+from sqlalchemy import exc, select
+
+from ai_service_platform.models import db, models, status_writer
+from ai_service_platform.models.models import Base, utcnow
+from ai_service_platform.models.request_handler import finish_batch, start_batch
+from benchmarks.common import create_bench_app, queue_requests
+from tests.model_server import predict
+
+
+def run(config: dict, count: int, workers: int, readers: int) -> tuple[float, int]:
+    """Returns the status updates per second and the number of failed updates"""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(tmp, "http://unused", **config)
+        with app.app_context():
+            if db.engine.dialect.name != "sqlite":
+                # The database outlives the run, so it starts from empty tables
+                Base.metadata.drop_all(db.engine)
+                Base.metadata.create_all(db.engine)
+            queue_requests(count)
+            request_ids = db.session.scalars(select(models.Request.public_id)).all()
+        output = predict(b"car")
+        failed = 0
+        done = threading.Event()
+
+        def work(chunk):
+            nonlocal failed
+            with app.app_context():
+                for request_id in chunk:
+                    try:
+                        start_batch([request_id])
+                        finish_batch([request_id], [output])
+                    except exc.OperationalError:
+                        db.session.rollback()
+                        failed += 1
+
+        def read():
+            since = utcnow()
+            with app.app_context():
+                while not done.is_set():
+                    db.session.execute(
+                        select(models.Request.public_id, models.Request.status).where(
+                            models.Request.updated_at > since
+                        )
+                    ).all()
+                    db.session.rollback()
+                    time.sleep(0.01)
+
+        threads = [
+            threading.Thread(target=work, args=(request_ids[i::workers],))
+            for i in range(workers)
+        ]
+        pollers = [threading.Thread(target=read) for _ in range(readers)]
+        for thread in pollers:
+            thread.start()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        for thread in pollers:
+            thread.join()
+
+        with app.app_context():
+            status_writer.shutdown()
+            db.engine.dispose()
+        return 2 * (count - failed) / elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--postgres-url")
+    args = parser.parse_args()
+
+    backends = [
+        (
+            "sqlite, old defaults",
+            {"SQLITE_WAL": False, "SQLITE_BUSY_TIMEOUT": 5, "STATUS_WRITER": False},
+        ),
+        ("sqlite, WAL", {"STATUS_WRITER": False}),
+        ("sqlite, WAL, writer", {"STATUS_WRITER": True}),
+    ]
+    if args.postgres_url:
+        backends.append(("postgres, pooled", {"DATABASE_URL": args.postgres_url}))
+
+    print(
+        f"{args.count} requests, {args.workers} workers, {args.readers} pollers, "
+        "two status updates per request"
+    )
+    for name, config in backends:
+        throughput, failed = run(config, args.count, args.workers, args.readers)
+        print(f"{name:>22}: {throughput:8.1f} updates/s, {failed} failed requests")
+
+
+if __name__ == "__main__":
+    main()
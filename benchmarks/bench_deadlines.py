@@ -0,0 +1,103 @@
+"""Measures how many requests are answered in time when the workers are overloaded
+
+Queues a burst of requests for a slow stub model server, more than the workers can
+answer within ``--timeout`` seconds, and a second burst once that time passed.
+Without deadlines the workers answer the stale requests of the first burst while
+the second one waits. With deadlines the stale requests are shed and the workers
+get to the second burst right away. Reports the requests of each burst answered
+within ``--timeout`` seconds of being queued and the number of shed requests.
+
+Run with ``python -m benchmarks.bench_deadlines``.
+"""
+
+import argparse
+import tempfile
+import time
+from datetime import timedelta
+
+from sqlalchemy import func, select
+
+from ai_service_platform.models import db, deadlines, dispatcher, models
+from ai_service_platform.models.models import RequestStatus, utcnow
+from benchmarks.common import create_bench_app, queue_requests
+from tests.model_server import StubModelServer
+
+Request = models.Request
+
+
+def queue_burst(args, shed: bool) -> list:
+    """Queues ``--count`` requests and returns their public_ids"""
+    deadline = utcnow() + timedelta(seconds=args.timeout) if shed else None
+    request = db.session.scalar(select(Request).limit(1))
+    burst = [
+        Request(
+            user=request.user,
+            model=request.model,
+            input_file=request.input_file,
+            deadline=deadline,
+        )
+        for _ in range(args.count)
+    ]
+    db.session.add_all(burst)
+    db.session.commit()
+    return [request.public_id for request in burst]
+
+
+def answered_in_time(args, burst: list) -> int:
+    rows = db.session.execute(
+        select(Request.queued_at, Request.updated_at).where(
+            Request.public_id.in_(burst), Request.status == RequestStatus.FINISHED
+        )
+    ).all()
+    limit = timedelta(seconds=args.timeout)
+    return sum(1 for queued_at, updated_at in rows if updated_at - queued_at <= limit)
+
+
+def run(args, server: StubModelServer, shed: bool) -> tuple[list[int], dict]:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            server.url,
+            DISPATCHER_WORKERS=args.workers,
+            DISPATCHER_MODEL_CONCURRENCY=args.workers,
+        )
+        with app.app_context():
+            # One request for the user and model the bursts are queued for
+            queue_requests(1)
+            bursts = [queue_burst(args, shed)]
+            dispatcher.start()
+            time.sleep(args.timeout)
+            bursts.append(queue_burst(args, shed))
+
+            done = select(func.count()).where(
+                Request.status.in_([RequestStatus.FINISHED, RequestStatus.FAILED])
+            )
+            while db.session.scalar(done) < 2 * args.count + 1:
+                time.sleep(0.01)
+            dispatcher.shutdown()
+            in_time = [answered_in_time(args, burst) for burst in bursts]
+            shed_counts = deadlines.stats()["shed"]
+            db.engine.dispose()
+    return in_time, shed_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with StubModelServer(latency=args.latency) as server:
+        for name, shed in [("no deadlines", False), ("deadlines", True)]:
+            in_time, shed_counts = run(args, server, shed)
+            print(
+                f"{name:>12}: answered in time {in_time[0]:3d} + {in_time[1]:3d} "
+                f"of {2 * args.count}, shed {sum(shed_counts.values()):3d} "
+                f"{shed_counts}"
+            )
+
+
+if __name__ == "__main__":
+    main()
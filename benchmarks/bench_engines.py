@@ -0,0 +1,80 @@
+"""Compares the threaded and the asyncio execution engine
+
+Both engines process the same number of queued requests against the stub model
+server with the same number of predictions in flight. Every engine runs in its own
+process, so the reported peak memory (max RSS) is not shared between them.
+
+Run with ``python -m benchmarks.bench_engines``, requires ``httpx``.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.common import create_bench_app, process_all, queue_requests
+from tests.model_server import StubModelServer
+
+
+def run(engine: str, count: int, concurrency: int, url: str) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            url,
+            DISPATCHER_ENGINE=engine,
+            DISPATCHER_WORKERS=concurrency,
+            DISPATCHER_MODEL_CONCURRENCY=concurrency,
+            DISPATCHER_QUEUE_SIZE=count,
+        )
+        with app.app_context():
+            queue_requests(count)
+            elapsed = process_all(count)
+
+    return {
+        "engine": engine,
+        "requests_per_second": count / elapsed,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--engine", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        result = run(args.engine, args.count, args.concurrency, args.url)
+        print(json.dumps(result))
+        return
+
+    with StubModelServer(latency=args.latency) as server:
+        for engine in ("threads", "asyncio"):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_engines",
+                    f"--engine={engine}",
+                    f"--url={server.url}",
+                    f"--count={args.count}",
+                    f"--concurrency={args.concurrency}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(
+                f"{engine:>8}: {result['requests_per_second']:7.1f} requests/s, "
+                f"max RSS {result['max_rss_mb']:.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
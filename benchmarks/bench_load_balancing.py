@@ -0,0 +1,78 @@
+"""Compares inference throughput of one model server and several replicas
+
+Queues requests for one model and processes them against a single stub model
+server, then against replicas of which one is several times slower, balanced by
+least outstanding requests. Every server predicts ``--concurrency`` calls at a
+time.
+
+Run with ``python -m benchmarks.bench_load_balancing``.
+"""
+
+import argparse
+import tempfile
+from contextlib import ExitStack
+
+from sqlalchemy import select
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.models import utcnow
+from benchmarks.common import create_bench_app, process_all, queue_requests
+from tests.model_server import StubModelServer
+
+
+def run(args, servers: list[StubModelServer]) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            servers[0].url,
+            DISPATCHER_WORKERS=args.workers,
+            DISPATCHER_MODEL_CONCURRENCY=args.workers,
+            DISPATCHER_QUEUE_SIZE=args.count,
+        )
+        with app.app_context():
+            queue_requests(args.count)
+            if len(servers) > 1:
+                model = db.session.scalar(select(models.Model))
+                db.session.add_all(
+                    models.ModelEndpoint(
+                        model=model, url=server.url, healthy=True, warmed_at=utcnow()
+                    )
+                    for server in servers
+                )
+                db.session.commit()
+            return process_all(args.count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--slowdown", type=float, default=4)
+    parser.add_argument("--concurrency", type=int, default=2)
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        latencies = [args.latency * args.slowdown] + [args.latency] * (
+            args.replicas - 1
+        )
+        servers = [
+            stack.enter_context(
+                StubModelServer(latency=latency, concurrency=args.concurrency)
+            )
+            for latency in latencies
+        ]
+        for name, group in [("one server", servers[1:2]), ("replicas", servers)]:
+            for server in servers:
+                server.calls.clear()
+            elapsed = run(args, group)
+            calls = ", ".join(str(len(server.calls)) for server in group)
+            print(
+                f"{name:>10}: {args.count / elapsed:7.1f} requests/s, "
+                f"calls per server {calls}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Measures loading request rows with the outputs in and out of the request table
+
+Creates finished requests with a classification over ``--classes`` classes and
+loads them the way the request list does, once from the ``request_output`` layout
+and once with the outputs pickled into the request rows as older versions did.
+
+Run with ``python -m benchmarks.bench_outputs``.
+"""
+
+import argparse
+import pickle
+import tempfile
+import time
+
+from sqlalchemy import func, select, text
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.models import RequestStatus, Role
+from benchmarks.common import create_bench_app
+
+
+def add_requests(count: int, classes: int) -> None:
+    user = models.User(name="bench", password="", role=Role.USER1)
+    model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+    output = [
+        {"class": f"n{i:08d} class {i}", "probability": 1 / (i + 2)}
+        for i in range(classes)
+    ]
+    db.session.add_all(
+        models.Request(
+            user=user,
+            model=model,
+            input_file="car.jpg",
+            status=RequestStatus.FINISHED,
+            output=output,
+        )
+        for _ in range(count)
+    )
+    db.session.commit()
+
+    # The layout of older versions, next to the new one
+    with db.engine.begin() as connection:
+        connection.execute(text("ALTER TABLE request ADD COLUMN output BLOB"))
+        connection.execute(
+            text("UPDATE request SET output = :output"),
+            {"output": pickle.dumps(output)},
+        )
+
+
+def load_pages(page_size: int, repeat: int) -> float:
+    query = select(models.Request).order_by(models.Request.created_at.desc())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for request in db.session.scalars(query.limit(page_size)):
+            # What the list renders instead of the whole output
+            _ = request.summary
+        db.session.expunge_all()
+    return (time.perf_counter() - start) / repeat
+
+
+def load_legacy_pages(page_size: int, repeat: int) -> float:
+    query = text("SELECT * FROM request ORDER BY created_at DESC LIMIT :limit")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for row in db.session.execute(query, {"limit": page_size}).mappings():
+            pickle.loads(row["output"])
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--classes", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(tmp, "http://unused")
+        with app.app_context():
+            add_requests(args.count, args.classes)
+            summary_bytes, pickle_bytes = db.session.execute(
+                text("SELECT avg(length(summary)), avg(length(output)) FROM request")
+            ).one()
+            runs = [
+                ("pickled in request", pickle_bytes, load_legacy_pages),
+                ("request_output", summary_bytes, load_pages),
+            ]
+            print(f"{args.count} requests, {args.classes} classes per output")
+            for name, row_bytes, load in runs:
+                seconds = load(args.page_size, args.repeat)
+                print(
+                    f"{name:>20}: {row_bytes / 1024:7.2f} KiB output per row, "
+                    f"{seconds * 1000:7.2f} ms per page of {args.page_size}"
+                )
+            count = db.session.scalar(select(func.count(models.RequestOutput.output)))
+            assert count == args.count
+
+
+if __name__ == "__main__":
+    main()
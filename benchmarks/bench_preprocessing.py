@@ -0,0 +1,80 @@
+"""Measures the effect of preprocessing the inputs before inference
+
+Sends ``tests/car.jpg`` to the stub model server as it is and downscaled to the
+input format of SqueezeNet. To emulate photos taken with a phone, the image can also
+be upscaled first. The transfer time at a given bandwidth is estimated from the
+bytes sent per input, the round trip over the loopback interface is measured.
+
+Run with ``python -m benchmarks.bench_preprocessing``.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from ai_service_platform.models import model_client, preprocessing
+from ai_service_platform.models.preprocessing import InputFormat
+from benchmarks.common import create_bench_app
+from tests.model_server import StubModelServer
+
+SQUEEZENET = InputFormat(size=256, mode="RGB", quality=90)
+
+
+def create_input(folder: str, scale: int) -> str:
+    if scale == 1:
+        return os.path.join(folder, "car.jpg")
+    path = os.path.join(folder, f"car_x{scale}.jpg")
+    with Image.open("tests/car.jpg") as image:
+        size = (image.width * scale, image.height * scale)
+        image.resize(size, Image.Resampling.BICUBIC).save(path, quality=95)
+    return path
+
+
+def run(url: str, scale: int, calls: int, bandwidth: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(tmp, url, PREPROCESS_WORKERS=1)
+        with app.app_context():
+            # Starts the worker process, which is not part of the measurement
+            preprocessing.prepare(InputFormat(size=32), [create_input(tmp, 2)])
+            path = create_input(os.path.join(tmp, "uploads"), scale)
+
+            start = time.perf_counter()
+            (preprocessed,) = preprocessing.prepare(SQUEEZENET, [path])
+            preprocess_ms = (time.perf_counter() - start) * 1000
+
+            with Image.open(path) as image:
+                print(f"tests/car.jpg at {image.width}x{image.height}:")
+            variants = [("original", path), ("preprocessed", preprocessed)]
+            for name, input_path in variants:
+                size = os.path.getsize(input_path)
+                start = time.perf_counter()
+                for _ in range(calls):
+                    model_client.predict("squeezenet", [input_path])
+                call_ms = (time.perf_counter() - start) * 1000 / calls
+                transfer_ms = size * 8 / (bandwidth * 1e6) * 1000
+                print(
+                    f"  {name:>12}: {size / 1024:7.1f} KiB, "
+                    f"{call_ms:5.2f} ms per call, "
+                    f"{transfer_ms:6.2f} ms transfer at {bandwidth:g} Mbit/s"
+                )
+            print(f"  preprocessing once: {preprocess_ms:.1f} ms")
+            preprocessing.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 6])
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--bandwidth", type=float, default=100, help="Mbit/s")
+    args = parser.parse_args()
+
+    with StubModelServer() as server:
+        for scale in args.scales:
+            run(server.url, scale, args.calls, args.bandwidth)
+
+
+if __name__ == "__main__":
+    main()
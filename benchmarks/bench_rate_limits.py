@@ -0,0 +1,48 @@
+"""Measures the cost of a rate limit check per upload
+
+Checks uploads of many users against their token bucket, the bucket of the model
+and the daily quotas of their role, in memory and in the database.
+
+Run with ``python -m benchmarks.bench_rate_limits``.
+"""
+
+import argparse
+import tempfile
+import time
+import uuid
+
+from ai_service_platform.models import rate_limits
+from ai_service_platform.models.models import Role
+from ai_service_platform.models.principal_cache import Principal
+from benchmarks.common import create_bench_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    users = [Principal(uuid.uuid4(), "bench", Role.USER1) for _ in range(args.users)]
+    # Never short, so every check takes tokens from all buckets
+    config = {
+        "RATE_LIMITS": {"USER1": (10**6, 10**9)},
+        "RATE_LIMIT_MODEL": (10**6, 10**9),
+        "RATE_LIMIT_QUOTAS": {"USER1": (10**9, 10**15)},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend, count in [("memory", args.count), ("database", args.count // 100)]:
+            app = create_bench_app(
+                tmp, "http://unused", RATE_LIMIT_BACKEND=backend, **config
+            )
+            with app.app_context():
+                start = time.perf_counter()
+                for i in range(count):
+                    rate_limits.check(users[i % len(users)], "squeezenet", 1, 10_000)
+                elapsed = time.perf_counter() - start
+            print(f"{backend:>8}: {elapsed / count * 10**6:8.1f} us per check")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Measures the queue wait of interactive requests while a device floods the queue
+
+Queues a backlog of frames of one source and adds an interactive upload of a user
+every ``--interval`` seconds while the backlog is processed against the stub model
+server. Reports the p50 and p99 time until the uploads are finished and the queue
+wait per priority, once with the frames queued as bulk requests and once, as before
+priorities, in arrival order.
+
+Run with ``python -m benchmarks.bench_scheduling``.
+"""
+
+import argparse
+import tempfile
+import time
+
+from sqlalchemy import func, select
+
+from ai_service_platform.models import db, dispatcher, models
+from ai_service_platform.models.models import Priority, RequestStatus, Role
+from benchmarks.common import create_bench_app
+from tests.model_server import StubModelServer
+
+
+def percentiles(values: list[float]) -> str:
+    values = sorted(values)
+    p50 = values[len(values) // 2]
+    p99 = values[min(len(values) - 1, int(0.99 * len(values)))]
+    return f"p50 {p50 * 1000:8.1f} ms, p99 {p99 * 1000:8.1f} ms"
+
+
+def run(args, server: StubModelServer, frames: Priority) -> tuple[list, dict]:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(
+            tmp,
+            server.url,
+            DISPATCHER_WORKERS=args.workers,
+            DISPATCHER_QUEUE_SIZE=10**6,
+        )
+        with app.app_context():
+            owner = models.User(name="owner", password="", role=Role.USER2)
+            source = models.Source(name="camera", password="", owner=owner)
+            user = models.User(name="user", password="", role=Role.USER1)
+            model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+            db.session.add_all(
+                models.Request(
+                    user=owner,
+                    source=source,
+                    model=model,
+                    input_file="car.jpg",
+                    priority=frames,
+                )
+                for _ in range(args.frames)
+            )
+            db.session.add(user)
+            db.session.commit()
+
+            dispatcher.start()
+            interactive = []
+            for _ in range(args.uploads):
+                time.sleep(args.interval)
+                upload = models.Request(user=user, model=model, input_file="car.jpg")
+                db.session.add(upload)
+                db.session.commit()
+                interactive.append(upload.public_id)
+                dispatcher.wake()
+
+            pending = (
+                select(func.count())
+                .where(models.Request.public_id.in_(interactive))
+                .where(models.Request.status != RequestStatus.FINISHED)
+            )
+            while db.session.scalar(pending):
+                time.sleep(0.01)
+            waits = dispatcher.stats()["wait_time_per_priority"]
+            dispatcher.shutdown()
+            latencies = [
+                (updated_at - queued_at).total_seconds()
+                for queued_at, updated_at in db.session.execute(
+                    select(models.Request.queued_at, models.Request.updated_at).where(
+                        models.Request.public_id.in_(interactive)
+                    )
+                ).all()
+            ]
+            db.engine.dispose()
+            return latencies, waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=400)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+
+    with StubModelServer(latency=args.latency) as server:
+        for name, frames in [
+            ("arrival order", Priority.INTERACTIVE),
+            ("prioritized", Priority.BULK),
+        ]:
+            latencies, waits = run(args, server, frames)
+            print(f"{name}:")
+            print(f"  {'uploads':>11}: finished after {percentiles(latencies)}")
+            for priority, stats in sorted(waits.items()):
+                label = Priority(priority).name.lower()
+                print(
+                    f"  {label:>11}: {stats['count']:5d} requests waited "
+                    f"p50 {stats['p50'] * 1000:8.1f} ms, "
+                    f"p99 {stats['p99'] * 1000:8.1f} ms"
+                )
+
+
+if __name__ == "__main__":
+    main()
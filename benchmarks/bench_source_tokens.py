@@ -0,0 +1,78 @@
+"""Measures authenticating devices by password and by API token
+
+Compares checking the password hash of a source with verifying a signed token, and
+reports the device uploads per second through ``/source/requests`` with a token,
+one image per call and several per call.
+
+Run with ``python -m benchmarks.bench_source_tokens``.
+"""
+
+import argparse
+import io
+import tempfile
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from ai_service_platform.models import db, models, source_tokens
+from ai_service_platform.models.models import Role
+from benchmarks.common import create_bench_app
+
+
+def per_second(function, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=10)
+    args = parser.parse_args()
+
+    with open("tests/car.jpg", "rb") as file:
+        image = file.read()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Nothing is processed, so the queue must take all uploads
+        app = create_bench_app(tmp, "http://unused", DISPATCHER_QUEUE_SIZE=10**6)
+        with app.app_context():
+            password = generate_password_hash("secret")
+            owner = models.User(name="bench", password="", role=Role.USER2)
+            source = models.Source(name="camera", password=password, owner=owner)
+            model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+            db.session.add_all([source, model])
+            db.session.commit()
+            token = source_tokens.issue(source, list(source_tokens.SCOPES))
+            model_id = str(model.public_id)
+
+            checks = per_second(lambda: check_password_hash(password, "secret"), 20)
+            verifications = per_second(
+                lambda: source_tokens.verify(token, source_tokens.UPLOAD), args.count
+            )
+
+        client = app.test_client()
+        headers = {"Authorization": f"Bearer {token}"}
+
+        def upload(files):
+            form = {
+                "model": model_id,
+                "input": [(io.BytesIO(image), "car.jpg") for _ in range(files)],
+            }
+            response = client.post("/source/requests", data=form, headers=headers)
+            assert response.status_code == 201
+
+        single = per_second(lambda: upload(1), args.count // 10)
+        bulk = per_second(lambda: upload(args.files), args.count // 10 // args.files)
+
+    print(f"{'password hash checks':>24}: {checks:10.1f}/s")
+    print(f"{'token verifications':>24}: {verifications:10.1f}/s")
+    print(f"{'uploads, 1 per call':>24}: {single:10.1f} images/s")
+    name = f"uploads, {args.files} per call"
+    print(f"{name:>24}: {bulk * args.files:10.1f} images/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Measures the memory used per in-flight call to the model server
+
+Compares the streamed request bodies of the model server client with the buffered
+bodies it used before, where all inputs of a call were read and encoded in memory.
+A number of calls with large inputs is kept in flight at the same time against the
+stub model server. Each variant runs in its own process and reports
+
+* the bytes copied into Python objects per call, i.e. the peak of traced
+  allocations divided by the calls in flight
+* the growth of the anonymous resident memory per call, which excludes the pages
+  of memory mapped input files that the kernel can drop at any time
+
+Run with ``python -m benchmarks.bench_streaming``.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+import requests
+
+from ai_service_platform.models import model_client
+from benchmarks.common import create_bench_app
+from tests.model_server import StubModelServer
+
+
+def anonymous_rss() -> int:
+    """Returns the resident anonymous memory of this process in bytes"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("RssAnon is not reported by this system")
+
+
+def create_inputs(folder: str, count: int, size: int) -> list[str]:
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"{i}.jpg")
+        with open(path, "wb") as file:
+            file.write(b"\xff\xd8\xff" + os.urandom(size - 3))
+        paths.append(path)
+    return paths
+
+
+def post_buffered(session: requests.Session, url: str, paths: list[str]) -> None:
+    files = []
+    for path in paths:
+        with open(path, "rb") as file:
+            files.append(("data", (os.path.basename(path), file.read())))
+    session.post(url, files=files).raise_for_status()
+
+
+def run(variant: str, url: str, inflight: int, batch: int, size: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(tmp, url, MODEL_SERVER_POOL_SIZE=inflight)
+        paths = create_inputs(tmp, batch, size)
+        session = requests.Session()
+        start = threading.Barrier(inflight + 1)
+
+        def call():
+            start.wait()
+            if variant == "buffered":
+                post_buffered(session, f"{url}/predictions/squeezenet", paths)
+            else:
+                with app.app_context():
+                    model_client.predict("squeezenet", paths)
+
+        threads = [threading.Thread(target=call) for _ in range(inflight)]
+        for thread in threads:
+            thread.start()
+
+        peak_rss = baseline_rss = anonymous_rss()
+        tracemalloc.start()
+        start.wait()
+        while any(thread.is_alive() for thread in threads):
+            peak_rss = max(peak_rss, anonymous_rss())
+            threads[0].join(0.005)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "variant": variant,
+        "copied_mb_per_call": peak_traced / inflight / 2**20,
+        "rss_mb_per_call": (peak_rss - baseline_rss) / inflight / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--inflight", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--variant", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = int(args.size_mb * 2**20)
+
+    if args.variant:
+        result = run(args.variant, args.url, args.inflight, args.batch, size)
+        print(json.dumps(result))
+        return
+
+    print(
+        f"{args.inflight} calls in flight with {args.batch} inputs of "
+        f"{args.size_mb} MB each"
+    )
+    with StubModelServer(latency=args.latency) as server:
+        for variant in ("buffered", "streamed"):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_streaming",
+                    f"--variant={variant}",
+                    f"--url={server.url}",
+                    f"--inflight={args.inflight}",
+                    f"--batch={args.batch}",
+                    f"--size-mb={args.size_mb}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(
+                f"{variant:>8}: {result['copied_mb_per_call']:6.2f} MB copied, "
+                f"{result['rss_mb_per_call']:6.2f} MB anonymous RSS per call"
+            )
+
+
+if __name__ == "__main__":
+    main()
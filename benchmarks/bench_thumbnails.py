@@ -0,0 +1,104 @@
+"""Measures the image weight of the request list with and without thumbnails
+
+Creates requests with phone sized photos, renders the list of a user and fetches
+every image it references, once as the original upload and once as thumbnail. The
+thumbnails are fetched three times: when they are created, from the cache and
+revalidated by a browser that already has them.
+
+Run with ``python -m benchmarks.bench_thumbnails``.
+"""
+
+import argparse
+import re
+import tempfile
+import time
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from ai_service_platform.models import blob_store, db, models
+from ai_service_platform.models.models import RequestStatus, Role
+from ai_service_platform.models.result_cache import hash_file
+from benchmarks.common import create_bench_app
+
+
+def add_requests(folder: str, count: int, scale: int) -> None:
+    user = models.User(
+        name="bench", password=generate_password_hash("bench"), role=Role.USER1
+    )
+    model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+    with Image.open("tests/car.jpg") as image:
+        photo = image.resize((image.width * scale, image.height * scale))
+    for i in range(count):
+        # Every photo differs, so the blob store cannot share them
+        photo.putpixel((0, 0), (i % 256, i // 256, 0))
+        path = f"{folder}/photo.jpg"
+        photo.save(path, quality=90)
+        with open(path, "rb") as file:
+            input_hash = hash_file(file)
+            file.seek(0)
+            input_file = blob_store.put(file, input_hash, ".jpg")
+        db.session.add(
+            models.Request(
+                user=user,
+                model=model,
+                input_file=input_file,
+                input_hash=input_hash,
+                status=RequestStatus.FINISHED,
+            )
+        )
+    db.session.commit()
+
+
+def fetch_all(client, urls: list[str], etags: dict | None = None):
+    """Fetches the urls and returns the bytes received, the seconds and the ETags"""
+    start = time.perf_counter()
+    total = 0
+    received = {}
+    for url in urls:
+        headers = {"If-None-Match": f'"{etags[url]}"'} if etags else {}
+        response = client.get(url, headers=headers)
+        assert response.status_code in (200, 304), url
+        total += len(response.get_data())
+        received[url] = response.get_etag()[0]
+    return total, time.perf_counter() - start, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--scale", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_bench_app(tmp, "http://unused")
+        with app.app_context():
+            add_requests(tmp, args.count, args.scale)
+
+        client = app.test_client()
+        client.post("/auth/login", data={"username": "bench", "password": "bench"})
+        page = client.get("/request").get_data(as_text=True)
+        thumbnail_urls = re.findall(r'src="(/thumbnails/[^"]+)"', page)
+        upload_urls = [
+            url.replace("/thumbnails/", "/uploads/") for url in thumbnail_urls
+        ]
+
+        print(f"{len(thumbnail_urls)} requests, list page {len(page) / 1024:.1f} KiB")
+        etags = None
+        runs = [
+            ("originals", upload_urls, False),
+            ("thumbnails, created", thumbnail_urls, False),
+            ("thumbnails, cached", thumbnail_urls, False),
+            ("thumbnails, revalidated", thumbnail_urls, True),
+        ]
+        for name, urls, revalidate in runs:
+            total, elapsed, received = fetch_all(client, urls, revalidate and etags)
+            etags = received
+            print(
+                f"{name:>24}: {total / 2**20:7.2f} MiB images, "
+                f"{elapsed * 1000:7.1f} ms to serve"
+            )
+
+
+if __name__ == "__main__":
+    main()
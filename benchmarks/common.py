@@ -0,0 +1,56 @@
+import os
+import shutil
+import time
+
+from flask import Flask
+from sqlalchemy import func, select
+
+from ai_service_platform import create_app
+from ai_service_platform.models import db, dispatcher, models
+from ai_service_platform.models.models import RequestStatus, Role
+
+
+def create_bench_app(tmp: str, model_server_url: str, **config) -> Flask:
+    """Creates an app with an empty database in ``tmp`` and stopped workers"""
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_ENGINES": {"default": f"sqlite:///{tmp}/bench.db"},
+            "UPLOAD_FOLDER": os.path.join(tmp, "uploads"),
+            "THUMBNAIL_FOLDER": os.path.join(tmp, "thumbnails"),
+            "MODEL_SERVER_URL": model_server_url,
+            "DISPATCHER_EMBEDDED": False,
+            "DISPATCHER_POLL_INTERVAL": 0.05,
+            # Benchmarks upload faster than any user is allowed to
+            "RATE_LIMIT_BACKEND": None,
+            **config,
+        }
+    )
+    shutil.copy("tests/car.jpg", os.path.join(tmp, "uploads", "car.jpg"))
+    return app
+
+
+def queue_requests(count: int) -> None:
+    """Adds ``count`` pending requests for a SqueezeNet model"""
+    user = models.User(name="bench", password="", role=Role.USER1)
+    model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+    db.session.add_all(
+        models.Request(user=user, model=model, input_file="car.jpg")
+        for _ in range(count)
+    )
+    db.session.commit()
+
+
+def process_all(count: int) -> float:
+    """Starts the workers and returns the seconds until ``count`` requests finished"""
+    start = time.perf_counter()
+    dispatcher.start()
+    finished = select(func.count()).where(
+        models.Request.status == RequestStatus.FINISHED
+    )
+    while db.session.scalar(finished) < count:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    dispatcher.shutdown()
+    db.engine.dispose()
+    return elapsed
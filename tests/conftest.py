@@ -9,6 +9,7 @@ import pytest
 from ai_service_platform import create_app
 from ai_service_platform.models import db, models
 from ai_service_platform.models.models import Role, RequestStatus
+from tests.model_server import StubModelServer
 
 ADMIN_ID = "7cb6e818-45f0-482e-90af-e35d2f56fbfd"
 USER1_ID = "c8572b62-c5f4-419d-8744-dbee83c1ee58"
@@ -133,6 +134,52 @@ def app():
     os.unlink(db_path)
 
 
+@pytest.fixture
+def empty_app(tmp_path):
+    """Create an app with an empty database and without background workers."""
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_ENGINES": {"default": f"sqlite:///{tmp_path / 'test.db'}"},
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+            "THUMBNAIL_FOLDER": str(tmp_path / "thumbnails"),
+            "DISPATCHER_EMBEDDED": False,
+        }
+    )
+
+    yield app
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def model_server(empty_app):
+    """Run a stub model server and point the app at it."""
+    with StubModelServer() as server:
+        empty_app.config["MODEL_SERVER_URL"] = server.url
+        yield server
+
+
+@pytest.fixture
+def user_client(empty_app):
+    """Log in a USER1 user to an empty app with one model."""
+    with empty_app.app_context():
+        db.session.add(
+            models.User(
+                name="user1", password=generate_password_hash("user1"), role=Role.USER1
+            )
+        )
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+        empty_app.config["TEST_MODEL_ID"] = str(model.public_id)
+
+    client = empty_app.test_client()
+    client.post("/auth/login", data={"username": "user1", "password": "user1"})
+    return client
+
+
 @pytest.fixture
 def flask_test_client(app):
     return app.test_client()
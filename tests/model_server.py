@@ -0,0 +1,126 @@
+"""Stub of the multi-model-server prediction API for tests and benchmarks
+
+Run it standalone with ``python -m tests.model_server --port 8080``.
+"""
+
+import argparse
+import hashlib
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import Flask, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+CLASSES = ["beach wagon", "sports car", "racer", "convertible", "cab"]
+
+
+def predict(data: bytes) -> list[dict]:
+    """Returns fake but deterministic top 5 predictions for an input"""
+    digest = hashlib.sha256(data).digest()
+    weights = [byte + 1 for byte in digest[: len(CLASSES)]]
+    total = sum(weights)
+    predictions = [
+        {"class": name, "probability": weight / total}
+        for name, weight in zip(CLASSES, weights)
+    ]
+    return sorted(predictions, key=lambda p: p["probability"], reverse=True)
+
+
+def create_stub_app(
+    latency: float = 0.0,
+    per_input_latency: float = 0.0,
+    concurrency: int | None = None,
+) -> Flask:
+    """Creates the stub model server app
+
+    Args:
+        latency: Seconds every call to the prediction endpoint takes
+        per_input_latency: Additional seconds per input of a call
+        concurrency: Number of calls that are predicted at the same time, the
+            others wait
+    """
+    app = Flask(__name__)
+    slots = threading.Semaphore(concurrency) if concurrency else nullcontext()
+    app.config["CALLS"] = []
+    # Number of upcoming prediction calls to answer with 503
+    app.config["FAILURES"] = 0
+    # Number of upcoming prediction calls to answer with a body that is no JSON
+    app.config["MALFORMED"] = 0
+
+    @app.post("/predictions/<model_name>")
+    def predictions(model_name):
+        inputs = [file.read() for file in request.files.getlist("data")]
+        batched = bool(inputs)
+        if not batched:
+            inputs = [request.get_data()]
+
+        app.config["CALLS"].append((model_name, len(inputs)))
+        if app.config["FAILURES"]:
+            app.config["FAILURES"] -= 1
+            return {"code": 503, "message": "Model is not ready"}, 503
+        if app.config["MALFORMED"]:
+            app.config["MALFORMED"] -= 1
+            return "Prediction failed", 200
+        with slots:
+            time.sleep(latency + per_input_latency * len(inputs))
+
+        outputs = [predict(data) for data in inputs]
+        return outputs if batched else outputs[0]
+
+    @app.get("/ping")
+    def ping():
+        return {"status": "Healthy"}
+
+    return app
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class StubModelServer:
+    """Runs the stub app on a local port in a background thread"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **options):
+        self.app = create_stub_app(**options)
+        self._server = make_server(
+            host, port, self.app, threaded=True, request_handler=_QuietRequestHandler
+        )
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._server.host}:{self._server.port}"
+
+    @property
+    def calls(self) -> list[tuple[str, int]]:
+        """The model name and number of inputs of every prediction call"""
+        return self.app.config["CALLS"]
+
+    def fail_next(self, count: int) -> None:
+        """Answers the next ``count`` prediction calls with 503"""
+        self.app.config["FAILURES"] = count
+
+    def malform_next(self, count: int) -> None:
+        """Answers the next ``count`` prediction calls with a body that is no JSON"""
+        self.app.config["MALFORMED"] = count
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    create_stub_app(latency=args.latency).run(host=args.host, port=args.port)
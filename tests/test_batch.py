@@ -0,0 +1,168 @@
+import io
+import os
+import tarfile
+import threading
+import uuid
+import zipfile
+
+from sqlalchemy import select
+
+from ai_service_platform.models import blob_store, db, models
+from ai_service_platform.models.models import RequestStatus
+from ai_service_platform.models.request_handler import process_requests
+from ai_service_platform.uploads import UploadRequest
+
+with open("tests/car.jpg", "rb") as f:
+    CAR = f.read()
+with open("tests/dog.jpg", "rb") as f:
+    DOG = f.read()
+
+
+def post_files(app, client, files):
+    form = {
+        "model": app.config["TEST_MODEL_ID"],
+        "input": [(io.BytesIO(data), f"{i}.jpg") for i, data in enumerate(files)],
+    }
+    return client.post("/batch", data=form, content_type="multipart/form-data")
+
+
+def tar_archive(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for i, data in enumerate(files):
+            info = tarfile.TarInfo(f"frames/{i}.jpg")
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def zip_archive(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for i, data in enumerate(files):
+            archive.writestr(f"frames/{i}.jpg", data)
+    return buffer.getvalue()
+
+
+def test_multipart_batch(empty_app, user_client):
+    response = post_files(empty_app, user_client, [CAR, DOG, CAR])
+    assert response.status_code == 201
+    body = response.get_json()
+    assert len(body["requests"]) == 3
+
+    with empty_app.app_context():
+        batch = db.session.get(models.Batch, uuid.UUID(body["batch"]))
+        assert batch.size == 3
+        assert {str(request.public_id) for request in batch.requests} == set(
+            body["requests"]
+        )
+        assert len({request.queued_at for request in batch.requests}) == 1
+        ref_counts = db.session.scalars(select(models.Blob.ref_count)).all()
+        assert sorted(ref_counts) == [1, 2]
+
+    state = user_client.get(f"/batch/{body['batch']}").get_json()
+    assert state["statuses"] == {"pending": 3}
+    assert not state["done"]
+
+
+def test_archive_batches(empty_app, user_client):
+    model_id = empty_app.config["TEST_MODEL_ID"]
+    for archive, content_type in [
+        (tar_archive([CAR, DOG]), "application/gzip"),
+        (zip_archive([CAR, DOG]), "application/zip"),
+    ]:
+        response = user_client.post(
+            f"/batch?model={model_id}", data=archive, content_type=content_type
+        )
+        assert response.status_code == 201
+        assert len(response.get_json()["requests"]) == 2
+
+    response = user_client.post(
+        f"/batch?model={model_id}",
+        data=tar_archive([CAR, b"GIF89a"]),
+        content_type="application/gzip",
+    )
+    assert response.status_code == 415
+    response = user_client.post(
+        f"/batch?model={model_id}", data=b"no zip", content_type="application/zip"
+    )
+    assert response.status_code == 400
+
+    empty_app.config["BATCH_MAX_FILES"] = 1
+    assert post_files(empty_app, user_client, [CAR, DOG]).status_code == 413
+    with empty_app.app_context():
+        assert len(db.session.scalars(select(models.Request)).all()) == 4
+
+
+def test_zip_size_limit(empty_app, user_client):
+    empty_app.config["BATCH_MAX_FILES"] = 1
+    empty_app.config["UPLOAD_MAX_SIZE"] = 1024
+    model_id = empty_app.config["TEST_MODEL_ID"]
+
+    # Rejected while it is spooled, before its index is read
+    response = user_client.post(
+        f"/batch?model={model_id}",
+        data=zip_archive([bytes(256 * 1024)]),
+        content_type="application/zip",
+    )
+    assert response.status_code == 413
+    assert b"Archive is too large" in response.data
+    with empty_app.app_context():
+        assert os.listdir(blob_store.temp_folder()) == []
+
+
+def test_multipart_file_limit(empty_app, user_client, monkeypatch):
+    empty_app.config["BATCH_MAX_FILES"] = 2
+    streams = []
+    original = UploadRequest._get_file_stream
+
+    def get_file_stream(self, *args, **kwargs):
+        streams.append(args)
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(UploadRequest, "_get_file_stream", get_file_stream)
+    response = post_files(empty_app, user_client, [CAR, DOG, CAR, DOG, CAR])
+
+    # Rejected at the first file over the limit, without reading the others
+    assert response.status_code == 413
+    assert len(streams) == 3
+    with empty_app.app_context():
+        assert os.listdir(blob_store.temp_folder()) == []
+
+
+def test_batch_fits_into_queue(empty_app, user_client):
+    empty_app.config["DISPATCHER_QUEUE_SIZE"] = 3
+    assert post_files(empty_app, user_client, [CAR]).status_code == 201
+
+    # Admitted as a whole or not at all
+    assert post_files(empty_app, user_client, [CAR, DOG, CAR]).status_code == 429
+    assert post_files(empty_app, user_client, [CAR, DOG, CAR, DOG]).status_code == 413
+    assert post_files(empty_app, user_client, [CAR, DOG]).status_code == 201
+    with empty_app.app_context():
+        assert len(db.session.scalars(select(models.Request)).all()) == 3
+
+
+def test_batch_events(empty_app, model_server, user_client):
+    empty_app.config["STATUS_PUSH"] = True
+    empty_app.config["STATUS_PUSH_KEEPALIVE"] = 0.1
+    empty_app.config["STATUS_PUSH_DURATION"] = 5
+    body = post_files(empty_app, user_client, [CAR, DOG]).get_json()
+
+    def process():
+        with empty_app.app_context():
+            process_requests([uuid.UUID(value) for value in body["requests"]])
+
+    timer = threading.Timer(0.2, process)
+    timer.start()
+    response = user_client.get(f"/batch/{body['batch']}/events")
+    timer.join()
+
+    events, done = response.get_data(as_text=True).split("event: done")
+    assert events.count('"status": "pending"') == 2
+    assert events.count('"status": "finished"') == 2
+    assert '"done": true' in done
+
+    state = user_client.get(f"/batch/{body['batch']}").get_json()
+    assert state["done"]
+    assert state["statuses"] == {RequestStatus.FINISHED.value: 2}
+    assert all(request["summary"] for request in state["requests"])
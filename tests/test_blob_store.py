@@ -0,0 +1,122 @@
+import os
+import shutil
+
+from sqlalchemy import select
+
+from ai_service_platform.models import blob_store, db, models
+from ai_service_platform.models.models import Blob, Role
+from ai_service_platform.models.result_cache import hash_file
+
+
+def create_owner():
+    user = models.User(name="user1", password="", role=Role.USER1)
+    model = models.Model(name="squeezenet", server_model_name="squeezenet")
+    db.session.add_all([user, model])
+    return user, model
+
+
+def create_request(user, model):
+    with open("tests/car.jpg", "rb") as file:
+        input_hash = hash_file(file)
+        file.seek(0)
+        input_file = blob_store.put(file, input_hash, ".jpg")
+    request = models.Request(
+        user=user, model=model, input_file=input_file, input_hash=input_hash
+    )
+    db.session.add(request)
+    db.session.commit()
+    return request
+
+
+def test_put_deduplicates(empty_app):
+    with empty_app.app_context():
+        user, model = create_owner()
+        first = create_request(user, model)
+        second = create_request(user, model)
+
+        assert first.input_file == second.input_file
+        assert first.input_file.count("/") == 2
+        assert os.path.isfile(blob_store.absolute_path(first.input_file))
+        assert db.session.get(Blob, first.input_hash).ref_count == 2
+
+
+def test_delete_releases_blob(empty_app):
+    with empty_app.app_context():
+        user, model = create_owner()
+        first = create_request(user, model)
+        second = create_request(user, model)
+        path = blob_store.absolute_path(first.input_file)
+
+        db.session.delete(first)
+        db.session.commit()
+        assert os.path.isfile(path)
+        assert db.session.get(Blob, second.input_hash).ref_count == 1
+
+        # Deleting the user cascades to the remaining request
+        db.session.delete(user)
+        db.session.commit()
+        assert not os.path.exists(path)
+        assert db.session.get(Blob, second.input_hash) is None
+
+
+def test_cascaded_deletes_release_blobs(empty_app):
+    with empty_app.app_context():
+        user, model = create_owner()
+        source = models.Source(owner=user, name="camera", password="")
+        db.session.add(source)
+        request = create_request(user, model)
+        batch = models.Batch(user_id=user.public_id, model_id=model.public_id, size=1)
+        batch.requests = [request]
+        db.session.add(batch)
+        db.session.commit()
+        source.requests = [create_request(user, model)]
+        db.session.commit()
+        path = blob_store.absolute_path(request.input_file)
+
+        db.session.delete(batch)
+        db.session.commit()
+        assert db.session.get(Blob, request.input_hash).ref_count == 1
+
+        db.session.delete(source)
+        db.session.commit()
+        assert not os.path.exists(path)
+        assert db.session.scalars(select(models.Request)).all() == []
+
+
+def test_reused_blob_is_kept(empty_app):
+    with empty_app.app_context():
+        user, model = create_owner()
+        first = create_request(user, model)
+        path = blob_store.absolute_path(first.input_file)
+
+        # The last reference is released and taken again before it is committed
+        db.session.delete(first)
+        db.session.flush()
+        second = create_request(user, model)
+
+        assert os.path.isfile(path)
+        assert db.session.get(Blob, second.input_hash).ref_count == 1
+
+
+def test_migrate_uploads(empty_app):
+    upload_folder = empty_app.config["UPLOAD_FOLDER"]
+    with empty_app.app_context():
+        user, model = create_owner()
+        for name in ["a_car.jpg", "b_car.jpg", "gone.jpg"]:
+            db.session.add(models.Request(user=user, model=model, input_file=name))
+            if name != "gone.jpg":
+                shutil.copy("tests/car.jpg", os.path.join(upload_folder, name))
+        db.session.commit()
+
+        migrated, missing = blob_store.migrate_uploads(chunk_size=1)
+
+        assert (migrated, missing) == (2, ["gone.jpg"])
+        assert not os.path.exists(os.path.join(upload_folder, "a_car.jpg"))
+        input_files = db.session.scalars(
+            select(models.Request.input_file).where(
+                models.Request.input_hash.is_not(None)
+            )
+        ).all()
+        assert len(set(input_files)) == 1
+        with open("tests/car.jpg", "rb") as file:
+            assert db.session.get(Blob, hash_file(file)).ref_count == 2
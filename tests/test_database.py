@@ -0,0 +1,23 @@
+from sqlalchemy import text
+
+from ai_service_platform.models import db
+from ai_service_platform.models.database import engine_options
+
+
+def test_sqlite_uses_wal(empty_app):
+    with empty_app.app_context(), db.engine.connect() as connection:
+        assert connection.scalar(text("PRAGMA journal_mode")) == "wal"
+        assert connection.scalar(text("PRAGMA busy_timeout")) == 30_000
+
+
+def test_engine_options_pool_other_backends(empty_app):
+    config = dict(empty_app.config)
+    assert "pool_size" not in engine_options(config)
+
+    config["DATABASE_URL"] = "postgresql+psycopg://app@db/app"
+    config["SQLALCHEMY_ENGINES"] = {"default": {"url": "sqlite://", "pool_size": 3}}
+    options = engine_options(config)
+    assert options["url"] == "postgresql+psycopg://app@db/app"
+    assert options["pool_size"] == 3
+    assert options["max_overflow"] == 20
+    assert options["pool_pre_ping"] is True
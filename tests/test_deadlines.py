@@ -0,0 +1,142 @@
+import asyncio
+import io
+import time
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import select
+
+from ai_service_platform.models import (
+    async_model_client,
+    db,
+    deadlines,
+    model_registry,
+    models,
+    status_writer,
+)
+from ai_service_platform.models.job_queue import claim_jobs
+from ai_service_platform.models.model_client import DeadlineExceeded
+from ai_service_platform.models.models import RequestStatus, utcnow
+from ai_service_platform.models.request_handler import (
+    process_requests,
+    process_requests_async,
+    start_batch,
+)
+from tests.model_server import StubModelServer
+from tests.test_request_handler import add_requests
+
+
+def set_deadlines(request_ids, seconds):
+    for request_id in request_ids:
+        request = db.session.get(models.Request, request_id)
+        request.deadline = utcnow() + timedelta(seconds=seconds)
+    db.session.commit()
+
+
+def status(request_id):
+    db.session.expire_all()
+    return db.session.get(models.Request, request_id).status
+
+
+def test_deadline(empty_app):
+    model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+    with empty_app.app_context():
+        assert deadlines.deadline(model) is None
+
+        empty_app.config["REQUEST_TIMEOUT"] = 60
+        model.request_timeout = 30
+        start = utcnow()
+        # The submitter can only shorten the timeout of the model
+        assert deadlines.deadline(model) - start >= timedelta(seconds=30)
+        assert deadlines.deadline(model, 10) - start < timedelta(seconds=11)
+        assert deadlines.deadline(model, 45) - start < timedelta(seconds=31)
+
+
+def test_expired_requests_are_not_claimed(empty_app):
+    with empty_app.app_context():
+        expired, pending = add_requests(empty_app, 2)
+        set_deadlines([expired], -1)
+        set_deadlines([pending], 60)
+
+        jobs = claim_jobs(10)
+
+        assert [job.request_id for job in jobs] == [pending]
+        assert status(expired) == RequestStatus.FAILED
+        assert deadlines.stats() == {
+            "shed": {"queued": 1, "dispatched": 0, "timed_out": 0},
+            "shed_per_model": {"squeezenet": 1},
+        }
+
+
+def test_late_requests_are_not_sent(empty_app):
+    with StubModelServer(latency=0.5) as server:
+        empty_app.config["MODEL_SERVER_URL"] = server.url
+        with empty_app.app_context():
+            first, late, kept = add_requests(empty_app, 3)
+            process_requests([first])
+            assert model_registry.expected_latency("squeezenet") >= 0.5
+
+            # Less time left than the last call took
+            set_deadlines([late], 0.2)
+            set_deadlines([kept], 30)
+            batch = start_batch([late, kept])
+
+            assert batch.request_ids == [kept]
+            assert batch.deadline == pytest.approx(time.time() + 30, abs=5)
+            # The failed status is written in the background
+            status_writer.submit([])
+            assert status(late) == RequestStatus.FAILED
+            assert deadlines.stats()["shed"]["dispatched"] == 1
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_deadline_bounds_call(empty_app, engine):
+    with StubModelServer(latency=5) as server:
+        empty_app.config["MODEL_SERVER_URL"] = server.url
+        if engine == "asyncio":
+            empty_app.config["DISPATCHER_ENGINE"] = "asyncio"
+            async_model_client.init_app(empty_app)
+        with empty_app.app_context():
+            (request_id,) = add_requests(empty_app, 1)
+            set_deadlines([request_id], 0.5)
+
+            start = time.monotonic()
+            with pytest.raises(DeadlineExceeded):
+                if engine == "asyncio":
+                    asyncio.run(process_requests_async([request_id]))
+                else:
+                    process_requests([request_id])
+            elapsed = time.monotonic() - start
+
+            assert status(request_id) == RequestStatus.FAILED
+            assert deadlines.stats()["shed"]["timed_out"] == 1
+            (endpoint,) = model_registry.stats()["endpoints"]
+
+    # Neither retried nor counted against the model server
+    assert elapsed < 2
+    assert len(server.calls) == 1
+    assert endpoint["failures"] == 0
+
+
+def test_users_post_timeout(empty_app, user_client):
+    with open("tests/car.jpg", "rb") as f:
+        car = f.read()
+
+    def upload(timeout):
+        form = {
+            "model": empty_app.config["TEST_MODEL_ID"],
+            "input": (io.BytesIO(car), "car.jpg"),
+            "timeout": timeout,
+        }
+        return user_client.post(
+            "/request", data=form, content_type="multipart/form-data"
+        )
+
+    assert upload("soon").status_code == 400
+    assert upload("-1").status_code == 400
+    start = utcnow()
+    assert upload("30").status_code == 302
+
+    with empty_app.app_context():
+        request = db.session.scalar(select(models.Request))
+        assert timedelta(seconds=29) < request.deadline - start < timedelta(seconds=31)
@@ -0,0 +1,261 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+from flask import Flask
+
+from ai_service_platform.models import cancellation
+from ai_service_platform.models.dispatcher import Dispatcher, Job, _FairQueue
+
+
+def create_dispatcher(handler, async_handler=None, **config):
+    app = Flask(__name__)
+    app.config.update(config)
+    dispatcher = Dispatcher()
+    dispatcher.init_app(app, handler, async_handler=async_handler)
+    return app, dispatcher
+
+
+def test_submit_processes_jobs():
+    done = []
+    finished = threading.Event()
+
+    def handler(request_ids):
+        done.extend(request_ids)
+        if len(done) == 5:
+            finished.set()
+
+    app, dispatcher = create_dispatcher(handler, DISPATCHER_WORKERS=2)
+    ids = [uuid.uuid4() for _ in range(5)]
+    with app.app_context():
+        for request_id in ids:
+            dispatcher.submit(request_id, "squeezenet")
+
+        assert finished.wait(5)
+        assert sorted(done) == sorted(ids)
+        dispatcher.shutdown()
+        assert dispatcher.stats()["completed"] == 5
+
+
+def test_model_concurrency_limit():
+    lock = threading.Lock()
+    active = {"squeezenet": 0, "FERPlus": 0}
+    peak = {"squeezenet": 0, "FERPlus": 0}
+    keys = {}
+
+    def handler(request_ids):
+        key = keys[request_ids[0]]
+        with lock:
+            active[key] += 1
+            peak[key] = max(peak[key], active[key])
+        time.sleep(0.02)
+        with lock:
+            active[key] -= 1
+
+    app, dispatcher = create_dispatcher(
+        handler,
+        DISPATCHER_WORKERS=4,
+        DISPATCHER_MODEL_CONCURRENCY=1,
+        DISPATCHER_MODEL_LIMITS={"FERPlus": 3},
+    )
+    with app.app_context():
+        for i in range(12):
+            request_id = uuid.uuid4()
+            keys[request_id] = "squeezenet" if i % 2 else "FERPlus"
+            dispatcher.submit(request_id, keys[request_id])
+
+        while dispatcher.stats()["completed"] < 12:
+            time.sleep(0.01)
+        dispatcher.shutdown()
+
+    assert peak["squeezenet"] == 1
+    assert peak["FERPlus"] <= 3
+
+
+def test_feeder_claims_jobs():
+    backlog = [uuid.uuid4() for _ in range(10)]
+    done = []
+    limits = []
+
+    def claim(limit):
+        limits.append(limit)
+        jobs = [Job(request_id, "squeezenet") for request_id in backlog[:limit]]
+        del backlog[:limit]
+        return jobs
+
+    app = Flask(__name__)
+    app.config.update(DISPATCHER_WORKERS=2, DISPATCHER_POLL_INTERVAL=0.01)
+    dispatcher = Dispatcher()
+    dispatcher.init_app(app, done.extend, claim=claim)
+
+    with app.app_context():
+        while len(done) < 10:
+            time.sleep(0.01)
+        dispatcher.shutdown()
+
+    assert len(set(done)) == 10
+    # never claims more than the free workers plus prefetch
+    assert max(limits) <= 4
+
+
+def test_batches_jobs_per_model():
+    batches = []
+    keys = {}
+
+    def handler(request_ids):
+        time.sleep(0.05)
+        batches.append(request_ids)
+
+    app, dispatcher = create_dispatcher(
+        handler,
+        DISPATCHER_WORKERS=1,
+        DISPATCHER_BATCH_SIZE=4,
+        DISPATCHER_BATCH_WAIT=0.05,
+    )
+    with app.app_context():
+        for i in range(10):
+            request_id = uuid.uuid4()
+            keys[request_id] = "FERPlus" if i == 5 else "squeezenet"
+            dispatcher.submit(request_id, keys[request_id])
+
+        while dispatcher.stats()["completed"] < 10:
+            time.sleep(0.01)
+        dispatcher.shutdown()
+
+    assert sum(len(batch) for batch in batches) == 10
+    assert max(len(batch) for batch in batches) == 4
+    assert len(batches) < 10
+    for batch in batches:
+        assert len({keys[request_id] for request_id in batch}) == 1
+
+
+def test_asyncio_engine():
+    in_flight = 0
+    peak = 0
+    done = []
+
+    async def handler(request_ids):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        done.extend(request_ids)
+
+    app, dispatcher = create_dispatcher(
+        None,
+        async_handler=handler,
+        DISPATCHER_ENGINE="asyncio",
+        DISPATCHER_WORKERS=50,
+        DISPATCHER_MODEL_CONCURRENCY=40,
+        DISPATCHER_QUEUE_SIZE=200,
+    )
+    with app.app_context():
+        for _ in range(200):
+            dispatcher.submit(uuid.uuid4(), "squeezenet")
+
+        while len(done) < 200:
+            time.sleep(0.01)
+        dispatcher.shutdown()
+        assert dispatcher.stats()["completed"] == 200
+
+    assert peak == 40
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_cancel_jobs(engine):
+    running, queued, other = [uuid.uuid4() for _ in range(3)]
+    started = threading.Event()
+    handled = []
+
+    def handler(request_ids):
+        handled.extend(request_ids)
+        started.set()
+        if request_ids == [running]:
+            # Stands in for a long call to the model server
+            cancellation.current().sleep(10)
+
+    async def async_handler(request_ids):
+        handled.extend(request_ids)
+        started.set()
+        if request_ids == [running]:
+            await asyncio.sleep(10)
+
+    app, dispatcher = create_dispatcher(
+        handler,
+        async_handler=async_handler,
+        DISPATCHER_ENGINE=engine,
+        DISPATCHER_WORKERS=1,
+        DISPATCHER_BATCH_WAIT=0,
+    )
+    with app.app_context():
+        for request_id in (running, queued, other):
+            dispatcher.submit(request_id, "squeezenet")
+        assert started.wait(5)
+
+        start = time.monotonic()
+        assert dispatcher.cancel([running, queued, uuid.uuid4()]) == 2
+        # The worker does not finish the cancelled job before taking the next one
+        while dispatcher.stats()["completed"] < 1:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        dispatcher.shutdown()
+        stats = dispatcher.stats()
+
+    assert handled == [running, other]
+    assert elapsed < 5
+    assert (stats["cancelled"], stats["completed"], stats["failed"]) == (2, 1, 0)
+    assert stats["queue_depth"] == 0
+
+
+def test_fair_queue_remove():
+    queue = _FairQueue()
+    for i in range(5):
+        queue.append(Job(i, "squeezenet", priority=i % 2, tenant=i))
+
+    removed = queue.remove({1, 2, 7})
+
+    assert sorted(job.request_id for job in removed) == [1, 2]
+    assert [queue.popleft().request_id for _ in range(len(queue))] == [0, 4, 3]
+
+
+def test_fair_queue():
+    queue = _FairQueue()
+    for i in range(4):
+        queue.append(Job(i, "squeezenet", priority=1, tenant="device"))
+    queue.append(Job("a", "squeezenet", priority=1, tenant="user"))
+    queue.append(Job("b", "squeezenet", priority=1, tenant="heavy", weight=2))
+    queue.append(Job("c", "squeezenet", priority=1, tenant="heavy", weight=2))
+    queue.append(Job("u", "squeezenet", priority=0, tenant="user"))
+
+    order = [queue.popleft().request_id for _ in range(len(queue))]
+
+    # The interactive job first, then the tenants take turns by weight
+    assert order == ["u", "b", 0, "a", "c", 1, 2, 3]
+    assert not queue.heaps and not queue.tags
+
+
+def test_wait_times_per_priority():
+    backlog = [Job(uuid.uuid4(), "squeezenet", priority=i % 2) for i in range(6)]
+    done = []
+
+    def claim(limit):
+        jobs = backlog[:limit]
+        del backlog[:limit]
+        return jobs
+
+    app = Flask(__name__)
+    app.config.update(DISPATCHER_WORKERS=2, DISPATCHER_POLL_INTERVAL=0.01)
+    dispatcher = Dispatcher()
+    dispatcher.init_app(app, done.extend, claim=claim)
+
+    with app.app_context():
+        while len(done) < 6:
+            time.sleep(0.01)
+        dispatcher.shutdown()
+        waits = dispatcher.stats()["wait_time_per_priority"]
+
+    assert [waits[priority]["count"] for priority in (0, 1)] == [3, 3]
+    assert waits[0]["p99"] >= waits[0]["p50"] >= 0
@@ -0,0 +1,158 @@
+import uuid
+
+from sqlalchemy import create_engine, inspect, select, text, update
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.job_queue import (
+    abandoned_jobs,
+    claim_jobs,
+    count_pending,
+    requeue_expired,
+)
+from ai_service_platform.models.models import Priority, RequestStatus, Role
+from ai_service_platform.models.schema import upgrade_schema
+
+
+def add_requests(count):
+    user = models.User(name="user1", password="", role=Role.USER1)
+    model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+    requests = [
+        models.Request(user=user, model=model, input_file=f"{i}.jpg")
+        for i in range(count)
+    ]
+    db.session.add_all(requests)
+    db.session.commit()
+    return [request.public_id for request in requests]
+
+
+def test_claim_jobs_oldest_first(empty_app):
+    with empty_app.app_context():
+        ids = add_requests(5)
+
+        jobs = claim_jobs(3)
+
+        assert [job.request_id for job in jobs] == ids[:3]
+        assert all(job.model_key == "squeezenet" for job in jobs)
+        assert count_pending(10) == 2
+
+        # claimed requests are not handed out twice
+        jobs = claim_jobs(10)
+        assert [job.request_id for job in jobs] == ids[3:]
+        assert claim_jobs(10) == []
+
+        request = db.session.get(models.Request, ids[0])
+        assert request.status == RequestStatus.RUNNING
+        assert request.attempts == 1
+        assert request.lease_expires_at is not None
+
+
+def test_claim_jobs_by_priority_and_share(empty_app):
+    with empty_app.app_context():
+        device = add_requests(6)
+        user = models.User(name="user2", password="", role=Role.USER2)
+        model = db.session.scalar(select(models.Model))
+        later = [
+            models.Request(user=user, model=model, input_file=f"{i}.jpg")
+            for i in range(2)
+        ]
+        db.session.add_all(later)
+        db.session.execute(
+            update(models.Request)
+            .where(models.Request.public_id.in_(device))
+            .values(priority=Priority.BULK)
+        )
+        db.session.commit()
+        interactive = [request.public_id for request in later]
+
+        # Interactive requests are claimed before older bulk requests
+        jobs = claim_jobs(3)
+        assert [job.request_id for job in jobs[:2]] == interactive
+        assert [job.priority for job in jobs] == [0, 0, 1]
+        assert jobs[0].tenant == user.public_id
+
+        # Tenants of the same priority take turns by weight
+        db.session.execute(
+            update(models.Request)
+            .where(models.Request.public_id.in_(interactive))
+            .values(status=RequestStatus.PENDING, priority=Priority.BULK)
+        )
+        db.session.commit()
+        empty_app.config["DISPATCHER_TENANT_WEIGHTS"] = {str(user.public_id): 2}
+        claimed = [job.request_id for job in claim_jobs(4)]
+        assert set(claimed) == {*interactive, *device[1:3]}
+
+
+def test_share_beyond_claim_window(empty_app):
+    empty_app.config["DISPATCHER_CLAIM_WINDOW"] = 2
+    with empty_app.app_context():
+        # A backlog of one tenant that is larger than the window
+        backlog = add_requests(20)
+        user = models.User(name="user2", password="", role=Role.USER2)
+        model = db.session.scalar(select(models.Model))
+        request = models.Request(user=user, model=model, input_file="late.jpg")
+        db.session.add(request)
+        db.session.commit()
+
+        claimed = [job.request_id for job in claim_jobs(2)]
+        assert claimed == [backlog[0], request.public_id]
+
+
+def test_requeue_expired(empty_app):
+    empty_app.config["DISPATCHER_LEASE_SECONDS"] = -1
+    empty_app.config["DISPATCHER_MAX_ATTEMPTS"] = 2
+
+    with empty_app.app_context():
+        (request_id,) = add_requests(1)
+
+        assert len(claim_jobs(1)) == 1
+        # the expired lease puts the request back into the queue
+        assert len(claim_jobs(1)) == 1
+
+        requeue_expired()
+        request = db.session.get(models.Request, request_id)
+        assert request.status == RequestStatus.FAILED
+        assert count_pending(10) == 0
+
+
+def test_paused_requests_are_not_claimed(empty_app):
+    with empty_app.app_context():
+        paused, deleted, running = add_requests(3)
+        assert len(claim_jobs(3)) == 3
+
+        db.session.get(models.Request, paused).status = RequestStatus.PAUSED
+        db.session.delete(db.session.get(models.Request, deleted))
+        db.session.commit()
+        assert sorted(abandoned_jobs([paused, deleted, running])) == sorted(
+            [paused, deleted]
+        )
+
+        # Resuming puts it back into the queue
+        db.session.get(models.Request, paused).status = RequestStatus.PENDING
+        db.session.commit()
+        assert [job.request_id for job in claim_jobs(3)] == [paused]
+
+
+def test_upgrade_schema_adds_missing_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE request (public_id CHAR(32) PRIMARY KEY, "
+                "user_id CHAR(32), source_id CHAR(32), model_id CHAR(32), "
+                "patient_id VARCHAR, input_file VARCHAR, output BLOB, "
+                "status VARCHAR(8))"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO request (public_id, status) VALUES (:id, 'PENDING')"),
+            {"id": uuid.uuid4().hex},
+        )
+
+    upgrade_schema(engine)
+
+    columns = {column["name"] for column in inspect(engine).get_columns("request")}
+    assert {"queued_at", "lease_expires_at", "attempts"} <= columns
+    indexes = {index["name"] for index in inspect(engine).get_indexes("request")}
+    assert "ix_request_status_priority_queued_at" in indexes
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT attempts FROM request")).scalar() == 0
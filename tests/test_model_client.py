@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from ai_service_platform.models import async_model_client, model_client, model_registry
+from ai_service_platform.models.cancellation import Cancelled, CancelToken, scope
+from ai_service_platform.models.input_body import InputBody
+from ai_service_platform.models.model_client import (
+    CircuitBreaker,
+    CircuitOpen,
+    DeadlineExceeded,
+    ModelServerError,
+)
+from tests.model_server import StubModelServer, predict
+
+INPUT = "tests/car.jpg"
+
+
+def test_predict_single(empty_app, model_server):
+    with empty_app.app_context():
+        (output,) = model_client.predict("squeezenet", [INPUT])
+
+    assert output[0]["class"]
+    assert model_server.calls == [("squeezenet", 1)]
+
+
+def test_predict_batch(empty_app, model_server):
+    with empty_app.app_context():
+        outputs = model_client.predict("squeezenet", [INPUT, "tests/dog.jpg"])
+
+    assert len(outputs) == 2
+    assert outputs[0] != outputs[1]
+    assert model_server.calls == [("squeezenet", 2)]
+
+
+def test_predict_retries(empty_app, model_server):
+    empty_app.config["MODEL_SERVER_BACKOFF"] = 0
+    model_server.fail_next(2)
+
+    with empty_app.app_context():
+        (output,) = model_client.predict("squeezenet", [INPUT])
+        assert model_client.stats()["retried"] == 2
+
+    # The retried call sent the complete input again
+    with open(INPUT, "rb") as file:
+        assert output == predict(file.read())
+    assert len(model_server.calls) == 3
+
+
+def test_async_predict_retries(empty_app, model_server):
+    empty_app.config.update(DISPATCHER_ENGINE="asyncio", MODEL_SERVER_BACKOFF=0)
+    async_model_client.init_app(empty_app)
+    model_server.fail_next(2)
+
+    with empty_app.app_context():
+        (output,) = asyncio.run(async_model_client.predict("squeezenet", [INPUT]))
+        # Both clients count their calls the same way
+        assert async_model_client.stats() == {
+            "calls": 3,
+            "retried": 2,
+            "failures": 0,
+            "open_circuits": [],
+        }
+
+    with open(INPUT, "rb") as file:
+        assert output == predict(file.read())
+
+
+def test_predict_fails_after_retries(empty_app, model_server):
+    model_server.fail_next(10)
+
+    with empty_app.app_context(), pytest.raises(ModelServerError):
+        model_client.predict("squeezenet", [INPUT])
+
+    assert len(model_server.calls) == empty_app.config["MODEL_SERVER_RETRIES"] + 1
+
+
+def test_backoff_ends_at_deadline(empty_app, model_server):
+    empty_app.config["MODEL_SERVER_BACKOFF"] = 30
+    model_client.init_app(empty_app)
+    model_server.fail_next(10)
+
+    start = time.monotonic()
+    with empty_app.app_context(), pytest.raises(DeadlineExceeded):
+        model_client.predict("squeezenet", [INPUT], time.time() + 0.3)
+
+    assert time.monotonic() - start < 2
+    assert len(model_server.calls) == 1
+
+
+def test_predict_unreachable(empty_app):
+    empty_app.config["MODEL_SERVER_URL"] = "http://127.0.0.1:9"
+
+    with empty_app.app_context(), pytest.raises(ModelServerError):
+        model_client.predict("squeezenet", [INPUT])
+
+
+def test_predict_cancelled(empty_app):
+    token = CancelToken()
+    errors = []
+
+    def call():
+        with empty_app.app_context(), scope(token):
+            try:
+                model_client.predict("squeezenet", [INPUT])
+            except Cancelled as e:
+                errors.append(e)
+
+    with StubModelServer(latency=10) as server:
+        empty_app.config["MODEL_SERVER_URL"] = server.url
+        thread = threading.Thread(target=call)
+        thread.start()
+        while not server.calls:
+            time.sleep(0.01)
+
+        start = time.monotonic()
+        token.cancel()
+        thread.join(5)
+        elapsed = time.monotonic() - start
+
+        with empty_app.app_context():
+            (endpoint,) = model_registry.stats()["endpoints"]
+
+    # The call is aborted instead of waiting for the answer or being retried
+    assert elapsed < 1
+    assert [type(e) for e in errors] == [Cancelled]
+    assert len(server.calls) == 1
+    assert (endpoint["outstanding"], endpoint["failures"]) == (0, 0)
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+
+    breaker.record_failure("squeezenet")
+    assert breaker.allow("squeezenet")
+    breaker.record_failure("squeezenet")
+    assert not breaker.allow("squeezenet")
+    assert breaker.allow("FERPlus")
+
+    time.sleep(0.05)
+    # a single trial call is let through
+    assert breaker.allow("squeezenet")
+    assert not breaker.allow("squeezenet")
+
+    breaker.record_success("squeezenet")
+    assert breaker.allow("squeezenet")
+
+
+def test_predict_circuit_open(empty_app, model_server):
+    empty_app.extensions["model_client"].breaker = CircuitBreaker(1, 60)
+    model_server.fail_next(10)
+
+    with empty_app.app_context():
+        with pytest.raises(ModelServerError):
+            model_client.predict("squeezenet", [INPUT])
+        calls = len(model_server.calls)
+
+        with pytest.raises(CircuitOpen):
+            model_client.predict("squeezenet", [INPUT])
+
+    assert len(model_server.calls) == calls
+
+
+def test_input_body_multipart():
+    body = InputBody([INPUT, "tests/dog.jpg"], chunk_size=1000)
+
+    # Bodies can be sent again, e.g. on retries
+    for _ in range(2):
+        data = b"".join(bytes(chunk) for chunk in body)
+        assert len(data) == len(body)
+
+        environ = EnvironBuilder(
+            method="POST", data=data, content_type=body.content_type
+        ).get_environ()
+        files = Request(environ).files.getlist("data")
+        for file, path in zip(files, [INPUT, "tests/dog.jpg"], strict=True):
+            with open(path, "rb") as f:
+                assert file.read() == f.read()
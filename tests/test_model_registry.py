@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy import select
+
+from ai_service_platform.models import db, model_client, model_registry, models
+from ai_service_platform.models.model_client import ModelServerError
+from ai_service_platform.models.models import utcnow
+from tests.model_server import StubModelServer
+
+INPUT = "tests/car.jpg"
+
+
+def add_endpoints(app, *urls, weights=None, ready=False):
+    """Adds endpoints serving the squeezenet model, warmed up and healthy if ready"""
+    with app.app_context():
+        model = models.Model(name="SqueezeNet", server_model_name="squeezenet")
+        for i, url in enumerate(urls):
+            db.session.add(
+                models.ModelEndpoint(
+                    model=model,
+                    url=url,
+                    weight=weights[i] if weights else 1.0,
+                    healthy=ready or None,
+                    warmed_at=utcnow() if ready else None,
+                )
+            )
+        db.session.commit()
+
+
+def test_least_outstanding(empty_app):
+    add_endpoints(
+        empty_app, "http://a", "http://b", "http://c/", weights=[1, 1, 2], ready=True
+    )
+
+    with empty_app.app_context():
+        endpoints = [model_registry.acquire("squeezenet") for _ in range(8)]
+        urls = [endpoint.url for endpoint in endpoints]
+        # In flight calls are spread by weight
+        assert sorted(urls) == ["http://a"] * 2 + ["http://b"] * 2 + ["http://c"] * 4
+
+        for endpoint in endpoints[1:]:
+            model_registry.release(endpoint, ok=True)
+        assert model_registry.acquire("squeezenet").url != endpoints[0].url
+
+        # Endpoints that keep failing get no traffic
+        b = next(endpoint for endpoint in endpoints if endpoint.url == "http://b")
+        for _ in range(empty_app.config["MODEL_REGISTRY_MAX_FAILURES"]):
+            model_registry.acquire("squeezenet")
+            model_registry.release(b, ok=False)
+        assert not b.ready
+        assert "http://b" not in {
+            model_registry.acquire("squeezenet").url for _ in range(10)
+        }
+
+        # Other models are served by the MODEL_SERVER_URL
+        empty_app.config["MODEL_SERVER_URL"] = "http://default/"
+        assert model_registry.acquire("FERPlus").url == "http://default"
+        empty_app.config["MODEL_SERVER_URL"] = None
+        assert model_registry.acquire("FERPlus") is None
+
+
+def test_probe_warms_up_new_endpoints(empty_app):
+    with StubModelServer() as server:
+        add_endpoints(empty_app, server.url, "http://127.0.0.1:9")
+
+        with empty_app.app_context():
+            model_registry.probe()
+            stats = model_registry.stats()
+            rows = db.session.execute(
+                select(
+                    models.ModelEndpoint.url,
+                    models.ModelEndpoint.healthy,
+                    models.ModelEndpoint.warmed_at,
+                )
+            ).all()
+
+            (output,) = model_client.predict("squeezenet", [INPUT])
+            # Warmed up once
+            model_registry.probe()
+
+    warmups = empty_app.config["MODEL_REGISTRY_WARMUP_CALLS"]
+    assert server.calls == [("squeezenet", 1)] * (warmups + 1)
+    assert output
+    assert stats["warmups"] == warmups
+    ready = {endpoint["url"]: endpoint["ready"] for endpoint in stats["endpoints"]}
+    assert ready == {server.url: True, "http://127.0.0.1:9": False}
+    health = {url: (healthy, warmed_at is not None) for url, healthy, warmed_at in rows}
+    assert health == {server.url: (True, True), "http://127.0.0.1:9": (False, False)}
+
+
+def test_predict_retries_other_endpoint(empty_app):
+    empty_app.config["MODEL_SERVER_BACKOFF"] = 0
+    with StubModelServer() as first, StubModelServer() as second:
+        add_endpoints(empty_app, first.url, second.url, ready=True)
+        first.fail_next(10)
+        second.fail_next(1)
+
+        with empty_app.app_context():
+            # Failed calls are retried on the other endpoint
+            for _ in range(4):
+                model_client.predict("squeezenet", [INPUT])
+            ready = {e["url"]: e["ready"] for e in model_registry.stats()["endpoints"]}
+            calls = len(second.calls)
+
+            second.fail_next(10)
+            with pytest.raises(ModelServerError):
+                model_client.predict("squeezenet", [INPUT])
+
+    assert len(first.calls) == empty_app.config["MODEL_REGISTRY_MAX_FAILURES"]
+    assert ready == {first.url: False, second.url: True}
+    retries = empty_app.config["MODEL_SERVER_RETRIES"]
+    assert len(second.calls) == calls + retries + 1
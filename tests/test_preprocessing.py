@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from ai_service_platform.models import db, preprocessing
+from ai_service_platform.models.preprocessing import (
+    InputFormat,
+    preprocess,
+    preprocessed_path,
+)
+from ai_service_platform.models.request_handler import process_requests
+from tests.model_server import predict
+from tests.test_blob_store import create_owner, create_request
+
+
+def test_preprocess(tmp_path):
+    path = str(tmp_path / "car.jpg")
+    shutil.copy("tests/car.jpg", path)
+    input_format = InputFormat(size=120, mode="L", quality=80)
+
+    target = preprocess(path, input_format)
+
+    assert target == preprocessed_path(path, input_format)
+    assert target.endswith("/car.120lq80.jpg")
+    with Image.open(target) as image:
+        assert image.size == (160, 120)
+        assert image.mode == "L"
+    assert os.path.getsize(target) < os.path.getsize(path)
+
+
+def test_preprocess_keeps_small_inputs(tmp_path):
+    path = str(tmp_path / "car.jpg")
+    shutil.copy("tests/car.jpg", path)
+
+    assert preprocess(path, InputFormat(size=480)) == path
+
+
+def test_broken_pool_is_replaced(empty_app, tmp_path, caplog):
+    empty_app.config["PREPROCESS_WORKERS"] = 1
+    preprocessing.init_app(empty_app)
+    path = str(tmp_path / "car.jpg")
+    shutil.copy("tests/car.jpg", path)
+    input_format = InputFormat(size=120)
+    with empty_app.app_context():
+        state = preprocessing._get_state()
+        broken = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+        with pytest.raises(BrokenProcessPool):
+            broken.submit(os._exit, 1).result()
+        state.pool = broken
+
+        try:
+            assert preprocessing.prepare(input_format, [path]) == [
+                preprocessed_path(path, input_format)
+            ]
+        finally:
+            preprocessing.shutdown()
+
+        assert state.pool is not broken
+        assert "Preprocessing pool broke" in caplog.text
+
+
+def test_process_requests_sends_preprocessed(empty_app, model_server):
+    empty_app.config["PREPROCESS_WORKERS"] = 1
+    preprocessing.init_app(empty_app)
+    with empty_app.app_context():
+        user, model = create_owner()
+        model.input_size = 64
+        request = create_request(user, model)
+        original = os.path.join(empty_app.config["UPLOAD_FOLDER"], request.input_file)
+
+        try:
+            process_requests([request.public_id])
+        finally:
+            preprocessing.shutdown()
+
+        target = preprocessed_path(original, InputFormat(64))
+        with open(target, "rb") as file:
+            assert request.output == predict(file.read())
+
+        # The preprocessed input is removed together with its original
+        db.session.delete(request)
+        db.session.commit()
+        assert not os.path.exists(original)
+        assert not os.path.exists(target)
@@ -0,0 +1,63 @@
+from sqlalchemy import event, select
+
+from ai_service_platform.models import db, models, principal_cache
+from ai_service_platform.models.models import Role
+
+
+def count_queries(app):
+    queries = []
+    with app.app_context():
+        event.listen(
+            db.engine, "before_cursor_execute", lambda *args: queries.append(1)
+        )
+    return queries
+
+
+def test_requests_reuse_the_principal(empty_app, user_client):
+    queries = count_queries(empty_app)
+    assert user_client.get("/").status_code == 200
+    assert queries
+
+    queries.clear()
+    assert user_client.get("/").status_code == 200
+    assert not queries
+
+    with empty_app.app_context():
+        stats = principal_cache.stats()
+    assert (stats["size"], stats["hits"]) == (1, 1)
+
+
+def test_role_change_invalidates(empty_app, user_client):
+    assert user_client.get("/metrics").status_code == 302
+
+    with empty_app.app_context():
+        user = db.session.scalar(select(models.User).filter_by(name="user1"))
+        user.role = Role.DEV
+        db.session.commit()
+
+    assert user_client.get("/metrics").status_code == 200
+
+
+def test_delete_invalidates(empty_app, user_client):
+    with empty_app.app_context():
+        user = db.session.scalar(select(models.User).filter_by(name="user1"))
+        admin = models.User(name="admin", password="", role=Role.ADMIN)
+        source = models.Source(name="camera", password="", owner=user)
+        db.session.add_all([admin, source])
+        db.session.commit()
+        admin_id, user_id = admin.public_id, user.public_id
+        source_id = source.public_id
+        assert principal_cache.get_source(source_id).user_id == user_id
+
+    assert user_client.get("/").status_code == 200
+
+    admin_client = empty_app.test_client()
+    with admin_client.session_transaction() as session:
+        session["user_id"] = admin_id
+    assert admin_client.delete(f"/user/{user_id}").status_code == 200
+
+    # The sources of the user are deleted with it
+    assert user_client.get("/").status_code == 302
+    with empty_app.app_context():
+        assert principal_cache.get_source(source_id) is None
+        assert principal_cache.stats()["invalidations"] >= 2
@@ -0,0 +1,115 @@
+import io
+import time
+import uuid
+
+import pytest
+
+from ai_service_platform.models import rate_limits
+from ai_service_platform.models.models import Role
+from ai_service_platform.models.principal_cache import Principal
+
+with open("tests/car.jpg", "rb") as f:
+    CAR = f.read()
+
+
+def configure(app, backend="memory", **config):
+    app.config.update(
+        {
+            "RATE_LIMIT_BACKEND": backend,
+            "RATE_LIMITS": {},
+            "RATE_LIMIT_MODEL": None,
+            "RATE_LIMIT_MODELS": {},
+            "RATE_LIMIT_QUOTAS": {},
+            **config,
+        }
+    )
+    rate_limits.init_app(app)
+
+
+def rejected(principal, model_key="squeezenet", count=1, size=0):
+    try:
+        rate_limits.check(principal, model_key, count, size)
+    except rate_limits.RateLimited as error:
+        return error
+    return None
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_token_buckets(empty_app, backend):
+    configure(
+        empty_app,
+        backend,
+        RATE_LIMITS={"USER1": (10, 3)},
+        RATE_LIMIT_MODELS={"resnet": (0.5, 4)},
+    )
+    user = Principal(uuid.uuid4(), "user1", Role.USER1)
+    other = Principal(uuid.uuid4(), "other", Role.USER1)
+    third = Principal(uuid.uuid4(), "third", Role.USER1)
+
+    with empty_app.app_context():
+        assert rejected(user, count=2) is None
+        assert rejected(user) is None
+        error = rejected(user)
+        assert str(error) == "Too many uploads, try again later"
+        assert 0 < error.retry_after <= 0.1
+        # More than the burst is never accepted
+        assert rejected(other, count=4).retry_after is None
+
+        time.sleep(0.2)
+        assert rejected(user, count=2) is None
+
+        # A short model bucket takes no tokens from the others
+        assert rejected(other, "resnet", count=3) is None
+        error = rejected(third, "resnet", count=2)
+        assert str(error) == "Too many uploads for this model, try again later"
+        assert 1 < error.retry_after <= 2
+        assert rejected(third, count=3) is None
+
+        # Unlimited roles
+        assert rejected(Principal(uuid.uuid4(), "admin", Role.ADMIN), count=100) is None
+
+        stats = rate_limits.stats()
+    assert stats["accepted"] == 6
+    assert stats["rejected"] == {"principal": 2, "model": 1}
+
+
+def test_daily_quotas(empty_app):
+    configure(empty_app, RATE_LIMIT_QUOTAS={"SOURCE": (3, 1000)})
+    source = Principal(uuid.uuid4(), "camera", Role.SOURCE, uuid.uuid4())
+
+    with empty_app.app_context():
+        assert rejected(source, count=2, size=600) is None
+        error = rejected(source, size=600)
+        assert str(error) == "Daily upload quota exceeded"
+        # Quotas start over with the next UTC day
+        now = time.time()
+        assert error.retry_after == pytest.approx(86400 - now % 86400, abs=1)
+        assert rejected(source, size=400) is None
+        assert rejected(source) is not None
+
+
+def test_uploads_over_limit(empty_app, user_client):
+    configure(empty_app, RATE_LIMITS={"USER1": (0.1, 2)})
+
+    def upload():
+        form = {
+            "model": empty_app.config["TEST_MODEL_ID"],
+            "input": (io.BytesIO(CAR), "car.jpg"),
+        }
+        return user_client.post("/request", data=form)
+
+    assert [upload().status_code for _ in range(2)] == [302, 302]
+    response = upload()
+    assert response.status_code == 429
+    assert 9 <= int(response.headers["Retry-After"]) <= 10
+
+    form = {
+        "model": empty_app.config["TEST_MODEL_ID"],
+        "input": [(io.BytesIO(CAR), f"{i}.jpg") for i in range(3)],
+    }
+    response = user_client.post("/batch", data=form)
+    assert response.status_code == 429
+    assert "Retry-After" not in response.headers
+
+    configure(empty_app, None, RATE_LIMITS={"USER1": (0.1, 2)})
+    assert upload().status_code == 302
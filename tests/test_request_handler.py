@@ -1,4 +1,34 @@
-from ai_service_platform.models.request_handler import *
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from ai_service_platform.models import async_model_client, db, model_client, models
+from ai_service_platform.models.model_client import ModelServerError
+from ai_service_platform.models.models import RequestStatus, Role
+from ai_service_platform.models.request_handler import (
+    finish_batch,
+    process_request,
+    process_requests,
+    process_requests_async,
+    start_batch,
+)
+
+
+def add_requests(app, count, server_model_name="squeezenet"):
+    user = models.User(name="user1", password="", role=Role.USER1)
+    model = models.Model(name=server_model_name, server_model_name=server_model_name)
+    batch = []
+    for i in range(count):
+        filename = f"{i}_car.jpg"
+        shutil.copy(
+            "tests/car.jpg", os.path.join(app.config["UPLOAD_FOLDER"], filename)
+        )
+        batch.append(models.Request(user=user, model=model, input_file=filename))
+    db.session.add_all(batch)
+    db.session.commit()
+    return [request.public_id for request in batch]
 
 
 def test_load_model_from_binary():
@@ -6,6 +36,101 @@ def test_load_model_from_binary():
     pass
 
 
-def test_process_request():
-    # TODO: write test
-    pass
+def test_process_request(empty_app, model_server):
+    with empty_app.app_context():
+        (request_id,) = add_requests(empty_app, 1)
+
+        process_request(request_id)
+
+        request = db.session.get(models.Request, request_id)
+        assert request.status == RequestStatus.FINISHED
+        assert request.output[0]["class"]
+        assert model_server.calls == [("squeezenet", 1)]
+
+
+def test_process_requests_batch(empty_app, model_server):
+    with empty_app.app_context():
+        request_ids = add_requests(empty_app, 3)
+
+        process_requests(request_ids)
+
+        for request_id in request_ids:
+            request = db.session.get(models.Request, request_id)
+            assert request.status == RequestStatus.FINISHED
+            assert len(request.output) == 5
+        assert model_server.calls == [("squeezenet", 3)]
+
+
+def test_process_requests_skips_finished(empty_app, model_server):
+    with empty_app.app_context():
+        (request_id,) = add_requests(empty_app, 1)
+        db.session.get(models.Request, request_id).status = RequestStatus.FINISHED
+        db.session.commit()
+
+        process_requests([request_id])
+
+        assert model_server.calls == []
+
+
+def test_finish_skips_paused_and_deleted(empty_app, model_server):
+    with empty_app.app_context():
+        paused, deleted, kept = add_requests(empty_app, 3)
+        batch = start_batch([paused, deleted, kept])
+        db.session.get(models.Request, paused).status = RequestStatus.PAUSED
+        db.session.delete(db.session.get(models.Request, deleted))
+        db.session.commit()
+
+        outputs = model_client.predict(batch.model_key, batch.input_paths)
+        finish_batch(batch.request_ids, outputs)
+
+        db.session.expire_all()
+        assert db.session.get(models.Request, paused).status == RequestStatus.PAUSED
+        assert db.session.get(models.Request, paused).output is None
+        assert db.session.get(models.Request, deleted) is None
+        assert db.session.get(models.Request, kept).status == RequestStatus.FINISHED
+
+
+def test_process_requests_async(empty_app, model_server):
+    empty_app.config["DISPATCHER_ENGINE"] = "asyncio"
+    async_model_client.init_app(empty_app)
+
+    with empty_app.app_context():
+        request_ids = add_requests(empty_app, 2)
+
+        asyncio.run(process_requests_async(request_ids))
+
+        for request_id in request_ids:
+            request = db.session.get(models.Request, request_id)
+            assert request.status == RequestStatus.FINISHED
+            assert len(request.output) == 5
+        assert model_server.calls == [("squeezenet", 2)]
+
+
+def test_process_requests_malformed_answer(empty_app, model_server):
+    model_server.malform_next(1)
+
+    with empty_app.app_context():
+        request_ids = add_requests(empty_app, 2)
+
+        with pytest.raises(ModelServerError):
+            process_requests(request_ids)
+
+        # Failed right away instead of waiting for the lease to expire
+        for request_id in request_ids:
+            request = db.session.get(models.Request, request_id)
+            assert request.status == RequestStatus.FAILED
+        assert model_server.calls == [("squeezenet", 2)]
+
+
+def test_process_requests_missing_input(empty_app, model_server):
+    with empty_app.app_context():
+        (request_id,) = add_requests(empty_app, 1)
+        request = db.session.get(models.Request, request_id)
+        os.remove(os.path.join(empty_app.config["UPLOAD_FOLDER"], request.input_file))
+
+        with pytest.raises(FileNotFoundError):
+            process_requests([request_id])
+
+        db.session.expire_all()
+        assert db.session.get(models.Request, request_id).status == RequestStatus.FAILED
+        assert model_server.calls == []
@@ -0,0 +1,101 @@
+import html
+import re
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, text
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.models import RequestStatus
+from ai_service_platform.models.schema import upgrade_schema
+
+
+def add_requests(app, count):
+    with app.app_context():
+        user = db.session.scalar(select(models.User))
+        model = db.session.scalar(select(models.Model))
+        start = datetime(2024, 1, 1)
+        requests = [
+            models.Request(
+                user=user,
+                model=model,
+                input_file=f"{i}.jpg",
+                status=RequestStatus.FINISHED if i % 2 else RequestStatus.PENDING,
+                created_at=start + timedelta(days=i),
+            )
+            for i in range(count)
+        ]
+        db.session.add_all(requests)
+        db.session.commit()
+        return [str(request.public_id) for request in requests]
+
+
+def listed(page):
+    return re.findall(r'id="status-([0-9a-f-]+)"', page)
+
+
+def test_list_is_paginated(empty_app, user_client):
+    empty_app.config["REQUEST_PAGE_SIZE"] = 2
+    request_ids = add_requests(empty_app, 5)
+    statements = []
+    with empty_app.app_context():
+        event.listen(
+            db.engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+        )
+
+    seen = []
+    url = "/request"
+    while url:
+        statements.clear()
+        page = user_client.get(url).get_data(as_text=True)
+        seen.extend(listed(page))
+        # The models of the requests are loaded together with them
+        assert sum("FROM request" in statement for statement in statements) == 1
+        older = re.search(r'href="(/request\?after=[^"]+)">Older', page)
+        url = older and html.unescape(older.group(1))
+
+    assert seen == request_ids[::-1]
+
+
+def test_list_filters(empty_app, user_client):
+    request_ids = add_requests(empty_app, 5)
+
+    page = user_client.get("/request?status=PENDING").get_data(as_text=True)
+    assert listed(page) == request_ids[4::-2]
+
+    page = user_client.get("/request?from=2024-01-02&to=2024-01-03")
+    assert listed(page.get_data(as_text=True)) == request_ids[2:0:-1]
+
+    model_id = empty_app.config["TEST_MODEL_ID"]
+    page = user_client.get(f"/request?model={model_id}").get_data(as_text=True)
+    assert len(listed(page)) == 5
+
+    assert user_client.get("/request?status=DONE").status_code == 400
+    assert user_client.get("/request?after=yesterday").status_code == 400
+
+
+def test_only_waiting_requests_are_busy(empty_app, user_client):
+    pending, _, failed = add_requests(empty_app, 3)
+    with empty_app.app_context():
+        request = db.session.get(models.Request, uuid.UUID(failed))
+        request.status = RequestStatus.FAILED
+        db.session.commit()
+
+    page = user_client.get("/request").get_data(as_text=True)
+    busy = re.findall(r'id="status-([0-9a-f-]+)"[^>]*aria-busy="true"', page)
+    assert busy == [pending]
+    assert "Failed" in page
+
+
+def test_upgrade_backfills_created_at(empty_app, user_client):
+    add_requests(empty_app, 1)
+    with empty_app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_request_user_id_created_at"))
+            connection.execute(text("DROP INDEX ix_request_created_at"))
+            connection.execute(text("ALTER TABLE request DROP COLUMN created_at"))
+
+        upgrade_schema(db.engine)
+
+        request = db.session.scalar(select(models.Request))
+        assert request.created_at == request.queued_at
@@ -0,0 +1,66 @@
+import pickle
+
+from sqlalchemy import event, select, text
+
+from ai_service_platform.models import db, models
+from ai_service_platform.models.models import RequestOutput, summarize
+from ai_service_platform.models.schema import migrate_outputs
+from tests.model_server import predict
+from tests.test_blob_store import create_owner, create_request
+
+
+def test_output_is_loaded_lazily(empty_app):
+    output = predict(b"car")
+    with empty_app.app_context():
+        user, model = create_owner()
+        request = create_request(user, model)
+        request.output = output
+        db.session.commit()
+        request_id = request.public_id
+        db.session.expunge_all()
+
+        statements = []
+        event.listen(
+            db.engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+        )
+        request = db.session.get(models.Request, request_id)
+        assert request.summary == summarize(output)
+        assert len(request.summary) == 3
+        assert not any("request_output" in statement for statement in statements)
+
+        assert request.output == output
+        assert any("request_output" in statement for statement in statements)
+
+        db.session.delete(request)
+        db.session.commit()
+        assert db.session.scalar(select(RequestOutput)) is None
+
+
+def test_summarize():
+    output = [{"class": "a", "probability": 0.2}, {"class": "b", "probability": 0.7}]
+
+    assert summarize(output, size=1) == [{"class": "b", "probability": 0.7}]
+    assert summarize({"boxes": []}) is None
+    assert summarize(None) is None
+
+
+def test_migrate_outputs(empty_app):
+    output = predict(b"car")
+    with empty_app.app_context():
+        user, model = create_owner()
+        request = create_request(user, model)
+        request_id = request.public_id
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE request ADD COLUMN output BLOB"))
+            connection.execute(
+                text("UPDATE request SET output = :output"),
+                {"output": pickle.dumps(output)},
+            )
+
+        assert migrate_outputs(db.engine, chunk_size=1) == 1
+        assert migrate_outputs(db.engine) == 0
+
+        db.session.expunge_all()
+        request = db.session.get(models.Request, request_id)
+        assert request.output == output
+        assert request.summary == summarize(output)
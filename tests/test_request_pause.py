@@ -0,0 +1,55 @@
+import uuid
+
+from ai_service_platform.models import db, models, status_writer
+from ai_service_platform.models.models import RequestStatus
+from ai_service_platform.models.request_handler import finish_batch, start_batch
+from tests.model_server import predict
+from tests.test_request_list import add_requests
+
+
+def status(app, request_id):
+    with app.app_context():
+        return db.session.get(models.Request, uuid.UUID(request_id)).status
+
+
+def test_pause_and_resume(empty_app, user_client):
+    finished, pending = add_requests(empty_app, 2)[::-1]
+
+    response = user_client.post(f"/request/{pending}/pause")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert f"/request/{pending}/resume" in page
+    assert 'hx-swap-oob="true"' in page
+    assert status(empty_app, pending) == RequestStatus.PAUSED
+
+    # Only pending or running requests can be paused, only paused ones resumed
+    assert user_client.post(f"/request/{pending}/pause").status_code == 409
+    assert user_client.post(f"/request/{finished}/pause").status_code == 409
+    assert user_client.post(f"/request/{finished}/resume").status_code == 409
+
+    response = user_client.post(f"/request/{pending}/resume")
+    assert response.status_code == 200
+    assert f"/request/{pending}/pause" in response.get_data(as_text=True)
+    assert status(empty_app, pending) == RequestStatus.PENDING
+
+
+def test_late_answer_of_resumed_request(empty_app, user_client):
+    (request_id,) = add_requests(empty_app, 1)
+    with empty_app.app_context():
+        batch = start_batch([uuid.UUID(request_id)])
+        status_writer.submit([])
+    assert status(empty_app, request_id) == RequestStatus.RUNNING
+
+    assert user_client.post(f"/request/{request_id}/pause").status_code == 200
+    assert user_client.post(f"/request/{request_id}/resume").status_code == 200
+    with empty_app.app_context():
+        finish_batch(batch.request_ids, [predict(b"car")])
+
+    # Queued again instead of finished by the batch that was aborted
+    assert status(empty_app, request_id) == RequestStatus.PENDING
+
+
+def test_pause_unknown_request(empty_app, user_client):
+    add_requests(empty_app, 1)
+
+    assert user_client.post(f"/request/{uuid.uuid4()}/pause").status_code == 404
@@ -0,0 +1,120 @@
+from datetime import timedelta
+
+from sqlalchemy import func, select
+
+from ai_service_platform.models import db, models, result_cache
+from ai_service_platform.models.models import InferenceResult, RequestStatus, utcnow
+from ai_service_platform.models.request_handler import process_requests
+from tests.test_request_handler import add_requests
+
+
+def hash_car():
+    with open("tests/car.jpg", "rb") as file:
+        return result_cache.hash_file(file)
+
+
+def test_store_and_lookup(empty_app):
+    with empty_app.app_context():
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+
+        assert result_cache.lookup(model, "abc") is None
+        result_cache.store(model, "abc", [{"class": "cab"}])
+        assert result_cache.lookup(model, "abc") == [{"class": "cab"}]
+
+        # Only the persistent tier is left for other processes
+        empty_app.extensions["result_cache"].memory.remove_model(model.public_id)
+        assert result_cache.lookup(model, "abc") == [{"class": "cab"}]
+
+        stats = result_cache.stats()
+        assert (stats["misses"], stats["memory_hits"], stats["db_hits"]) == (1, 1, 1)
+
+
+def test_revision_invalidates(empty_app):
+    with empty_app.app_context():
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+        result_cache.store(model, "abc", [1])
+
+        model.revision += 1
+        db.session.commit()
+
+        assert result_cache.lookup(model, "abc") is None
+
+
+def test_hits_touch_results_rarely(empty_app):
+    with empty_app.app_context():
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+        result_cache.store(model, "abc", [1])
+        memory = empty_app.extensions["result_cache"].memory
+        key = (model.public_id, model.revision, "abc")
+
+        def last_used_after_hit():
+            memory.remove_model(model.public_id)
+            assert result_cache.lookup(model, "abc") == [1]
+            db.session.expire_all()
+            return db.session.get(InferenceResult, key)
+
+        stored = last_used_after_hit().last_used_at
+        assert last_used_after_hit().last_used_at == stored
+
+        result = db.session.get(InferenceResult, key)
+        result.last_used_at = utcnow() - timedelta(hours=1)
+        db.session.commit()
+        assert last_used_after_hit().last_used_at >= stored
+
+
+def test_store_many_keeps_stored_results(empty_app):
+    with empty_app.app_context():
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+        result_cache.store(model, "a", [1])
+
+        # Stored meanwhile by another worker
+        result_cache.store_many(model, {"a": [2], "b": [3]})
+
+        rows = db.session.execute(
+            select(InferenceResult.input_hash, InferenceResult.output).order_by(
+                InferenceResult.input_hash
+            )
+        ).all()
+        assert rows == [("a", [1]), ("b", [3])]
+
+
+def test_evict_oldest(empty_app):
+    empty_app.config["RESULT_CACHE_DB_BYTES"] = 10
+    result_cache.init_app(empty_app)
+    with empty_app.app_context():
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add(model)
+        db.session.commit()
+        for key in ["a", "b", "c"]:
+            result_cache.store(model, key, "1234")  # 6 bytes as JSON
+
+        result_cache.evict()
+
+        keys = db.session.scalars(select(InferenceResult.input_hash)).all()
+        assert keys == ["c"]
+        assert result_cache.stats()["evictions"] == 2
+
+
+def test_process_requests_uses_cache(empty_app, model_server):
+    with empty_app.app_context():
+        request_ids = add_requests(empty_app, 2)
+        for request_id in request_ids:
+            db.session.get(models.Request, request_id).input_hash = hash_car()
+        db.session.commit()
+
+        process_requests(request_ids[:1])
+        process_requests(request_ids[1:])
+
+        first, second = (db.session.get(models.Request, id) for id in request_ids)
+        assert second.status == RequestStatus.FINISHED
+        assert second.output == first.output
+        assert model_server.calls == [("squeezenet", 1)]
+        assert db.session.scalar(select(func.count(InferenceResult.input_hash))) == 1
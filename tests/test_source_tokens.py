@@ -0,0 +1,127 @@
+import io
+
+import pytest
+from sqlalchemy import select
+
+from ai_service_platform.models import db, models, source_tokens
+from ai_service_platform.models.models import RequestStatus, Role
+
+with open("tests/car.jpg", "rb") as f:
+    CAR = f.read()
+with open("tests/dog.jpg", "rb") as f:
+    DOG = f.read()
+
+
+@pytest.fixture
+def source_id(empty_app):
+    """Add a source owned by a USER2 user and a model"""
+    with empty_app.app_context():
+        owner = models.User(name="user2", password="", role=Role.USER2)
+        source = models.Source(name="camera", password="", owner=owner)
+        model = models.Model(name="squeezenet", server_model_name="squeezenet")
+        db.session.add_all([source, model])
+        db.session.commit()
+        empty_app.config["TEST_MODEL_ID"] = str(model.public_id)
+        return source.public_id
+
+
+def issue(app, source_id, scopes=source_tokens.SCOPES, max_age=None):
+    with app.app_context():
+        source = db.session.get(models.Source, source_id)
+        return source_tokens.issue(source, scopes, max_age)
+
+
+def verify(app, token, scope=source_tokens.UPLOAD):
+    with app.app_context():
+        return source_tokens.verify(token, scope)
+
+
+def test_verify(empty_app, source_id):
+    token = issue(empty_app, source_id, [source_tokens.UPLOAD])
+
+    principal = verify(empty_app, token)
+    assert principal.public_id == source_id
+    assert principal.role is Role.SOURCE
+    assert verify(empty_app, token, source_tokens.STATUS) is None
+
+    # Tokens can neither be altered nor signed with another key
+    payload, signature = token.rsplit(".", 1)
+    assert verify(empty_app, payload.replace("upload", "status") + signature) is None
+    altered = "B" if signature.endswith("A") else "A"
+    assert verify(empty_app, f"{payload}.{signature[:-1]}{altered}") is None
+    assert verify(empty_app, "ü.ü") is None
+    with empty_app.app_context():
+        stats = source_tokens.stats()
+        with pytest.raises(ValueError):
+            source_tokens.issue(db.session.get(models.Source, source_id), ["admin"])
+    assert (stats["issued"], stats["verified"], stats["rejected"]) == (1, 1, 4)
+
+    empty_app.config["SOURCE_TOKEN_SECRET"] = "other"
+    source_tokens.init_app(empty_app)
+    assert verify(empty_app, token) is None
+
+
+def test_expired_and_revoked(empty_app, source_id):
+    assert verify(empty_app, issue(empty_app, source_id, max_age=-1)) is None
+
+    token = issue(empty_app, source_id)
+    assert verify(empty_app, token) is not None
+    with empty_app.app_context():
+        source_tokens.revoke(db.session.get(models.Source, source_id))
+        db.session.commit()
+    assert verify(empty_app, token) is None
+    assert verify(empty_app, issue(empty_app, source_id)) is not None
+
+
+def test_owner_manages_tokens(empty_app, source_id):
+    client = empty_app.test_client()
+    with empty_app.app_context():
+        owner_id = db.session.scalar(select(models.User.public_id))
+    with client.session_transaction() as session:
+        session["user_id"] = owner_id
+
+    response = client.post(f"/source/{source_id}/tokens", json={"scopes": ["status"]})
+    assert response.status_code == 201
+    token = response.get_json()["token"]
+    assert verify(empty_app, token, source_tokens.STATUS) is not None
+
+    for scopes in [[], 5, "status", {"status": 1}, [["status"]]]:
+        response = client.post(f"/source/{source_id}/tokens", json={"scopes": scopes})
+        assert response.status_code == 400
+    limit = empty_app.config["SOURCE_TOKEN_MAX_AGE"]
+    for max_age in ["3600", -1, 0, 1.5, True, limit + 1]:
+        response = client.post(f"/source/{source_id}/tokens", json={"max_age": max_age})
+        assert response.status_code == 400
+    assert client.post(f"/source/{source_id}/tokens", json=[60]).status_code == 400
+    response = client.post(f"/source/{source_id}/tokens", json={"max_age": 60})
+    assert response.status_code == 201
+    assert client.delete(f"/source/{source_id}/tokens").status_code == 200
+    assert verify(empty_app, token, source_tokens.STATUS) is None
+
+
+def test_device_uploads(empty_app, source_id):
+    client = empty_app.test_client()
+    token = issue(empty_app, source_id)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def form():
+        return {
+            "model": empty_app.config["TEST_MODEL_ID"],
+            "input": [(io.BytesIO(CAR), "car.jpg"), (io.BytesIO(DOG), "dog.jpg")],
+        }
+
+    assert client.post("/source/requests", data=form()).status_code == 401
+    response = client.post("/source/requests", data=form(), headers=headers)
+    assert response.status_code == 201
+    request_ids = response.get_json()["requests"]
+    assert len(request_ids) == 2
+
+    with empty_app.app_context():
+        requests = db.session.scalars(select(models.Request)).all()
+        assert {str(request.public_id) for request in requests} == set(request_ids)
+        assert all(request.source_id == source_id for request in requests)
+        owner_id = requests[0].source.owner_id
+        assert all(request.user_id == owner_id for request in requests)
+
+    response = client.get(f"/source/requests/{request_ids[0]}", headers=headers)
+    assert response.get_json()["status"] == RequestStatus.PENDING.value
@@ -0,0 +1,125 @@
+import html
+import re
+import threading
+import uuid
+
+from sqlalchemy import select
+
+from ai_service_platform.models import db, models, status_events
+from ai_service_platform.models.models import RequestStatus
+from ai_service_platform.models.request_handler import process_requests
+from ai_service_platform.models.status_events import StatusEvent
+from tests.test_blob_store import create_owner, create_request
+from tests.test_uploads import upload
+
+
+def test_process_requests_publishes(empty_app, model_server):
+    empty_app.config["STATUS_PUSH_MAX_STREAMS"] = 3
+    status_events.init_app(empty_app)
+    with empty_app.app_context():
+        user, model = create_owner()
+        request = create_request(user, model)
+        own = status_events.subscribe(user.public_id)
+        everyone = status_events.subscribe(None)
+        other = status_events.subscribe(uuid.uuid4())
+
+        process_requests([request.public_id])
+
+        for subscription in (own, everyone):
+            statuses = []
+            while (event := subscription.get(timeout=0)) is not None:
+                statuses.append(event.status)
+            # RUNNING is left out if it was written together with FINISHED
+            assert statuses in (
+                [RequestStatus.RUNNING, RequestStatus.FINISHED],
+                [RequestStatus.FINISHED],
+            )
+        assert other.get(timeout=0) is None
+
+        other.close()
+        assert status_events.stats()["subscribers"] == 2
+
+
+def test_events_stream(empty_app, user_client):
+    empty_app.config["STATUS_PUSH_KEEPALIVE"] = 0.1
+    empty_app.config["STATUS_PUSH_DURATION"] = 0.5
+    with empty_app.app_context():
+        user_id = db.session.scalar(select(models.User.public_id))
+    event = StatusEvent(user_id, uuid.uuid4(), RequestStatus.FINISHED)
+
+    def publish():
+        with empty_app.app_context():
+            status_events.publish([event])
+
+    timer = threading.Timer(0.1, publish)
+    timer.start()
+    response = user_client.get("/request/events")
+    timer.join()
+
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert f"event: status-{event.public_id}\ndata: " in body
+    assert "View Output" in body
+    assert ": keepalive" in body
+    with empty_app.app_context():
+        assert status_events.stats()["subscribers"] == 0
+
+
+def test_streams_are_limited(empty_app, user_client):
+    empty_app.config["STATUS_PUSH_MAX_STREAMS"] = 1
+    status_events.init_app(empty_app)
+    with empty_app.app_context():
+        subscription = status_events.subscribe(None)
+
+    # The list keeps polling slowly instead
+    assert user_client.get("/request/events").status_code == 503
+    with empty_app.app_context():
+        assert status_events.stats()["rejected"] == 1
+        subscription.close()
+
+
+def test_list_connects_when_push_enabled(empty_app, user_client):
+    with open("tests/car.jpg", "rb") as file:
+        upload(empty_app, user_client, file.read())
+    with empty_app.app_context():
+        request_id = db.session.scalar(select(models.Request.public_id))
+
+    page = user_client.get("/request").get_data(as_text=True)
+    assert "sse-connect" not in page
+    assert "sse-swap" not in page
+    assert 'hx-trigger="load delay:1s"' in page
+
+    empty_app.config["STATUS_PUSH"] = True
+    page = user_client.get("/request").get_data(as_text=True)
+    assert 'sse-connect="/request/events"' in page
+    assert f'sse-swap="status-{request_id}"' in page
+    assert 'hx-trigger="load delay:10s"' in page
+
+
+def test_statuses_returns_changes(empty_app, user_client, model_server):
+    empty_app.config["STATUS_CURSOR_MARGIN"] = 0
+    with open("tests/car.jpg", "rb") as file:
+        upload(empty_app, user_client, file.read())
+    page = user_client.get("/request").get_data(as_text=True)
+    (poll_url,) = re.findall(r'hx-get="(/request/statuses[^"]*)"', page)
+    poll_url = html.unescape(poll_url)
+
+    # Nothing changed since the list was loaded
+    response = user_client.get(poll_url)
+    assert response.status_code == 200
+    assert "hx-swap-oob" not in response.text
+
+    with empty_app.app_context():
+        request_id = db.session.scalar(select(models.Request.public_id))
+        process_requests([request_id])
+
+    response = user_client.get(poll_url)
+    assert f'id="status-{request_id}"' in response.text
+    assert 'hx-swap-oob="true"' in response.text
+    assert "View Output" in response.text
+    assert user_client.get(f"{poll_url}&id={uuid.uuid4()}").text.count("oob") == 0
+
+    # The next poll starts after the change
+    (next_url,) = re.findall(r'hx-get="(/request/statuses[^"]*)"', response.text)
+    assert "hx-swap-oob" not in user_client.get(html.unescape(next_url)).text
+    assert user_client.get("/request/statuses?since=yesterday").status_code == 400
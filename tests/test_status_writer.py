@@ -0,0 +1,145 @@
+import threading
+
+from sqlalchemy import select
+
+from ai_service_platform.models import db, models, status_events, status_writer
+from ai_service_platform.models.models import RequestStatus, summarize
+from ai_service_platform.models.status_writer import Transition
+from tests.model_server import predict
+from tests.test_blob_store import create_owner, create_request
+
+
+def add_requests(count, status=RequestStatus.RUNNING):
+    user, model = create_owner()
+    requests = [create_request(user, model) for _ in range(count)]
+    for request in requests:
+        request.status = status
+    db.session.commit()
+    return user.public_id, [request.public_id for request in requests]
+
+
+def load(request_id):
+    db.session.expire_all()
+    return db.session.get(models.Request, request_id)
+
+
+def test_transitions_share_flushes(empty_app):
+    empty_app.config["STATUS_WRITER_INTERVAL"] = 0.05
+    status_writer.init_app(empty_app)
+    output = predict(b"car")
+    with empty_app.app_context():
+        user_id, request_ids = add_requests(8)
+
+    def finish(request_id):
+        with empty_app.app_context():
+            transition = Transition(
+                request_id, user_id, RequestStatus.FINISHED, output=output
+            )
+            status_writer.submit([transition])
+
+    threads = [threading.Thread(target=finish, args=(i,)) for i in request_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with empty_app.app_context():
+        assert status_writer.stats()["flushes"] < 8
+        assert status_writer.stats()["written"] == 8
+        for request_id in request_ids:
+            request = load(request_id)
+            assert request.status == RequestStatus.FINISHED
+            assert request.output == output
+            assert request.summary == summarize(output)
+            assert request.lease_expires_at is None
+        status_writer.shutdown()
+
+
+def test_transitions_keep_their_order(empty_app):
+    empty_app.config["STATUS_WRITER_INTERVAL"] = 10
+    status_writer.init_app(empty_app)
+    with empty_app.app_context():
+        user_id, (request_id,) = add_requests(1, RequestStatus.PENDING)
+        subscription = status_events.subscribe(user_id)
+        for status in (RequestStatus.RUNNING, RequestStatus.FINISHED):
+            status_writer.submit([Transition(request_id, user_id, status)], wait=False)
+        status_writer.submit(
+            [Transition(request_id, user_id, RequestStatus.FAILED)], wait=False
+        )
+
+        # Shutting down writes the buffered transitions in one flush
+        status_writer.shutdown()
+
+        assert load(request_id).status == RequestStatus.FAILED
+        assert status_writer.stats() == {
+            "enabled": True,
+            "buffered": 0,
+            "flushes": 1,
+            "written": 3,
+        }
+        assert subscription.get(timeout=0).status == RequestStatus.FAILED
+        assert subscription.get(timeout=0) is None
+
+
+def test_paused_and_deleted_requests_are_left_alone(empty_app):
+    output = predict(b"car")
+    with empty_app.app_context():
+        user_id, (paused, deleted) = add_requests(2)
+        db.session.delete(load(deleted))
+        load(paused).status = RequestStatus.PAUSED
+        db.session.commit()
+        subscription = status_events.subscribe(user_id)
+
+        status_writer.submit(
+            [
+                Transition(request_id, user_id, RequestStatus.FINISHED, output=output)
+                for request_id in (paused, deleted)
+            ]
+        )
+
+        assert load(paused).status == RequestStatus.PAUSED
+        assert db.session.scalars(select(models.RequestOutput)).all() == []
+        # Nobody is told about transitions that were not written
+        assert subscription.get(timeout=0) is None
+        status_writer.shutdown()
+
+
+def test_late_answers_are_dropped(empty_app):
+    output = predict(b"car")
+    with empty_app.app_context():
+        user_id, (resumed, failed) = add_requests(2)
+        # Paused and resumed, or failed by shedding, while the batch was running
+        for request_id, status in [
+            (resumed, RequestStatus.PENDING),
+            (failed, RequestStatus.FAILED),
+        ]:
+            load(request_id).status = status
+            db.session.commit()
+        db.session.commit()
+        subscription = status_events.subscribe(user_id)
+
+        status_writer.submit(
+            [
+                Transition(request_id, user_id, RequestStatus.FINISHED, output=output)
+                for request_id in (resumed, failed)
+            ]
+        )
+
+        assert load(resumed).status == RequestStatus.PENDING
+        assert load(failed).status == RequestStatus.FAILED
+        assert db.session.scalars(select(models.RequestOutput)).all() == []
+        assert subscription.get(timeout=0) is None
+        status_writer.shutdown()
+
+
+def test_disabled_writer_writes_right_away(empty_app):
+    empty_app.config["STATUS_WRITER"] = False
+    status_writer.init_app(empty_app)
+    with empty_app.app_context():
+        user_id, (request_id,) = add_requests(1, RequestStatus.PENDING)
+        status_writer.submit([Transition(request_id, user_id, RequestStatus.RUNNING)])
+
+        assert load(request_id).status == RequestStatus.RUNNING
+        assert status_writer.stats()["flushes"] == 0
+        updated_at = db.session.scalar(select(models.Request.updated_at))
+        assert updated_at > db.session.scalar(select(models.Request.created_at))
@@ -0,0 +1,82 @@
+import os
+import shutil
+
+from PIL import Image
+from sqlalchemy import select
+
+from ai_service_platform.models import db, models, thumbnails
+from tests.test_uploads import upload
+
+
+def add_uploads(app, count):
+    names = []
+    for i in range(count):
+        name = f"{i}_car.jpg"
+        shutil.copy("tests/car.jpg", os.path.join(app.config["UPLOAD_FOLDER"], name))
+        names.append(name)
+    return names
+
+
+def test_get_creates_thumbnail(empty_app):
+    (name,) = add_uploads(empty_app, 1)
+    with empty_app.app_context():
+        path = thumbnails.get(name)
+
+    assert path.endswith("0_car.160.webp")
+    with Image.open(path) as image:
+        assert image.format == "WEBP"
+        assert image.size == (160, 120)
+
+
+def test_cache_is_bounded(empty_app):
+    empty_app.config["THUMBNAIL_CACHE_BYTES"] = 10_000
+    thumbnails.init_app(empty_app)
+    with empty_app.app_context():
+        paths = [thumbnails.get(name) for name in add_uploads(empty_app, 10)]
+
+    folder = empty_app.config["THUMBNAIL_FOLDER"]
+    total = sum(os.path.getsize(os.path.join(folder, n)) for n in os.listdir(folder))
+    assert total <= 10_000
+    # The most recent thumbnails are kept
+    assert os.path.exists(paths[-1])
+    assert not os.path.exists(paths[0])
+
+
+def test_send_thumbnail(empty_app, user_client):
+    with open("tests/car.jpg", "rb") as file:
+        upload(empty_app, user_client, file.read())
+    with empty_app.app_context():
+        request = db.session.scalar(select(models.Request))
+        request_id, name = request.public_id, request.input_file
+
+    response = user_client.get(f"/thumbnails/{name}")
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert response.cache_control.immutable
+    etag, _ = response.get_etag()
+
+    headers = {"If-None-Match": f'"{etag}"'}
+    response = user_client.get(f"/thumbnails/{name}", headers=headers)
+    assert response.status_code == 304
+    assert user_client.get("/thumbnails/missing.jpg").status_code == 404
+    assert user_client.get("/thumbnails/../secret.jpg").status_code == 404
+    # Only for logged in users
+    assert empty_app.test_client().get(f"/thumbnails/{name}").status_code == 302
+
+    # Deleted together with the upload, even if the browser still has it. Waits
+    # for the thumbnail created in the background after the upload first.
+    empty_app.extensions["thumbnails"].executor.submit(lambda: None).result()
+    assert user_client.delete(f"/request/{request_id}").status_code == 200
+    assert os.listdir(empty_app.config["THUMBNAIL_FOLDER"]) == []
+    response = user_client.get(f"/thumbnails/{name}", headers=headers)
+    assert response.status_code == 404
+
+
+def test_list_uses_thumbnails(empty_app, user_client):
+    with open("tests/car.jpg", "rb") as file:
+        upload(empty_app, user_client, file.read())
+
+    page = user_client.get("/request").get_data(as_text=True)
+
+    assert "/thumbnails/" in page
+    assert "/uploads/" not in page
@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+
+import pytest
+from sqlalchemy import select
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from ai_service_platform.models import blob_store, db, models
+from ai_service_platform.uploads import UploadStream, sniff
+
+with open("tests/car.jpg", "rb") as f:
+    CAR = f.read()
+
+
+def test_sniff():
+    assert sniff(b"\xff\xd8\xff\xe0") == ".jpg"
+    assert sniff(b"\x89PNG\r\n\x1a\n\0") == ".png"
+    assert sniff(b"\x89PN") is None
+    with pytest.raises(UnsupportedMediaType):
+        sniff(b"GIF89a")
+
+
+def test_upload_stream(tmp_path):
+    stream = UploadStream(str(tmp_path), max_size=len(CAR))
+    for start in range(0, len(CAR), 1000):
+        stream.write(CAR[start : start + 1000])
+    stream.seek(0)
+
+    assert stream.read() == CAR
+    assert stream.extension == ".jpg"
+    assert stream.hexdigest() == hashlib.sha256(CAR).hexdigest()
+    stream.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_upload_stream_rejects_early(tmp_path):
+    stream = UploadStream(str(tmp_path), max_size=100)
+    with pytest.raises(UnsupportedMediaType):
+        stream.write(b"GIF89a")
+    assert os.listdir(tmp_path) == []
+
+    stream = UploadStream(str(tmp_path), max_size=100)
+    stream.write(CAR[:100])
+    with pytest.raises(RequestEntityTooLarge):
+        stream.write(CAR[100:101])
+    assert os.listdir(tmp_path) == []
+
+
+def upload(app, client, data, filename="car.jpg"):
+    form = {"model": app.config["TEST_MODEL_ID"], "input": (io.BytesIO(data), filename)}
+    return client.post("/request", data=form, content_type="multipart/form-data")
+
+
+def test_users_post_streams_to_blob_store(empty_app, user_client):
+    response = upload(empty_app, user_client, CAR)
+
+    assert response.status_code == 302
+    with empty_app.app_context():
+        request = db.session.scalar(select(models.Request))
+        assert request.input_hash == hashlib.sha256(CAR).hexdigest()
+        with open(blob_store.absolute_path(request.input_file), "rb") as f:
+            assert f.read() == CAR
+    assert os.listdir(os.path.join(empty_app.config["UPLOAD_FOLDER"], ".tmp")) == []
+
+
+def test_users_post_rejects_invalid(empty_app, user_client):
+    empty_app.config["UPLOAD_MAX_SIZE"] = 1000
+
+    assert upload(empty_app, user_client, b"not an image").status_code == 415
+    assert upload(empty_app, user_client, CAR).status_code == 413
+    assert upload(empty_app, user_client, b"").status_code == 415
+
+    with empty_app.app_context():
+        assert db.session.scalar(select(models.Request)) is None
+    assert os.listdir(os.path.join(empty_app.config["UPLOAD_FOLDER"], ".tmp")) == []